@@ -3,4 +3,7 @@ set -e
 echo "running functional tests:"
 bash test/func/unfazed_snv_test.sh
 bash test/func/unfazed_sv_test.sh
+bash test/func/unfazed_read_collector_test.sh
+bash test/func/unfazed_prepare_sites_test.sh
+bash test/func/unfazed_insert_sizes_test.sh
 echo "finished functional tests"
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""
+benchmark the lookup of denovo search windows that contain a sites VCF record,
+comparing the interval index used by find_many with a linear scan over
+every denovo on the chromosome (the approach it replaced)
+
+run from the repository root with:
+    python test/bench/bench_close_vars.py
+"""
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+
+from unfazed.informative_site_finder import create_lookups, get_close_vars
+
+CHROM_LEN = 50000000
+SEARCH_DIST = 5000
+QUERIES = 2000
+
+
+def make_dnms(count):
+    dnms = []
+    for i in range(count):
+        start = random.randint(SEARCH_DIST, CHROM_LEN - SEARCH_DIST)
+        if random.random() < 0.1:
+            end = start + random.randint(100, 50000)
+            vartype = "DEL"
+        else:
+            end = start + 1
+            vartype = "POINT"
+        dnms.append(
+            {
+                "chrom": "1",
+                "start": start,
+                "end": end,
+                "kid": "kid{}".format(i % 50),
+                "vartype": vartype,
+            }
+        )
+    return dnms
+
+
+def linear_close_vars(chrom, pos, vars_by_sample, search_dist):
+    close_var_keys = []
+    for sample in vars_by_sample:
+        if chrom not in vars_by_sample[sample]:
+            continue
+        for start in vars_by_sample[sample][chrom]:
+            for denovo in vars_by_sample[sample][chrom][start]:
+                if (start - search_dist) <= pos <= (int(denovo["end"]) + search_dist):
+                    close_var_keys.append([sample, chrom, start])
+    return close_var_keys
+
+
+def main():
+    random.seed(42)
+    pedigrees = {"kid{}".format(i): {"sex": "2"} for i in range(50)}
+    positions = [random.randint(1, CHROM_LEN) for _ in range(QUERIES)]
+    print("dnms\tlinear_us_per_record\tindexed_us_per_record\tspeedup")
+    for count in [100, 1000, 10000, 50000]:
+        dnms = make_dnms(count)
+        window_index, vars_by_sample = create_lookups(
+            dnms, pedigrees, "38", SEARCH_DIST, True
+        )[:2]
+        for pos in positions[:50]:
+            linear = sorted(linear_close_vars("1", pos, vars_by_sample, SEARCH_DIST))
+            indexed = sorted(get_close_vars("1", pos, window_index))
+            if linear != indexed:
+                sys.exit("index and linear scan disagree at {}".format(pos))
+
+        linear_time = timeit.timeit(
+            lambda: [
+                linear_close_vars("1", pos, vars_by_sample, SEARCH_DIST)
+                for pos in positions
+            ],
+            number=1,
+        )
+        indexed_time = timeit.timeit(
+            lambda: [get_close_vars("1", pos, window_index) for pos in positions],
+            number=1,
+        )
+        print(
+            "{}\t{:.2f}\t{:.2f}\t{:.0f}x".format(
+                count,
+                1e6 * linear_time / QUERIES,
+                1e6 * indexed_time / QUERIES,
+                linear_time / indexed_time,
+            )
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+"""
+benchmark the read QC filter, comparing goodread with the per-base loop it replaced
+and with counting low base qualities through numpy
+
+run from the repository root with:
+    python test/bench/bench_goodread.py
+"""
+from __future__ import print_function
+
+import random
+import sys
+import timeit
+
+import numpy as np
+import pysam
+
+import unfazed.read_collector as read_collector
+from unfazed.utils import CIGAR_MAP
+
+READS = 20000
+READLEN = 151
+MIN_MAPQ = 1
+MIN_BASE_QUAL = 20
+
+
+def make_reads(count):
+    header = pysam.AlignmentHeader.from_dict(
+        {"SQ": [{"SN": "1", "LN": 50000000}, {"SN": "2", "LN": 50000000}]}
+    )
+    reads = []
+    for i in range(count):
+        read = pysam.AlignedSegment(header)
+        read.query_name = "r{}".format(i)
+        read.reference_id = 0
+        read.reference_start = random.randint(1, 49000000)
+        read.next_reference_id = 0 if random.random() < 0.98 else 1
+        read.next_reference_start = read.reference_start + 300
+        read.mapping_quality = 60 if random.random() < 0.95 else 0
+        read.flag = 0x1 | 0x2 | random.choice([0x40, 0x80])
+        if random.random() < 0.05:
+            read.flag |= random.choice([0x4, 0x8, 0x100, 0x200, 0x400, 0x800])
+        cigar = [(0, READLEN)]
+        if random.random() < 0.2:
+            # split the match with small indels
+            cigar = []
+            query_left = READLEN
+            while query_left > 20:
+                match_len = random.randint(5, 20)
+                cigar.append((random.choice([0, 7, 8]), match_len))
+                query_left -= match_len
+                operation = random.choice([1, 2])
+                op_len = random.randint(1, 3)
+                if operation == 2:
+                    cigar.append((2, op_len))
+                else:
+                    op_len = min(op_len, query_left - 1)
+                    cigar.append((1, op_len))
+                    query_left -= op_len
+            cigar.append((0, query_left))
+        read.cigartuples = cigar
+        read.query_sequence = "A" * READLEN
+        low_qual_rate = 0.01 if random.random() < 0.9 else 0.2
+        read.query_qualities = pysam.qualitystring_to_array(
+            "".join(
+                (
+                    chr(33 + random.randint(2, MIN_BASE_QUAL - 1))
+                    if random.random() < low_qual_rate
+                    else chr(33 + 35)
+                )
+                for _ in range(READLEN)
+            )
+        )
+        reads.append(read)
+    return reads
+
+
+def loop_goodread(read, discordant=False):
+    """
+    the per-base loop goodread replaced, counting non-match cigar operations
+    correctly so that its results can be compared
+    """
+    if not read:
+        return False
+    if (
+        read.is_qcfail
+        or read.is_unmapped
+        or read.is_duplicate
+        or int(read.mapping_quality) < MIN_MAPQ
+        or read.is_secondary
+        or read.is_supplementary
+        or read.mate_is_unmapped
+        or (read.next_reference_id != read.reference_id)
+    ):
+        return False
+    if not discordant:
+        low_quals = 0
+        for qual in read.query_qualities:
+            if qual < MIN_BASE_QUAL:
+                low_quals += 1
+        mismatches = 0
+        for operation in read.cigartuples:
+            if CIGAR_MAP[operation[0]] not in ["=", "M"]:
+                mismatches += 1
+        if low_quals > 10 or mismatches > 10:
+            return False
+    return True
+
+
+def numpy_goodread(read, discordant=False):
+    """
+    goodread with the low base qualities counted by numpy
+    """
+    if not read:
+        return False
+    if (
+        read.flag & read_collector.BAD_READ_FLAGS
+        or read.mapping_quality < MIN_MAPQ
+        or (read.next_reference_id != read.reference_id)
+    ):
+        return False
+    if not discordant:
+        low_quals = np.count_nonzero(
+            np.frombuffer(read.query_qualities, dtype=np.uint8) < MIN_BASE_QUAL
+        )
+        op_blocks = read.get_cigar_stats()[1]
+        mismatches = sum(op_blocks) - op_blocks[0] - op_blocks[7]
+        if low_quals > 10 or mismatches > 10:
+            return False
+    return True
+
+
+def main():
+    random.seed(42)
+    read_collector.MIN_MAPQ = MIN_MAPQ
+    read_collector.MIN_BASE_QUAL = MIN_BASE_QUAL
+    read_collector.LOW_QUALS = read_collector.get_low_quals(MIN_BASE_QUAL)
+    reads = make_reads(READS)
+    for read in reads:
+        for discordant in [False, True]:
+            expected = read_collector.goodread(read, discordant)
+            if (
+                loop_goodread(read, discordant) != expected
+                or numpy_goodread(read, discordant) != expected
+            ):
+                sys.exit("implementations disagree on {}".format(read.query_name))
+
+    print("check\tloop_us_per_read\tnumpy_us_per_read\tgoodread_us_per_read\tspeedup")
+    for discordant in [False, True]:
+        times = [
+            timeit.timeit(
+                lambda: [goodread(read, discordant) for read in reads], number=3
+            )
+            / 3
+            for goodread in [loop_goodread, numpy_goodread, read_collector.goodread]
+        ]
+        print(
+            "{}\t{:.2f}\t{:.2f}\t{:.2f}\t{:.1f}x".format(
+                "discordant" if discordant else "concordant",
+                1e6 * times[0] / READS,
+                1e6 * times[1] / READS,
+                1e6 * times[2] / READS,
+                times[0] / times[2],
+            )
+        )
+
+
+if __name__ == "__main__":
+    sys.exit(main())
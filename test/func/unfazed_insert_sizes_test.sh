@@ -0,0 +1,194 @@
+#!/bin/bash
+
+test -e ssshtest || wget -q https://raw.githubusercontent.com/ryanlayer/ssshtest/master/ssshtest
+. ssshtest
+
+STOP_ON_FAIL=1
+
+tmp_dir=$(mktemp -d)
+bam=$tmp_dir"/pairs.bam"
+cache=$tmp_dir"/cache"
+metrics_dir=$tmp_dir"/metrics"
+mkdir $metrics_dir
+
+echo "insert size tests"
+echo "##########################################################################"
+
+# read pairs with 300 base fragments. inserts are measured by read as
+# |tlen - 2 * readlen|, so the second reads have the longest inserts, of 602
+make_bam=$(cat <<'EOF'
+import sys
+
+import pysam
+
+header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "1", "LN": 100000}]})
+reads = []
+for i in range(2000):
+    start = 40 * i
+    tlen = 300
+    for is_read1 in [True, False]:
+        read = pysam.AlignedSegment(header)
+        read.query_name = "pair{}".format(i)
+        read.reference_id = 0
+        read.next_reference_id = 0
+        read.reference_start = start if is_read1 else start + tlen - 151
+        read.next_reference_start = start + tlen - 151 if is_read1 else start
+        read.template_length = tlen if is_read1 else -tlen
+        read.flag = 0x1 | 0x2 | (0x40 | 0x20 if is_read1 else 0x80 | 0x10)
+        read.mapping_quality = 60
+        read.cigartuples = [(0, 151)]
+        read.query_sequence = "A" * 151
+        read.query_qualities = pysam.qualitystring_to_array("I" * 151)
+        reads.append(read)
+reads.sort(key=lambda read: read.reference_start)
+with pysam.AlignmentFile(sys.argv[1], "wb", header=header) as bam_out:
+    for read in reads:
+        bam_out.write(read)
+pysam.index(sys.argv[1])
+EOF
+)
+
+python -c "$make_bam" $bam
+
+# a cached length is used in place of an estimate while the alignment file is
+# unchanged, and estimated again once it changes or the cache is rebuilt.
+# the cached length is overwritten, so the test can tell which one was used
+cache_test=$(cat <<'EOF'
+import json
+import os
+import sys
+
+import unfazed.insert_sizes as insert_sizes
+
+bam_name, cache_dir = sys.argv[1:]
+cache_name = os.path.join(cache_dir, insert_sizes.CACHE_NAME)
+
+
+def get_insert_len():
+    return insert_sizes.get_concordant_insert_len(bam_name, None, 1000000, 3, 151)
+
+
+def set_cached_insert_len(insert_len):
+    with open(cache_name, "r") as cache_file:
+        cache = json.load(cache_file)
+    cache["entries"][0]["concordant_insert_len"] = insert_len
+    with open(cache_name, "w") as cache_file:
+        json.dump(cache, cache_file)
+
+
+def get_status():
+    return [entry["status"] for entry in insert_sizes.get_cache_stats(cache_dir)]
+
+
+insert_sizes.set_insert_size_cache(cache_dir, False, True)
+print("estimated", get_insert_len(), get_status())
+set_cached_insert_len(12345.0)
+print("cache hit", get_insert_len())
+
+stat = os.stat(bam_name)
+os.utime(bam_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+print("changed status", get_status())
+print("changed", get_insert_len(), get_status())
+
+set_cached_insert_len(12345.0)
+insert_sizes.set_insert_size_cache(cache_dir, True, True)
+print("rebuilt", get_insert_len())
+insert_sizes.set_insert_size_cache(cache_dir, False, True)
+print("after rebuild", get_insert_len(), len(insert_sizes.read_cache(cache_dir)))
+
+stat = os.stat(bam_name)
+os.utime(bam_name, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+EOF
+)
+
+run insert_size_cache \
+    python -c "$cache_test" $bam $cache
+if [ $insert_size_cache ]; then
+    assert_exit_code 0
+    assert_in_stdout "estimated 602.0 ['current']"
+    assert_in_stdout 'cache hit 12345.0'
+    assert_in_stdout "changed status ['changed']"
+    assert_in_stdout "changed 602.0 ['current']"
+    assert_in_stdout 'rebuilt 602.0'
+    assert_in_stdout 'after rebuild 602.0 1'
+fi
+
+run insert_size_cache_stats \
+    unfazed insert-sizes -c $cache
+if [ $insert_size_cache_stats ]; then
+    assert_exit_code 0
+    assert_in_stdout '#path	status	concordant_insert_len'
+    assert_in_stdout 'pairs.bam	changed	602.0'
+fi
+
+cat > $metrics_dir/NA1.insert_size_metrics <<'EOF'
+## htsjdk.samtools.metrics.StringHeader
+# CollectInsertSizeMetrics INPUT=NA1.bam OUTPUT=NA1.insert_size_metrics
+## METRICS CLASS	picard.analysis.InsertSizeMetrics
+MEDIAN_INSERT_SIZE	MEAN_INSERT_SIZE	STANDARD_DEVIATION	READ_PAIRS	PAIR_ORIENTATION	SAMPLE	LIBRARY	READ_GROUP
+400	400.5	50	900000	FR
+250	250	20	1000	RF
+
+## HISTOGRAM	java.lang.Integer
+insert_size	All_Reads.fr_count
+400	1000
+EOF
+
+cat > $metrics_dir/NA2.stats <<'EOF'
+# This file was produced by samtools stats
+SN	raw total sequences:	2000000
+SN	insert size average:	412.5
+SN	insert size standard deviation:	51.5
+SN	inward oriented pairs:	900000
+EOF
+
+printf "#sample\tmean\tstdev\nNA1\t380\t40\nNA3 390 45\n" > $tmp_dir"/metrics.txt"
+
+# concordant lengths are the mean plus three stdevs, plus both reads
+metrics=$(cat <<'EOF'
+import sys
+
+from unfazed.insert_sizes import read_insert_size_metrics
+
+metrics = read_insert_size_metrics(sys.argv[1], ["NA1", "NA2", "NA3"], 3, 151)
+for sample in sorted(metrics):
+    print(sample, metrics[sample])
+EOF
+)
+
+run insert_size_metrics_dir \
+    python -c "$metrics" $metrics_dir
+if [ $insert_size_metrics_dir ]; then
+    assert_exit_code 0
+    assert_in_stdout 'NA1 852.5'
+    assert_in_stdout 'NA2 869.0'
+    assert_in_stderr 'no insert size metrics for NA3, estimating from reads'
+fi
+
+run insert_size_metrics_table \
+    python -c "$metrics" $tmp_dir"/metrics.txt"
+if [ $insert_size_metrics_table ]; then
+    assert_exit_code 0
+    assert_in_stdout 'NA1 802.0'
+    assert_in_stdout 'NA3 827.0'
+    assert_in_stderr 'no insert size metrics for NA2, estimating from reads'
+fi
+
+sed -i.bak 's/^400	400.5/400	n\/a/' $metrics_dir/NA1.insert_size_metrics
+rm $metrics_dir/NA1.insert_size_metrics.bak
+run insert_size_metrics_malformed \
+    python -c "$metrics" $metrics_dir
+if [ $insert_size_metrics_malformed ]; then
+    assert_exit_code 1
+    assert_in_stderr 'Unreadable insert size metrics in'
+fi
+
+printf "NA1\t380\n" > $tmp_dir"/metrics.txt"
+run insert_size_metrics_table_malformed \
+    python -c "$metrics" $tmp_dir"/metrics.txt"
+if [ $insert_size_metrics_table_malformed ]; then
+    assert_exit_code 1
+    assert_in_stderr 'needs sample, mean and stdev on each line, not: NA1	380'
+fi
+
+rm -rf $tmp_dir
@@ -0,0 +1,66 @@
+#!/bin/bash
+
+test -e ssshtest || wget -q https://raw.githubusercontent.com/ryanlayer/ssshtest/master/ssshtest
+. ssshtest
+
+STOP_ON_FAIL=1
+data_path="test/data/"
+
+bam=$data_path"NA12878.bam"
+sites_vcf=$data_path"trio_snvs_chr22.vcf.gz"
+snv_hets_vcf=$data_path"trio_hets_snvs_chr22.vcf.gz"
+ped=$data_path"trio.ped"
+store_dir=$(mktemp -d)
+store=$store_dir"/sites_store"
+
+
+echo "sites store tests"
+echo "##########################################################################"
+
+run prepare_sites_store \
+    unfazed prepare-sites \
+        -s $sites_vcf \
+        -p $ped \
+        -o $store
+if [ $prepare_sites_store ]; then
+    assert_exit_code 0
+    assert_in_stderr 'Wrote informative sites for 1 trios to'
+fi
+
+run phase_snv_with_store \
+    unfazed \
+        -d $snv_hets_vcf \
+        -s $store \
+        -p $ped \
+        --quiet \
+        -o bed\
+        --build 38\
+        --verbose \
+        --bam-pairs "NA12878":$bam
+if [ $phase_snv_with_store ]; then
+    assert_exit_code 0
+    assert_in_stdout '#chrom	start	end	vartype	kid	origin_parent	other_parent	evidence_count	evidence_types	origin_parent_sites	origin_parent_reads	other_parent_sites	other_parent_reads'
+    assert_in_stdout '22	18844941	18844942	POINT	NA12878	NA12892	NA12891	1	READBACKED	18844298'
+    assert_in_stdout '22	21088145	21088146	POINT	NA12878	NA12892	NA12891	1	READBACKED	21087760'
+    assert_in_stdout '22	30862399	30862400	POINT	NA12878	NA12891	NA12892	2	READBACKED	30861914,30861930'
+    assert_in_stdout '22	41609689	41609690	POINT	NA12878	NA12892	NA12891	3	READBACKED	41609429,41609442,41609858'
+    assert_in_stdout '22	50617725	50617726	POINT	NA12878	NA12891	NA12892	1	READBACKED	50617982'
+fi
+
+# a store only holds the sites that passed the filters it was prepared with
+run phase_snv_with_store_filter_mismatch \
+    unfazed \
+        -d $snv_hets_vcf \
+        -s $store \
+        -p $ped \
+        --quiet \
+        -o bed\
+        --build 38\
+        --min-gt-qual 30 \
+        --bam-pairs "NA12878":$bam
+if [ $phase_snv_with_store_filter_mismatch ]; then
+    assert_exit_code 1
+    assert_in_stderr 'was prepared with min_gt_qual 20, not 30. Rerun `unfazed prepare-sites` with matching options'
+fi
+
+rm -rf $store_dir
@@ -0,0 +1,300 @@
+#!/bin/bash
+
+test -e ssshtest || wget -q https://raw.githubusercontent.com/ryanlayer/ssshtest/master/ssshtest
+. ssshtest
+
+STOP_ON_FAIL=1
+
+echo "read collector tests"
+echo "##########################################################################"
+
+# a chain of 20000 reads, each sharing a het site with the next and carrying the
+# other allele, which is far deeper than python's recursion limit.
+# the reads alternate between the haplotypes
+long_chain=$(cat <<'EOF'
+import pysam
+
+import unfazed.read_collector as read_collector
+
+read_collector.READLEN = 151
+read_collector.MIN_BASE_QUAL = 20
+header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "1", "LN": 10000000}]})
+chain_len = 20000
+sites = [
+    {"pos": 100 * i + 20, "ref_allele": "A", "alt_allele": "C"}
+    for i in range(chain_len + 1)
+]
+read_sites = {}
+site_reads = {}
+fetched_reads = {}
+for i in range(chain_len):
+    read = pysam.AlignedSegment(header)
+    read.query_name = "read{}".format(i)
+    read.reference_id = 0
+    read.reference_start = 100 * i
+    read.cigartuples = [(0, 151)]
+    read.query_sequence = ("C" if i % 2 == 0 else "A") * 151
+    read.query_qualities = pysam.qualitystring_to_array("I" * 151)
+    fetched_reads[read.query_name] = [read, None]
+    read_sites[read.query_name] = [sites[i], sites[i + 1]]
+    for site in read_sites[read.query_name]:
+        site_reads.setdefault(site["pos"], []).append(read.query_name)
+
+grouped = read_collector.connect_reads(
+    {"alt": {"read0"}, "ref": set()},
+    read_sites,
+    site_reads,
+    {"alt": [["read0", -1]], "ref": []},
+    fetched_reads,
+)
+print("alt", len(grouped["alt"]), "ref", len(grouped["ref"]))
+print("read19999", "alt" if "read19999" in grouped["alt"] else "ref")
+EOF
+)
+
+run connect_reads_long_chain \
+    python -c "$long_chain"
+if [ $connect_reads_long_chain ]; then
+    assert_exit_code 0
+    assert_in_stdout 'alt 10000 ref 10000'
+    assert_in_stdout 'read19999 ref'
+fi
+
+# a pile-up of 5000 read pairs over one het site, after another 5000 pairs that
+# start in the lead-in of its fetch window without reaching the site.
+# with --max-reads 10 no stretch of a window, before, over, or after its sites,
+# reads more than its scan limit, whether sampling the reads at a variant or at
+# het sites, and the mates of the sampled reads outside the part of the window
+# that was read are still found. a sweep over the pile-up stops at its own limit
+pileup=$(cat <<'EOF'
+import os
+import random
+import tempfile
+
+import pysam
+
+import unfazed.read_collector as read_collector
+
+read_collector.READLEN = 151
+read_collector.MIN_BASE_QUAL = 20
+read_collector.LOW_QUALS = read_collector.get_low_quals(20)
+read_collector.MIN_MAPQ = 1
+read_collector.MAX_READS = 10
+site = 10000
+concordant_upper_len = 500
+pairs = 5000
+
+header = pysam.AlignmentHeader.from_dict({"SQ": [{"SN": "1", "LN": 100000}]})
+rng = random.Random(0)
+reads = []
+for i in range(2 * pairs):
+    if i < pairs:
+        start = rng.randint(site - 140, site - 10)
+        mate_offset = 300
+    else:
+        start = rng.randint(site - 450, site - 300)
+        mate_offset = 100
+    for is_read1 in [True, False]:
+        read = pysam.AlignedSegment(header)
+        read.query_name = "pair{}".format(i)
+        read.reference_id = 0
+        read.next_reference_id = 0
+        read.reference_start = start if is_read1 else start + mate_offset
+        read.next_reference_start = start + mate_offset if is_read1 else start
+        tlen = mate_offset + 151
+        read.template_length = tlen if is_read1 else -tlen
+        read.flag = 0x1 | 0x2 | (0x40 | 0x20 if is_read1 else 0x80 | 0x10)
+        read.mapping_quality = 60
+        read.cigartuples = [(0, 151)]
+        read.query_sequence = "A" * 151
+        read.query_qualities = pysam.qualitystring_to_array("I" * 151)
+        reads.append(read)
+reads.sort(key=lambda read: read.reference_start)
+bam_name = os.path.join(tempfile.mkdtemp(), "pileup.bam")
+with pysam.AlignmentFile(bam_name, "wb", header=header) as bam_out:
+    for read in reads:
+        bam_out.write(read)
+pysam.index(bam_name)
+bamfile = pysam.AlignmentFile(bam_name, "rb")
+
+
+def count_buffered(read_buffer):
+    return sum(len(reads) for reads in read_buffer["reads"].values())
+
+
+def get_fetch_limit(regions):
+    """
+    the scan limits of the stretches before, over, and after the regions
+    """
+    window_start = regions[0][0] - concordant_upper_len
+    limit = read_collector.get_scan_limit(window_start, regions[0][0])
+    for idx, (start, end) in enumerate(regions):
+        if idx > 0:
+            limit += read_collector.get_scan_limit(regions[idx - 1][1], start)
+        limit += read_collector.get_scan_limit(start, end)
+    window_end = regions[-1][1] + concordant_upper_len
+    return limit + read_collector.get_scan_limit(regions[-1][1], window_end)
+
+
+variant_regions = [[site - 1, site + 1]]
+read_buffer = read_collector.new_read_buffer(bamfile, "1")
+sample = read_collector.sample_reads(
+    read_collector.fetch_pairs(
+        bamfile, read_buffer, variant_regions, concordant_upper_len
+    ),
+    read_collector.MAX_READS,
+    site,
+)
+print("variant sampled", len(sample))
+print(
+    "variant reads read within limit",
+    count_buffered(read_buffer) <= get_fetch_limit(variant_regions),
+)
+mates = [read_collector.find_mate(bamfile, read, read_buffer) for read in sample]
+print(
+    "variant mates found",
+    sum(
+        mate is not None and mate.query_name == read.query_name and mate.is_read2
+        for read, mate in zip(sample, mates)
+    ),
+)
+
+# the het sites are fetched together, with the lead-in pile-up between them
+het_sites = [
+    {"pos": pos, "ref_allele": "A", "alt_allele": "C"} for pos in [site - 700, site]
+]
+read_buffer = read_collector.new_read_buffer(bamfile, "1")
+read_collector.group_reads_by_haplotype(
+    bamfile,
+    {"chrom": "1", "start": site, "end": site + 1},
+    {"alt": [], "ref": []},
+    het_sites,
+    0,
+    concordant_upper_len,
+    read_buffer,
+)
+het_site_regions = [[het_site["pos"], het_site["pos"] + 1] for het_site in het_sites]
+print(
+    "het site reads read within limit",
+    count_buffered(read_buffer) <= get_fetch_limit(het_site_regions),
+)
+
+
+class CountingBam:
+    """
+    an alignment file that counts the reads its fetches read
+    """
+
+    def __init__(self, bamfile):
+        self.filename = bamfile.filename
+        self.bamfile = bamfile
+        self.read_count = 0
+
+    def fetch(self, **kwargs):
+        for read in self.bamfile.fetch(**kwargs):
+            self.read_count += 1
+            yield read
+
+
+# a sweep over the pile-up stops once it passes its scan limit and is dropped
+sweep_span = [site - 1000, site + 1000]
+counting_bam = CountingBam(bamfile)
+print("deep sweep", read_collector.get_sweep(counting_bam, 0, sweep_span))
+print(
+    "deep sweep read within limit",
+    counting_bam.read_count
+    <= read_collector.get_scan_limit(sweep_span[0], sweep_span[1]) + 1,
+)
+
+# reads in the overlap of two windows are only buffered by the first
+read_collector.MAX_READS = 4 * pairs
+read_buffer = read_collector.new_read_buffer(bamfile, "1")
+for start in [site - 1, site + 300]:
+    for read in read_collector.fetch_pairs(
+        bamfile, read_buffer, [[start, start + 2]], concordant_upper_len
+    ):
+        pass
+buffered = [
+    (read.query_name, read.flag)
+    for reads in read_buffer["reads"].values()
+    for read in reads
+]
+print("overlapping windows buffered", len(buffered), "unique", len(set(buffered)))
+
+# a window read partway may stop among the reads that start where it stopped,
+# and a later window buffers only the ones it didn't read
+read_buffer = read_collector.new_read_buffer(bamfile, "1")
+reads = read_collector.fetch_pairs(
+    bamfile, read_buffer, [[site - 1, site + 1]], concordant_upper_len
+)
+for read_idx, read in zip(range(5000), reads):
+    pass
+for read in read_collector.fetch_pairs(
+    bamfile, read_buffer, [[site + 300, site + 302]], concordant_upper_len
+):
+    pass
+buffered = [
+    (read.query_name, read.flag)
+    for reads in read_buffer["reads"].values()
+    for read in reads
+]
+print("partly read window buffered", len(buffered), "unique", len(set(buffered)))
+
+# with no cap the sweep is kept. the thread still holds the dropped sweep of the
+# earlier span, so this one starts a base later
+sweep = read_collector.get_sweep(bamfile, 0, [site - 999, site + 1000])
+print("shallow sweep", len(sweep["reads"]))
+
+read_buffer = read_collector.new_read_buffer(bamfile, "1")
+sample = read_collector.sample_reads(
+    read_collector.fetch_pairs(
+        bamfile, read_buffer, variant_regions, concordant_upper_len
+    ),
+    read_collector.MAX_READS,
+    site,
+)
+print("uncapped sampled", len(sample), "read", count_buffered(read_buffer))
+EOF
+)
+
+run sample_reads_pileup \
+    python -c "$pileup"
+if [ $sample_reads_pileup ]; then
+    assert_exit_code 0
+    assert_in_stdout 'variant sampled 10'
+    assert_in_stdout 'variant reads read within limit True'
+    assert_in_stdout 'variant mates found 10'
+    assert_in_stdout 'het site reads read within limit True'
+    assert_in_stdout 'deep sweep None'
+    assert_in_stdout 'deep sweep read within limit True'
+    assert_in_stdout 'overlapping windows buffered 20000 unique 20000'
+    assert_in_stdout 'partly read window buffered 20000 unique 20000'
+    assert_in_stdout 'shallow sweep 20000'
+    assert_in_stdout 'uncapped sampled 5000 read 20000'
+fi
+
+# a kid with more than a worker's share of the variants is split into runs,
+# but never between variants in the same sweep
+schedule=$(cat <<'EOF'
+from unfazed.utils import schedule_by_kid
+
+sweep_span = [1200, 1800]
+dnms = [
+    {"kid": "NA1", "chrom": "1", "start": start, "end": start + 1, "sweep_span": None}
+    for start in [100, 200, 1300, 1400, 1500, 1600]
+]
+for denovo in dnms[2:]:
+    denovo["sweep_span"] = sweep_span
+schedule = schedule_by_kid(dnms, 3)
+print("workers", [worker for worker, denovo in schedule])
+print("starts", [denovo["start"] for worker, denovo in schedule])
+EOF
+)
+
+run schedule_sweeps \
+    python -c "$schedule"
+if [ $schedule_sweeps ]; then
+    assert_exit_code 0
+    assert_in_stdout 'workers [0, 0, 0, 0, 1, 1]'
+    assert_in_stdout 'starts [1300, 1400, 1500, 1600, 100, 200]'
+fi
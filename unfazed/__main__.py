@@ -5,7 +5,8 @@ import argparse
 import sys
 
 from .__init__ import __version__
-from .unfazed import unfazed
+from .insert_sizes import get_default_cache_dir
+from .unfazed import insert_size_stats, prepare_sites, unfazed
 
 
 def pair(arg):
@@ -16,6 +17,40 @@ def float_pair(arg):
     return [float(x) for x in arg.split(":")]
 
 
+def add_site_filter_args(parser):
+    parser.add_argument(
+        "--min-gt-qual",
+        help="min genotype and base quality for informative sites",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        "--min-depth", help="min coverage for informative sites", type=int, default=10
+    )
+
+    parser.add_argument(
+        "--ab-homref",
+        help="allele balance range for homozygous reference informative sites",
+        type=float_pair,
+        default="0.0:0.2",
+    )
+
+    parser.add_argument(
+        "--ab-homalt",
+        help="allele balance range for homozygous alternate informative sites",
+        type=float_pair,
+        default="0.8:1.0",
+    )
+
+    parser.add_argument(
+        "--ab-het",
+        help="allele balance range for heterozygous informative sites",
+        type=float_pair,
+        default="0.2:0.8",
+    )
+
+
 def setup_args():
     parser = argparse.ArgumentParser(
         prog="unfazed", formatter_class=argparse.ArgumentDefaultsHelpFormatter
@@ -39,7 +74,8 @@ def setup_args():
         "-s",
         "--sites",
         help="sorted/bgzipped/indexed VCF/BCF file of SNVs to identify "
-        + "informative sites. Must contain each kid and both parents",
+        + "informative sites. Must contain each kid and both parents. "
+        + "Can also be a store written by `unfazed prepare-sites`",
         required=True,
     )
 
@@ -76,6 +112,14 @@ def setup_args():
         "-t", "--threads", help="number of threads to use", type=int, default=2
     )
 
+    parser.add_argument(
+        "--max-open-files",
+        help="maximum number of alignment and VCF files each thread keeps open "
+        + "for reuse by later variants",
+        type=int,
+        default=16,
+    )
+
     parser.add_argument(
         "-o",
         "--output-type",
@@ -143,37 +187,7 @@ def setup_args():
         action="store_true",
     )
 
-    parser.add_argument(
-        "--min-gt-qual",
-        help="min genotype and base quality for informative sites",
-        type=int,
-        default=20,
-    )
-
-    parser.add_argument(
-        "--min-depth", help="min coverage for informative sites", type=int, default=10
-    )
-
-    parser.add_argument(
-        "--ab-homref",
-        help="allele balance range for homozygous reference informative sites",
-        type=float_pair,
-        default="0.0:0.2",
-    )
-
-    parser.add_argument(
-        "--ab-homalt",
-        help="allele balance range for homozygous alternate informative sites",
-        type=float_pair,
-        default="0.8:1.0",
-    )
-
-    parser.add_argument(
-        "--ab-het",
-        help="allele balance range for heterozygous informative sites",
-        type=float_pair,
-        default="0.2:0.8",
-    )
+    add_site_filter_args(parser)
 
     parser.add_argument(
         "--evidence-min-ratio",
@@ -195,6 +209,33 @@ def setup_args():
         default=1000000,
     )
 
+    parser.add_argument(
+        "--insert-size-cache",
+        help="directory to cache the concordant insert size estimated for each "
+        + "alignment file in, so later runs can reuse it. "
+        + "An empty string turns off the cache",
+        type=str,
+        default=get_default_cache_dir(),
+    )
+
+    parser.add_argument(
+        "--insert-size-metrics",
+        help="insert size metrics to use in place of estimating the insert size "
+        + "of each sample from its reads. Either a directory of Picard "
+        + "CollectInsertSizeMetrics or samtools stats output files, named for "
+        + "the sample up to the first dot, or a table with the sample, mean and "
+        + "standard deviation of the insert size on each line",
+        type=str,
+    )
+
+    parser.add_argument(
+        "--rebuild-insert-size-cache",
+        help="estimate the insert sizes of the alignment files again "
+        + "and replace their cached values",
+        action="store_true",
+        default=False,
+    )
+
     parser.add_argument(
         "--min-map-qual", help="minimum map quality for reads", type=int, default=1
     )
@@ -217,7 +258,8 @@ def setup_args():
 
     parser.add_argument(
         "--max-reads",
-        help="maximum number of reads to collect for phasing a single variant",
+        help="maximum read depth to sample at a variant and at each of the "
+        + "heterozygous sites used to extend its phasing",
         type=int,
         default=100,
     )
@@ -225,8 +267,72 @@ def setup_args():
     return parser
 
 
+def setup_prepare_sites_args():
+    parser = argparse.ArgumentParser(
+        prog="unfazed prepare-sites",
+        description="find the informative sites of every trio in the ped file once "
+        + "and store them for reuse. The store can be passed to unfazed with "
+        + "--sites in place of the sites VCF/BCF, using the same quality options",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-s",
+        "--sites",
+        help="sorted/bgzipped/indexed VCF/BCF file of SNVs to identify "
+        + "informative sites",
+        required=True,
+    )
+    parser.add_argument(
+        "-p",
+        "--ped",
+        help="ped file including the kid and both parent IDs for each trio",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-o",
+        "--store",
+        help="directory to write the informative sites store to",
+        type=str,
+        required=True,
+    )
+    parser.add_argument(
+        "-q",
+        "--quiet",
+        help="no logging of site processing data",
+        action="store_true",
+    )
+    add_site_filter_args(parser)
+    return parser
+
+
+def setup_insert_sizes_args():
+    parser = argparse.ArgumentParser(
+        prog="unfazed insert-sizes",
+        description="show the concordant insert sizes in the cache, and whether "
+        + "each alignment file has changed since its insert size was estimated",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "-c",
+        "--insert-size-cache",
+        help="insert size cache directory",
+        type=str,
+        default=get_default_cache_dir(),
+    )
+    return parser
+
+
 def main():
     print("\nUNFAZED v{}".format(__version__), file=sys.stderr)
+    if len(sys.argv) > 1 and sys.argv[1] == "prepare-sites":
+        parser = setup_prepare_sites_args()
+        prepare_sites(parser.parse_args(sys.argv[2:]))
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == "insert-sizes":
+        parser = setup_insert_sizes_args()
+        insert_size_stats(parser.parse_args(sys.argv[2:]))
+        return
     parser = setup_args()
     args = parser.parse_args()
     print("Genome Build: {}\n".format(args.build), file=sys.stderr)
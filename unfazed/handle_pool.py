@@ -0,0 +1,89 @@
+#!/usr/bin/env python
+"""
+pools of open alignment and VCF files, so that variants from the same files reuse
+their handles instead of reading their indexes, headers, and CRAM references
+again. each thread has its own pool, since a handle can't be read by two threads
+at once, and a full pool closes its least recently used handle
+"""
+
+from __future__ import print_function
+
+import sys
+from collections import OrderedDict
+from threading import Lock, local
+
+import pysam
+from cyvcf2 import VCF
+
+# set by set_handle_pool_size
+MAX_HANDLES = 16
+thread_pools = local()
+# every thread's pool, so they can all be closed at the end of the run
+all_pools = []
+pools_lock = Lock()
+
+
+def set_handle_pool_size(max_handles):
+    global MAX_HANDLES
+    MAX_HANDLES = max(max_handles, 1)
+
+
+def get_thread_pool():
+    if not hasattr(thread_pools, "handles"):
+        thread_pools.handles = OrderedDict()
+        with pools_lock:
+            all_pools.append(thread_pools.handles)
+    return thread_pools.handles
+
+
+def get_pooled_handle(key):
+    """
+    the handle for key from this thread's pool, or None if it isn't open
+    """
+    handles = get_thread_pool()
+    if key not in handles:
+        return None
+    handles.move_to_end(key)
+    return handles[key]
+
+
+def add_pooled_handle(key, handle):
+    handles = get_thread_pool()
+    handles[key] = handle
+    while len(handles) > MAX_HANDLES:
+        handles.popitem(last=False)[1].close()
+    return handle
+
+
+def get_alignment_file(bam_name, cram_ref):
+    key = ("alignment", bam_name, cram_ref)
+    bamfile = get_pooled_handle(key)
+    if bamfile is None:
+        if "cram" == bam_name[-4:]:
+            bamfile = pysam.AlignmentFile(bam_name, "rc", reference_filename=cram_ref)
+        else:
+            bamfile = pysam.AlignmentFile(bam_name, "rb")
+        add_pooled_handle(key, bamfile)
+    return bamfile
+
+
+def get_vcf(vcf_name):
+    key = ("vcf", vcf_name, None)
+    vcf = get_pooled_handle(key)
+    if vcf is None:
+        vcf = add_pooled_handle(key, VCF(vcf_name))
+    return vcf
+
+
+def close_handles():
+    """
+    close the handles in every thread's pool
+    """
+    with pools_lock:
+        for handles in all_pools:
+            while len(handles) > 0:
+                handles.popitem(last=False)[1].close()
+
+
+if __name__ == "__main__":
+    sys.exit("Import this as a module")
@@ -1,137 +1,409 @@
 #! /usr/bin/env python
 from __future__ import print_function
 
+import os
 import sys
-from concurrent.futures import ThreadPoolExecutor, wait
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
 
+import numpy as np
 from cyvcf2 import VCF
+
+from .site_store import (
+    ALT_FROM_DAD_FLAG,
+    KID_ALLELE_SHIFTS,
+    STORE_FIELDS,
+    encode_site_flags,
+    find_window_rows,
+    get_family_sites,
+    is_site_store,
+    load_store_block,
+    open_site_store,
+    write_site_store,
+)
 from .utils import *
 
-def get_position(vcf, denovo, extra, whole_region):
-    locs = []
-    loc_template = "{prefix}{chrom}:{start}-{end}"
-    prefix = get_prefix(vcf)
+# records of the sites file classified at once by prepare
+PREPARE_CHUNK_SIZE = 10000
+# find_many chunks of the chromosomes per process,
+# and the fewest bases of search windows worth a chunk
+CHUNKS_PER_THREAD = 4
+MIN_CHUNK_BASES = 100000
+
+
+def get_position_windows(denovo, extra, whole_region):
+    """
+    the closed, 1-based regions of the sites file searched for a denovo by find
+    """
     if whole_region:
-        locs.append(
-            loc_template.format(
-                prefix=prefix,
-                chrom=denovo["chrom"].strip("chr"),
-                start=(int(denovo["start"]) - extra),
-                end=(int(denovo["end"]) + extra),
-            )
-        )
-    else:
-        locs.append(
-            loc_template.format(
-                prefix=prefix,
-                chrom=denovo["chrom"].strip("chr"),
-                start=(int(denovo["start"]) - extra),
-                end=(int(denovo["start"]) + extra),
-            )
-        )
-        if (int(denovo["end"]) - int(denovo["start"])) > extra:
-            locs.append(
-                loc_template.format(
-                    prefix=prefix,
-                    chrom=denovo["chrom"].strip("chr"),
-                    start=(int(denovo["end"]) - extra),
-                    end=(int(denovo["end"]) + extra),
-                )
-            )
-    for loc in locs:
+        return [[int(denovo["start"]) - extra, int(denovo["end"]) + extra]]
+    windows = [[int(denovo["start"]) - extra, int(denovo["start"]) + extra]]
+    if (int(denovo["end"]) - int(denovo["start"])) > extra:
+        windows.append([int(denovo["end"]) - extra, int(denovo["end"]) + extra])
+    return windows
+
+
+def get_position(vcf, chrom, windows):
+    """
+    the records in windows of a contig, named as in the sites file
+    """
+    loc_template = "{chrom}:{start}-{end}"
+    for start, end in windows:
+        loc = loc_template.format(chrom=chrom, start=start, end=end)
         for variant in vcf(loc):
             yield variant
 
 
-def is_high_quality_site(i, ref_depths, alt_depths, genotypes, gt_quals):
+def merge_windows(windows):
     """
-    check if the potential informative site is high quality.
-    this is pretty hacky, but filters out the really cruddy variants.
-    i: index of the parent in the VCF FORMAT field
-    ref_depths: numpy array of reference depths
-    alt_depths: numpy array of alternate depths
-    genotypes: numpy array of genotypes
-    gt_quals: numpy array of genotype qualities
-    """
-    if genotypes[i] == HOM_REF:
-        min_ab, max_ab = MIN_AB_HOMREF, MAX_AB_HOMREF
-    elif genotypes[i] == HOM_ALT:
-        min_ab, max_ab = MIN_AB_HOMALT, MAX_AB_HOMALT
-    elif genotypes[i] == HET:
-        min_ab, max_ab = MIN_AB_HET, MAX_AB_HET
-    else: #gt is unknown
-        return False
-    if gt_quals[i] < MIN_GT_QUAL:
-        return False
-    if (ref_depths[i] + alt_depths[i]) < MIN_DEPTH:
-        return False
+    merge overlapping and adjacent closed, 1-based windows
+    into sorted regions that don't overlap
+    """
+    regions = []
+    for start, end in sorted(windows):
+        start = max(start, 1)
+        if len(regions) > 0 and start <= regions[-1][1] + 1:
+            regions[-1][1] = max(regions[-1][1], end)
+        else:
+            regions.append([start, end])
+    return regions
+
+
+def get_site_searches(search_dist, whole_region, het_sites, cnv_sites):
+    """
+    the searches for informative sites made in one pass over the sites file.
+    each search adds its candidate sites to its own field of the denovos.
+    cnv_sites adds a search of the whole of each denovo, for allele-balance
+    phasing of CNVs, to the search at search_dist
+    """
+    searches = [
+        {
+            "search_dist": search_dist,
+            "whole_region": whole_region,
+            "het_sites": het_sites,
+            "candidate_field": "candidate_sites",
+        }
+    ]
+    if cnv_sites:
+        searches.append(
+            {
+                "search_dist": 0,
+                "whole_region": True,
+                "het_sites": False,
+                "candidate_field": "cnv_candidate_sites",
+            }
+        )
+    return searches
+
+
+def get_search_vartype(denovo, search):
+    return (
+        denovo["vartype"] if search["whole_region"] and ("vartype" in denovo) else None
+    )
+
+
+def open_sites_vcf(vcf_name, pedigrees):
+    """
+    open the sites file so that only the FORMAT columns of the kids
+    and their parents are decoded, instead of every sample in a joint callset.
+    sample indexes must come from the returned handle's samples,
+    which are the trio members in file order
+    """
+    vcf = VCF(vcf_name)
+    trio_samples = set()
+    for kid in pedigrees:
+        trio_samples.update([kid, pedigrees[kid]["dad"], pedigrees[kid]["mom"]])
+    vcf.set_samples([sample for sample in vcf.samples if sample in trio_samples])
+    return vcf
+
+
+def is_complex(variant):
+    return (
+        len(variant.ALT) != 1
+        or (len(variant.REF) > 1)
+        or ("*" in variant.ALT or len(variant.ALT[0]) > 1)
+    )
+
+
+def new_site_stats():
+    """
+    counts of the sites records read, and of those rejected at each stage of decoding
+    """
+    return {"records": 0, "complex": 0, "genotypes": 0, "decoded": 0}
+
+
+def add_site_stats(stats, other_stats):
+    for stage in stats:
+        stats[stage] += other_stats[stage]
+
+
+def print_site_stats(label, stats):
+    print(
+        "{}: {} records read, {} rejected as not biallelic SNVs, ".format(
+            label, stats["records"], stats["complex"]
+        )
+        + "{} rejected on trio genotypes, {} decoded".format(
+            stats["genotypes"], stats["decoded"]
+        ),
+        file=sys.stderr,
+    )
 
-    allele_bal = float(alt_depths[i] / float(ref_depths[i] + alt_depths[i]))
 
-    if min_ab <= allele_bal <= max_ab:
+def usable_genotypes(genotypes, kid_idx, dad_idx, mom_idx, vartype, het_sites):
+    """
+    check from the genotypes alone if a site could be a het or candidate site
+    for a trio, so depths and qualities are only decoded for sites that could be
+    """
+    dad_gt = genotypes[dad_idx]
+    mom_gt = genotypes[mom_idx]
+    # both parents must be high quality, which needs a known genotype
+    if dad_gt == GT_UNKNOWN or mom_gt == GT_UNKNOWN:
+        return False
+    kid_gt = genotypes[kid_idx]
+    if het_sites and kid_gt == HET:
         return True
+    # candidate sites need one parent to have an allele the other doesn't
+    if dad_gt == mom_gt:
+        return False
+    if vartype == "DEL":
+        return kid_gt == HOM_REF or kid_gt == HOM_ALT
+    if vartype is None or vartype == "DUP":
+        return kid_gt == HET
     return False
 
 
-def get_kid_allele(
-    denovo, genotypes, ref_depths, alt_depths, kid_idx, dad_idx, mom_idx
-):
-    kid_allele = None
-    if (denovo["vartype"] == "DEL") and (ref_depths[kid_idx] + alt_depths[kid_idx]) > 4:
-        # large deletions can be genotyped by hemizygous inheritance of informative alleles
-        if genotypes[kid_idx] == HOM_ALT:
-            kid_allele = "ref_parent"
-        elif genotypes[kid_idx] == HOM_REF:
-            kid_allele = "alt_parent"
+def load_sites_block(variants, sample_count, usable=None):
+    """
+    pull the biallelic SNVs from an iterable of sites records into columns.
+    genotypes, depths, and genotype qualities are 2D numpy arrays
+    with a row per record and a column per sample in the (subset) VCF.
+    records are decoded in stages: if a usable function of the 0-based position
+    and genotypes is given, depths and qualities are only decoded for
+    the records it accepts, and the rest are left out of the block
+    """
+    block = {
+        "chrom": None,
+        "pos": [],
+        "ref": [],
+        "alt": [],
+        "genotypes": [],
+        "ref_depths": [],
+        "alt_depths": [],
+        "gt_quals": [],
+        "stats": new_site_stats(),
+    }
+    for variant in variants:
+        block["stats"]["records"] += 1
+        # ignore more complex variants for now
+        if is_complex(variant):
+            block["stats"]["complex"] += 1
+            continue
+        # cyvcf2 reuses the buffers behind these arrays between records
+        genotypes = variant.gt_types.copy()
+        if usable is not None and not usable(variant.start, genotypes):
+            block["stats"]["genotypes"] += 1
+            continue
+        block["stats"]["decoded"] += 1
+        block["chrom"] = variant.CHROM
+        block["pos"].append(variant.start)
+        block["ref"].append(variant.REF)
+        block["alt"].append(variant.ALT[0])
+        block["genotypes"].append(genotypes)
+        block["ref_depths"].append(variant.gt_ref_depths.copy())
+        block["alt_depths"].append(variant.gt_alt_depths.copy())
+        block["gt_quals"].append(variant.gt_quals.copy())
+
+    block["pos"] = np.array(block["pos"], dtype=np.int64)
+    for field in ["genotypes", "ref_depths", "alt_depths", "gt_quals"]:
+        if len(block[field]) > 0:
+            block[field] = np.vstack(block[field])
         else:
-            # het kid, variant unusable
-            return
-    elif (
-        (denovo["vartype"] == "DUP")
-        and (ref_depths[kid_idx] > 2)
-        and (alt_depths[kid_idx] > 2)
-        and (ref_depths[kid_idx] + alt_depths[kid_idx]) > MIN_DEPTH
-    ):
+            block[field] = np.zeros((0, sample_count))
+    return block
+
+
+def high_quality_sites(block):
+    """
+    check if the potential informative sites are high quality for each sample.
+    this is pretty hacky, but filters out the really cruddy variants.
+    returns a boolean array with the same shape as the block's genotypes
+    """
+    genotypes = block["genotypes"]
+    ref_depths = block["ref_depths"]
+    alt_depths = block["alt_depths"]
+
+    min_ab = np.zeros(genotypes.shape)
+    max_ab = np.zeros(genotypes.shape)
+    for gt, gt_min_ab, gt_max_ab in [
+        (HOM_REF, MIN_AB_HOMREF, MAX_AB_HOMREF),
+        (HOM_ALT, MIN_AB_HOMALT, MAX_AB_HOMALT),
+        (HET, MIN_AB_HET, MAX_AB_HET),
+    ]:
+        min_ab[genotypes == gt] = gt_min_ab
+        max_ab[genotypes == gt] = gt_max_ab
+
+    depths = ref_depths + alt_depths
+    with np.errstate(divide="ignore", invalid="ignore"):
+        allele_bal = alt_depths / depths.astype(np.float64)
+    return (
+        np.isin(genotypes, [HOM_REF, HOM_ALT, HET])  # gt is known
+        & ~(block["gt_quals"] < MIN_GT_QUAL)
+        & (depths >= MIN_DEPTH)
+        & (min_ab <= allele_bal)
+        & (allele_bal <= max_ab)
+    )
+
+
+def get_kid_alleles(block, vartype, kid_idx, dad_idx, mom_idx):
+    """
+    the parent (ref_parent or alt_parent) whose allele the kid carries
+    at each site inside a CNV, or None where the site is unusable
+    """
+    genotypes = block["genotypes"]
+    ref_depths = block["ref_depths"]
+    alt_depths = block["alt_depths"]
+    kid_depths = ref_depths[:, kid_idx] + alt_depths[:, kid_idx]
+    kid_gts = genotypes[:, kid_idx]
+    kid_alleles = np.full(len(genotypes), None, dtype=object)
+    if vartype == "DEL":
+        # large deletions can be genotyped by hemizygous inheritance of informative alleles
+        # (a het kid leaves the variant unusable)
+        kid_alleles[(kid_depths > 4) & (kid_gts == HOM_ALT)] = "ref_parent"
+        kid_alleles[(kid_depths > 4) & (kid_gts == HOM_REF)] = "alt_parent"
+    elif vartype == "DUP":
         # large duplications can be genotyped by unbalanced het inheritance
         # of informative alleles if there's enough depth
-        if genotypes[kid_idx] == HET:
-            kid_alt_allele_bal = alt_depths[kid_idx] / float(
-                ref_depths[kid_idx] + alt_depths[kid_idx]
-            )
-            dad_alt_allele_bal = alt_depths[dad_idx] / float(
-                ref_depths[dad_idx] + alt_depths[dad_idx]
-            )
-            mom_alt_allele_bal = alt_depths[mom_idx] / float(
-                ref_depths[mom_idx] + alt_depths[mom_idx]
+        usable = (
+            (ref_depths[:, kid_idx] > 2)
+            & (alt_depths[:, kid_idx] > 2)
+            & (kid_depths > MIN_DEPTH)
+            & (kid_gts == HET)
+        )
+        with np.errstate(divide="ignore", invalid="ignore"):
+            kid_alt_allele_bal = alt_depths[:, kid_idx] / kid_depths.astype(np.float64)
+            dad_alt_allele_bal = alt_depths[:, dad_idx] / (
+                ref_depths[:, dad_idx] + alt_depths[:, dad_idx]
+            ).astype(np.float64)
+            mom_alt_allele_bal = alt_depths[:, mom_idx] / (
+                ref_depths[:, mom_idx] + alt_depths[:, mom_idx]
+            ).astype(np.float64)
+        # DUPs can't be phased this way if the parental shared allele is duplicated, though
+        # in first case, the dominate allele is alt and alt is duplicated, which is unphaseable
+        # in second case, the dominate allele is ref and ref is duplicated, which is unphaseable
+        parent_alt_allele_bal = dad_alt_allele_bal + mom_alt_allele_bal
+        usable &= ~(
+            ((parent_alt_allele_bal < 1) & (kid_alt_allele_bal > 0.5))
+            | ((parent_alt_allele_bal > 1) & (kid_alt_allele_bal < 0.5))
+        )
+        # allele balance must be at least 2:1 for the dominant allele,
+        # balanced alleles are unusable
+        kid_alleles[usable & (kid_alt_allele_bal >= 0.67)] = "alt_parent"
+        kid_alleles[usable & (kid_alt_allele_bal <= 0.33)] = "ref_parent"
+    # otherwise not a CNV, or not enough depth
+    return kid_alleles
+
+
+def classify_trio_sites(block, high_quality, kid_idx, dad_idx, mom_idx, vartype):
+    """
+    find which sites in the block are usable for a trio.
+    het: the kid is HET and both parents are high quality,
+    usable for extended read-backed phasing
+    candidate: the site is informative for the parent of origin
+    alt_from_dad: the dad is the alt_parent of a candidate site (otherwise the mom)
+    kid_allele: only set if vartype is given, the parent of the kid allele inside a CNV
+    """
+    genotypes = block["genotypes"]
+    kid_gts = genotypes[:, kid_idx]
+    dad_gts = genotypes[:, dad_idx]
+    mom_gts = genotypes[:, mom_idx]
+    parents_high_quality = high_quality[:, dad_idx] & high_quality[:, mom_idx]
+
+    trio_sites = {"het": (kid_gts == HET) & parents_high_quality}
+    if vartype is not None:
+        trio_sites["kid_allele"] = get_kid_alleles(
+            block, vartype, kid_idx, dad_idx, mom_idx
+        )
+        candidate = trio_sites["kid_allele"].astype(bool)
+    else:
+        candidate = (kid_gts == HET) & high_quality[:, kid_idx]
+    candidate &= parents_high_quality
+
+    dad_alt = np.isin(dad_gts, [HET, HOM_ALT]) & (mom_gts == HOM_REF)
+    mom_alt = np.isin(mom_gts, [HET, HOM_ALT]) & (dad_gts == HOM_REF)
+    dad_hom_alt = (mom_gts == HET) & (dad_gts == HOM_ALT)
+    mom_hom_alt = (dad_gts == HET) & (mom_gts == HOM_ALT)
+    candidate &= dad_alt | mom_alt | dad_hom_alt | mom_hom_alt
+    trio_sites["alt_from_dad"] = dad_alt | (~mom_alt & dad_hom_alt)
+
+    # if kid is hemizygous we need to make sure the inherited allele is not shared
+    # by both parents. if one parent is het and the other is homozygous for either allele
+    # make sure the kid doesn't have that allele
+    homs = [HOM_ALT, HOM_REF]
+    dad_hom = np.isin(dad_gts, homs)
+    mom_hom = np.isin(mom_gts, homs)
+    shared_allele = (
+        np.isin(kid_gts, homs)
+        & ((dad_gts == HET) | (mom_gts == HET))
+        & (dad_hom | mom_hom)
+        & ((dad_hom & (dad_gts == kid_gts)) | (mom_hom & (mom_gts == kid_gts)))
+    )
+    trio_sites["candidate"] = candidate & ~shared_allele
+    return trio_sites
+
+
+def add_block_sites(
+    denovo,
+    block,
+    rows,
+    trio_sites,
+    dad,
+    mom,
+    het_sites=True,
+    candidate_field="candidate_sites",
+):
+    """
+    append the het and candidate sites in the given block rows to the denovo.
+    het sites are only needed for extended read-backed phasing
+    """
+    if not het_sites and "het_sites" not in denovo:
+        denovo["het_sites"] = []
+    for row in rows:
+        pos = int(block["pos"][row])
+        # if this is a small event (SNV or INDEL), ignore candidate sites in the variant
+        if ((denovo["end"] - denovo["start"]) < 20) and (
+            pos in range(denovo["start"], denovo["end"])
+        ):
+            continue
+        if het_sites and trio_sites["het"][row]:
+            if "het_sites" not in denovo:
+                denovo["het_sites"] = []
+            # variant usable for extended read-backed phasing
+            denovo["het_sites"].append(
+                {
+                    "pos": pos,
+                    "ref_allele": block["ref"][row],
+                    "alt_allele": block["alt"][row],
+                }
             )
-            # DUPs can't be phased this way if the parental shared allele is duplicated, though
-            # in first case, the dominate allele is alt and alt is duplicated, which is unphaseable
-            # in second case, the dominate allele is ref and ref is duplicated, which is unphaseable
-            if (
-                ((dad_alt_allele_bal + mom_alt_allele_bal) < 1)
-                and (kid_alt_allele_bal > 0.5)
-                or ((dad_alt_allele_bal + mom_alt_allele_bal) > 1)
-                and (kid_alt_allele_bal < 0.5)
-            ):
-                return
-
-            # allele balance must be at least 2:1 for the dominant allele
-            if kid_alt_allele_bal >= 0.67:
-                # this variant came from the alt parent
-                kid_allele = "alt_parent"
-            elif kid_alt_allele_bal <= 0.33:
-                # this variant came from the ref parent
-                kid_allele = "ref_parent"
-            else:
-                # balanced allele, variant unusable
-                return
+        if not trio_sites["candidate"][row]:
+            continue
+        candidate = {
+            "pos": pos,
+            "ref_allele": block["ref"][row],
+            "alt_allele": block["alt"][row],
+        }
+        if "kid_allele" in trio_sites:
+            candidate["kid_allele"] = trio_sites["kid_allele"][row]
+        if trio_sites["alt_from_dad"][row]:
+            candidate["alt_parent"] = dad
+            candidate["ref_parent"] = mom
         else:
-            # homozygous kid, variant unusable
-            return
-    else:
-        # not a CNV, or not enough depth
-        return
-    return kid_allele
+            candidate["alt_parent"] = mom
+            candidate["ref_parent"] = dad
+        if candidate_field not in denovo:
+            denovo[candidate_field] = []
+        denovo[candidate_field].append(candidate)
 
 
 def autophaseable(denovo, pedigrees, build):
@@ -179,39 +451,83 @@ def find(
     min_gt_qual,
     min_depth,
     whole_region=True,
+    het_sites=True,
+    cnv_sites=False,
 ):
     """
     Given list of denovo variant positions
-    a vcf_name, and the distance upstream or downstream to search, find informative sites
+    a vcf_name, and the distance upstream or downstream to search, find informative sites.
+    vcf_name can also be a sites store written by `unfazed prepare-sites`.
+    het sites for extended read-backed phasing are only found if het_sites is set.
+    if cnv_sites is set, the candidate sites across the whole of each denovo
+    are found in the same pass, as cnv_candidate_sites
     """
-    global QUIET_MODE
-    QUIET_MODE = quiet_mode
-    global MIN_AB_HET
-    MIN_AB_HET = ab_het[0]
-    global MIN_AB_HOMREF
-    MIN_AB_HOMREF = ab_homref[0]
-    global MIN_AB_HOMALT
-    MIN_AB_HOMALT = ab_homalt[0]
-    global MAX_AB_HET
-    MAX_AB_HET = ab_het[1]
-    global MAX_AB_HOMREF
-    MAX_AB_HOMREF = ab_homref[1]
-    global MAX_AB_HOMALT
-    MAX_AB_HOMALT = ab_homalt[1]
-    global MIN_GT_QUAL
-    MIN_GT_QUAL = min_gt_qual
-    global MIN_DEPTH
-    MIN_DEPTH = min_depth
+    set_site_filters(quiet_mode, ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth)
+    searches = get_site_searches(search_dist, whole_region, het_sites, cnv_sites)
+    store = None
+    if is_site_store(vcf_name):
+        store = open_site_store(
+            vcf_name,
+            get_site_filters(ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth),
+        )
 
     if len(dnms) >= multithread_proc_min:
-        return find_many(
-            dnms, pedigrees, vcf_name, search_dist, threads, build, whole_region
-        )
+        return find_many(dnms, pedigrees, vcf_name, searches, threads, build, store)
     elif len(dnms) <= 0:
         return
 
-    vcf = VCF(vcf_name)
-    sample_dict = dict(zip(vcf.samples, range(len(vcf.samples))))
+    if store is not None or threads == 1:
+        dnms, site_stats = find_batch(dnms, pedigrees, vcf_name, searches, build, store)
+    else:
+        # split the denovos into contiguous batches for a bounded pool of processes,
+        # each with its own handle of the sites file.
+        # several batches per process keep a slow batch from holding up the rest
+        batch_size = -(-len(dnms) // (threads * CHUNKS_PER_THREAD))
+        site_filters = get_site_filters(
+            ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth
+        )
+        with ProcessPoolExecutor(threads) as executor:
+            futures = []
+            for batch_start in range(0, len(dnms), batch_size):
+                futures.append(
+                    executor.submit(
+                        find_batch_sites,
+                        dnms[batch_start : batch_start + batch_size],
+                        pedigrees,
+                        vcf_name,
+                        searches,
+                        build,
+                        quiet_mode,
+                        site_filters,
+                    )
+                )
+            # batches are put back in submission order, the same order as the input
+            dnms = []
+            site_stats = new_site_stats()
+            for future in futures:
+                batch_dnms, batch_site_stats = future.result()
+                dnms += batch_dnms
+                add_site_stats(site_stats, batch_site_stats)
+    if store is None and not QUIET_MODE:
+        print_site_stats("Sites records", site_stats)
+    return dnms
+
+
+def find_batch(dnms, pedigrees, vcf_name, searches, build, store):
+    """
+    find the informative sites for each denovo in turn, from one handle of the
+    sites file or from a sites store. the windows of all of the searches are
+    read from the sites file at once. returns the denovos and the counts of
+    sites records read and rejected
+    """
+    site_stats = new_site_stats()
+    if store is None:
+        vcf = open_sites_vcf(vcf_name, pedigrees)
+        aliases = get_vcf_contig_aliases(vcf_name, vcf)
+        sample_dict = dict(zip(vcf.samples, range(len(vcf.samples))))
+    else:
+        aliases = store["aliases"]
+        sample_dict = dict(zip(store["samples"], range(len(store["samples"]))))
     for i, denovo in enumerate(dnms):
         if autophaseable(denovo, pedigrees, build):
             continue
@@ -230,128 +546,139 @@ def find(
         kid_idx = sample_dict[kid_id]
         dad_idx = sample_dict[dad_id]
         mom_idx = sample_dict[mom_id]
-
-        candidate_sites = []
-        het_sites = []
-        # loop over all variants in the VCF within search_dist bases from the DNM
-        for variant in get_position(vcf, denovo, search_dist, whole_region):
-            # ignore more complex variants for now
-            if (
-                len(variant.ALT) != 1
-                or (len(variant.REF) > 1)
-                or ("*" in variant.ALT or len(variant.ALT[0]) > 1)
-            ):
+        search_windows = [
+            get_position_windows(denovo, search["search_dist"], search["whole_region"])
+            for search in searches
+        ]
+
+        if store is None:
+            # loop over all variants in the VCF within search_dist bases from the DNM
+            block = load_sites_block(
+                get_position(
+                    vcf,
+                    resolve_contig(aliases, denovo["chrom"]),
+                    merge_windows(sum(search_windows, [])),
+                ),
+                len(vcf.samples),
+                lambda pos, genotypes: any(
+                    usable_genotypes(
+                        genotypes,
+                        kid_idx,
+                        dad_idx,
+                        mom_idx,
+                        get_search_vartype(denovo, search),
+                        search["het_sites"],
+                    )
+                    for search in searches
+                ),
+            )
+            add_site_stats(site_stats, block["stats"])
+            high_quality = high_quality_sites(block)
+            trio_sites_cache = {}
+        else:
+            family_sites = get_family_sites(
+                store,
+                kid_id,
+                dad_id,
+                mom_id,
+                resolve_contig(aliases, denovo["chrom"]),
+            )
+            if family_sites is None:
+                if not QUIET_MODE:
+                    print("{} missing from sites store".format(kid_id), file=sys.stderr)
                 continue
 
+        denovo["het_sites"] = []
+        for search, windows in zip(searches, search_windows):
+            vartype = get_search_vartype(denovo, search)
+            if store is None:
+                if vartype not in trio_sites_cache:
+                    trio_sites_cache[vartype] = classify_trio_sites(
+                        block, high_quality, kid_idx, dad_idx, mom_idx, vartype
+                    )
+                search_block = block
+                trio_sites = trio_sites_cache[vartype]
+                # a site can be in both breakpoint windows of a search
+                rows = find_window_rows(block, windows)
+            else:
+                search_block, trio_sites = load_store_block(
+                    family_sites, find_window_rows(family_sites, windows), vartype
+                )
+                rows = range(len(search_block["pos"]))
             # male chrX variants have to come from mom
-            if variant.CHROM == "X" and (
+            if search_block["chrom"] == "X" and (
                 pedigrees[denovo["kid"]]["sex"] == SEX_KEY["male"]
             ):
-                continue
+                rows = []
+            denovo[search["candidate_field"]] = []
+            add_block_sites(
+                denovo,
+                search_block,
+                rows,
+                trio_sites,
+                dad_id,
+                mom_id,
+                search["het_sites"],
+                search["candidate_field"],
+            )
+            denovo[search["candidate_field"]] = sorted(
+                denovo[search["candidate_field"]], key=lambda x: x["pos"]
+            )
+        denovo["het_sites"] = sorted(denovo["het_sites"], key=lambda x: x["pos"])
+        dnms[i] = denovo
+    return dnms, site_stats
 
-            # if this is a small event (SNV or INDEL), ignore candidate sites in the variant
-            if ((denovo["end"] - denovo["start"]) < 20) and (
-                variant.start in range(denovo["start"], denovo["end"])
-            ):
-                continue
-            genotypes = variant.gt_types
-            ref_depths = variant.gt_ref_depths
-            alt_depths = variant.gt_alt_depths
-            gt_quals = variant.gt_quals
-
-            candidate = {
-                "pos": variant.start,
-                "ref_allele": variant.REF,
-                "alt_allele": variant.ALT[0],
-            }
 
-            if (
-                (genotypes[kid_idx] == HET)
-                and is_high_quality_site(
-                    dad_idx, ref_depths, alt_depths, genotypes, gt_quals
-                )
-                and is_high_quality_site(
-                    mom_idx, ref_depths, alt_depths, genotypes, gt_quals
-                )
-            ):
-                # variant usable for extended read-backed phasing
-                het_sites.append(
-                    {
-                        "pos": variant.start,
-                        "ref_allele": variant.REF,
-                        "alt_allele": variant.ALT[0],
-                    }
-                )
+def find_batch_sites(
+    dnms, pedigrees, vcf_name, searches, build, quiet_mode, site_filters
+):
+    """
+    process pool worker for find, finds the sites for a batch of denovos
+    """
+    set_site_filters(quiet_mode, **site_filters)
+    return find_batch(dnms, pedigrees, vcf_name, searches, build, None)
 
-            if whole_region and ("vartype" in denovo):
-                candidate["kid_allele"] = get_kid_allele(
-                    denovo, genotypes, ref_depths, alt_depths, kid_idx, dad_idx, mom_idx
-                )
-                if not candidate["kid_allele"]:
-                    continue
-            elif genotypes[kid_idx] != HET or not is_high_quality_site(
-                kid_idx, ref_depths, alt_depths, genotypes, gt_quals
-            ):
-                continue
 
-            if not (
-                is_high_quality_site(
-                    dad_idx, ref_depths, alt_depths, genotypes, gt_quals
-                )
-                and is_high_quality_site(
-                    mom_idx, ref_depths, alt_depths, genotypes, gt_quals
-                )
-            ):
-                continue
+def set_site_filters(quiet_mode, ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth):
+    global QUIET_MODE
+    QUIET_MODE = quiet_mode
+    global MIN_AB_HET
+    MIN_AB_HET = ab_het[0]
+    global MIN_AB_HOMREF
+    MIN_AB_HOMREF = ab_homref[0]
+    global MIN_AB_HOMALT
+    MIN_AB_HOMALT = ab_homalt[0]
+    global MAX_AB_HET
+    MAX_AB_HET = ab_het[1]
+    global MAX_AB_HOMREF
+    MAX_AB_HOMREF = ab_homref[1]
+    global MAX_AB_HOMALT
+    MAX_AB_HOMALT = ab_homalt[1]
+    global MIN_GT_QUAL
+    MIN_GT_QUAL = min_gt_qual
+    global MIN_DEPTH
+    MIN_DEPTH = min_depth
 
-            if genotypes[dad_idx] in (HET, HOM_ALT) and genotypes[mom_idx] == HOM_REF:
-                candidate["alt_parent"] = pedigrees[denovo["kid"]]["dad"]
-                candidate["ref_parent"] = pedigrees[denovo["kid"]]["mom"]
-            elif genotypes[mom_idx] in (HET, HOM_ALT) and genotypes[dad_idx] == HOM_REF:
-                candidate["alt_parent"] = pedigrees[denovo["kid"]]["mom"]
-                candidate["ref_parent"] = pedigrees[denovo["kid"]]["dad"]
-            elif genotypes[mom_idx] == HET and genotypes[dad_idx] == HOM_ALT:
-                candidate["alt_parent"] = pedigrees[denovo["kid"]]["dad"]
-                candidate["ref_parent"] = pedigrees[denovo["kid"]]["mom"]
-            elif genotypes[dad_idx] == HET and genotypes[mom_idx] == HOM_ALT:
-                candidate["alt_parent"] = pedigrees[denovo["kid"]]["mom"]
-                candidate["ref_parent"] = pedigrees[denovo["kid"]]["dad"]
-            else:
-                continue
 
-            # if kid is hemizygous we need to make sure the inherited allele is not shared
-            # by both parents
-            if genotypes[kid_idx] in [HOM_ALT, HOM_REF]:
-                unique_allele = True
-                # if one parent is het and the other is homozygous for either allele
-                # make sure the kid doesn't have that allele
-                parent_gts = [genotypes[dad_idx], genotypes[mom_idx]]
-                if (HET in parent_gts) and (
-                    HOM_ALT in parent_gts or HOM_REF in parent_gts
-                ):
-                    for parent_gt in parent_gts:
-                        kid_gt = genotypes[kid_idx]
-                        if (parent_gt in [HOM_ALT, HOM_REF]) and (kid_gt == parent_gt):
-                            unique_allele = False
-                if not unique_allele:
-                    continue
-
-            candidate_sites.append(candidate)
-
-        denovo["candidate_sites"] = sorted(candidate_sites, key=lambda x: x["pos"])
-        denovo["het_sites"] = sorted(het_sites, key=lambda x: x["pos"])
-        dnms[i] = denovo
-    return dnms
+def get_site_filters(ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth):
+    """
+    the options that change which sites are informative, as recorded in a sites store
+    """
+    return {
+        "ab_homref": list(ab_homref),
+        "ab_homalt": list(ab_homalt),
+        "ab_het": list(ab_het),
+        "min_gt_qual": min_gt_qual,
+        "min_depth": min_depth,
+    }
 
 
-def create_lookups(dnms, pedigrees, build):
+def create_lookups(dnms, pedigrees, build, search_dist, whole_region):
     """
     this will be a lookup to find samples for a range where
     variants are informative for a given denovo
     """
-    samples_by_location = {}
     vars_by_sample = {}
-    chrom_ranges = {}
     dnms_autophase = []
     dnms_nonautophase = []
     for denovo in dnms:
@@ -362,18 +689,8 @@ def create_lookups(dnms, pedigrees, build):
 
         chrom = denovo["chrom"]
         start = int(denovo["start"])
-        end = int(denovo["end"])
         sample = denovo["kid"]
 
-        # find the range within the chromosome where we need data
-        if chrom not in chrom_ranges:
-            chrom_ranges[chrom] = [start, end]
-        if start < chrom_ranges[chrom][0]:
-            chrom_ranges[chrom][0] = start
-        if end > chrom_ranges[chrom][1]:
-            chrom_ranges[chrom][1] = end
-
-
         if sample not in vars_by_sample:
             vars_by_sample[sample] = {}
         if chrom not in vars_by_sample[sample]:
@@ -382,44 +699,127 @@ def create_lookups(dnms, pedigrees, build):
             vars_by_sample[sample][chrom][start] = []
         vars_by_sample[sample][chrom][start].append(denovo)
 
-        if chrom not in samples_by_location:
-            samples_by_location[chrom] = {}
+    window_index = create_window_index(vars_by_sample, search_dist, whole_region)
+    return window_index, vars_by_sample, dnms_autophase, dnms_nonautophase
 
-        if start not in samples_by_location[chrom]:
-            samples_by_location[chrom][start] = []
-        samples_by_location[chrom][start].append(sample)
 
-        if (end - start) > 2:
-            if end not in samples_by_location[chrom] and ((end - start) > 2):
-                samples_by_location[chrom][end] = []
-            samples_by_location[chrom][end].append(sample)
-    return samples_by_location, vars_by_sample, chrom_ranges, dnms_autophase, dnms_nonautophase
+def get_search_windows(denovo, search_dist, whole_region):
+    """
+    the closed intervals around a denovo where variants are informative for it
+    """
+    start = int(denovo["start"])
+    end = int(denovo["end"])
+    if whole_region:
+        return [[start - search_dist, end + search_dist]]
+    windows = [[start - search_dist, start + search_dist]]
+    if (end - start) > 2:
+        windows.append([end - search_dist, end + search_dist])
+    return windows
 
 
-def get_close_vars(
-    chrom, pos, samples_by_location, vars_by_sample, search_dist, whole_region
-):
+def create_window_index(vars_by_sample, search_dist, whole_region):
+    """
+    index the search windows of every denovo by chromosome.
+    windows are binned by the bit length of their size and each bin is kept
+    sorted by window start, so a position can be matched to the windows that
+    contain it with a pair of binary searches per bin
+    """
+    windows_by_chrom = {}
+    for sample in vars_by_sample:
+        for chrom in vars_by_sample[sample]:
+            if chrom not in windows_by_chrom:
+                windows_by_chrom[chrom] = {}
+            for start in vars_by_sample[sample][chrom]:
+                for denovo in vars_by_sample[sample][chrom][start]:
+                    for window in get_search_windows(denovo, search_dist, whole_region):
+                        size_bin = (window[1] - window[0]).bit_length()
+                        if size_bin not in windows_by_chrom[chrom]:
+                            windows_by_chrom[chrom][size_bin] = []
+                        windows_by_chrom[chrom][size_bin].append(
+                            [window[0], window[1], [sample, chrom, start]]
+                        )
+
+    window_index = {}
+    for chrom in windows_by_chrom:
+        window_index[chrom] = []
+        for size_bin in sorted(windows_by_chrom[chrom]):
+            windows = sorted(windows_by_chrom[chrom][size_bin], key=lambda x: x[0])
+            window_index[chrom].append(
+                {
+                    "starts": [w[0] for w in windows],
+                    "ends": [w[1] for w in windows],
+                    "keys": [w[2] for w in windows],
+                    "max_len": max(w[1] - w[0] for w in windows),
+                }
+            )
+    return window_index
+
+
+def get_window_indexes(vars_by_sample, searches):
+    return [
+        create_window_index(
+            vars_by_sample, search["search_dist"], search["whole_region"]
+        )
+        for search in searches
+    ]
+
+
+def get_close_vars(chrom, pos, window_index):
+    """
+    find the keys of the denovos whose search windows contain pos
+    """
     close_var_keys = []
-    if chrom not in samples_by_location:
+    if chrom not in window_index:
         return close_var_keys
-    if not whole_region:
-        for dn_loc in samples_by_location[chrom]:
-            if (dn_loc - search_dist) <= pos <= (dn_loc + search_dist):
-                close_samples = samples_by_location[chrom][dn_loc]
-                for close_sample in close_samples:
-                    close_var_keys.append([close_sample, chrom, dn_loc])
-    else:
-        for dn_loc in samples_by_location[chrom]:
-            close_samples = samples_by_location[chrom][dn_loc]
-            for close_sample in close_samples:
-                for denovo in vars_by_sample[close_sample][chrom][dn_loc]:
-                    dn_start = int(denovo["start"])
-                    dn_end = int(denovo["end"])
-                    if (dn_start - search_dist) <= pos <= (dn_end + search_dist):
-                        close_var_keys.append([close_sample, chrom, dn_start])
+    for windows in window_index[chrom]:
+        first = bisect_left(windows["starts"], pos - windows["max_len"])
+        last = bisect_right(windows["starts"], pos)
+        for i in range(first, last):
+            if pos <= windows["ends"][i]:
+                # both breakpoint windows of a denovo can contain the same position
+                if windows["keys"][i] not in close_var_keys:
+                    close_var_keys.append(windows["keys"][i])
     return close_var_keys
 
 
+def plan_queries(window_indexes, chrom):
+    """
+    merge the overlapping search windows of every search on a chromosome
+    into clusters that can each be read from the sites file with one region query,
+    so the gaps between clusters are never decoded
+    """
+    windows = []
+    for window_index in window_indexes:
+        for windows_bin in window_index[chrom]:
+            windows += zip(windows_bin["starts"], windows_bin["ends"])
+    return merge_windows(windows)
+
+
+def summarize_queries(chrom, clusters, site_stats):
+    """
+    compare the planned queries to a single scan from the first
+    to the last search window on the chromosome. the records in the gaps
+    between queries are never read, so their number is only an estimate
+    """
+    record_count = site_stats["records"]
+    queried_bases = sum(end - start + 1 for start, end in clusters)
+    spanned_bases = clusters[-1][1] - clusters[0][0] + 1
+    skipped_bases = spanned_bases - queried_bases
+    # estimated from the density of the records that were read
+    estimated_skipped_records = int(
+        round(record_count * skipped_bases / float(queried_bases))
+    )
+    return {
+        "chrom": chrom,
+        "queries": len(clusters),
+        "queried_bases": queried_bases,
+        "skipped_bases": skipped_bases,
+        "records": record_count,
+        "estimated_skipped_records": estimated_skipped_records,
+        "site_stats": site_stats,
+    }
+
+
 def get_family_indexes(kid, pedigrees, sample_dict):
     dad_id = pedigrees[kid]["dad"]
     mom_id = pedigrees[kid]["mom"]
@@ -439,8 +839,19 @@ def get_family_indexes(kid, pedigrees, sample_dict):
     return kid_idx, dad_idx, mom_idx
 
 
-def add_good_candidate_variant(
-    variant, vars_by_sample, dn_key, pedigrees, whole_region, sample_dict, build
+def add_good_candidate_sites(
+    block,
+    high_quality,
+    rows,
+    vars_by_sample,
+    dn_key,
+    pedigrees,
+    whole_region,
+    sample_dict,
+    build,
+    trio_sites_cache,
+    het_sites,
+    candidate_field,
 ):
     kid, chrom, pos = dn_key
     kid_idx, dad_idx, mom_idx = get_family_indexes(kid, pedigrees, sample_dict)
@@ -451,215 +862,532 @@ def add_good_candidate_variant(
     if pos not in vars_by_sample[kid][chrom]:
         return False
 
-    for i, denovo in enumerate(vars_by_sample[kid][chrom][pos]):
+    for denovo in vars_by_sample[kid][chrom][pos]:
         if autophaseable(denovo, pedigrees, build):
             continue
-        # if this is a small event (SNV or INDEL), ignore candidate sites in the variant
-        if ((denovo["end"] - denovo["start"]) < 20) and (
-            variant.start in range(denovo["start"], denovo["end"])
-        ):
-            continue
-        genotypes = variant.gt_types
-        ref_depths = variant.gt_ref_depths
-        alt_depths = variant.gt_alt_depths
-        gt_quals = variant.gt_quals
-
-        candidate = {
-            "pos": variant.start,
-            "ref_allele": variant.REF,
-            "alt_allele": variant.ALT[0],
-        }
-        if (
-            (genotypes[kid_idx] == HET)
-            and is_high_quality_site(
-                dad_idx, ref_depths, alt_depths, genotypes, gt_quals
-            )
-            and is_high_quality_site(
-                mom_idx, ref_depths, alt_depths, genotypes, gt_quals
-            )
-        ):
-            if "het_sites" not in vars_by_sample[kid][chrom][pos][i]:
-                vars_by_sample[kid][chrom][pos][i]["het_sites"] = []
-            # variant usable for extended read-backed phasing
-            vars_by_sample[kid][chrom][pos][i]["het_sites"].append(
-                {
-                    "pos": variant.start,
-                    "ref_allele": variant.REF,
-                    "alt_allele": variant.ALT[0],
-                }
+        vartype = denovo["vartype"] if whole_region and ("vartype" in denovo) else None
+        # classify each trio once per block, it's shared by all of the kid's denovos
+        # and all of the searches
+        trio_key = (kid, vartype)
+        if trio_key not in trio_sites_cache:
+            trio_sites_cache[trio_key] = classify_trio_sites(
+                block, high_quality, kid_idx, dad_idx, mom_idx, vartype
             )
+        add_block_sites(
+            denovo,
+            block,
+            rows,
+            trio_sites_cache[trio_key],
+            dad,
+            mom,
+            het_sites,
+            candidate_field,
+        )
+    return True
 
-        if whole_region and ("vartype" in denovo):
-            candidate["kid_allele"] = get_kid_allele(
-                denovo, genotypes, ref_depths, alt_depths, kid_idx, dad_idx, mom_idx
-            )
-            if not candidate["kid_allele"]:
-                continue
-        elif genotypes[kid_idx] != HET or not is_high_quality_site(
-            kid_idx, ref_depths, alt_depths, genotypes, gt_quals
-        ):
-            continue
-
-        if not (
-            is_high_quality_site(dad_idx, ref_depths, alt_depths, genotypes, gt_quals)
-            and is_high_quality_site(
-                mom_idx, ref_depths, alt_depths, genotypes, gt_quals
-            )
-        ):
-            continue
 
-        if genotypes[dad_idx] in (HET, HOM_ALT) and genotypes[mom_idx] == HOM_REF:
-            candidate["alt_parent"] = dad
-            candidate["ref_parent"] = mom
-        elif genotypes[mom_idx] in (HET, HOM_ALT) and genotypes[dad_idx] == HOM_REF:
-            candidate["alt_parent"] = mom
-            candidate["ref_parent"] = dad
-        elif genotypes[mom_idx] == HET and genotypes[dad_idx] == HOM_ALT:
-            candidate["alt_parent"] = dad
-            candidate["ref_parent"] = mom
-        elif genotypes[dad_idx] == HET and genotypes[mom_idx] == HOM_ALT:
-            candidate["alt_parent"] = mom
-            candidate["ref_parent"] = dad
-        else:
+def get_usable_keys(
+    chrom,
+    pos,
+    genotypes,
+    window_index,
+    vars_by_sample,
+    family_indexes,
+    whole_region,
+    het_sites,
+):
+    """
+    the keys of the denovos whose search windows contain pos,
+    and for whose trios the genotypes could make a het or candidate site.
+    family_indexes caches the sample indexes of each kid's trio
+    """
+    usable_keys = []
+    for close_var_key in get_close_vars(chrom, pos, window_index):
+        kid, chrom, start = close_var_key
+        kid_idx, dad_idx, mom_idx = family_indexes[kid]
+        if kid_idx is None:
             continue
-
-        # if kid is hemizygous we need to make sure the inherited allele is not shared
-        # by both parents
-        if genotypes[kid_idx] in [HOM_ALT, HOM_REF]:
-            unique_allele = True
-            # if one parent is het and the other is homozygous for either allele
-            # make sure the kid doesn't have that allele
-            parent_gts = [genotypes[dad_idx], genotypes[mom_idx]]
-            if (HET in parent_gts) and (HOM_ALT in parent_gts or HOM_REF in parent_gts):
-                for parent_gt in parent_gts:
-                    kid_gt = genotypes[kid_idx]
-                    if (parent_gt in [HOM_ALT, HOM_REF]) and (kid_gt == parent_gt):
-                        unique_allele = False
-            if not unique_allele:
-                continue
-        if "candidate_sites" not in vars_by_sample[kid][chrom][pos][i]:
-            vars_by_sample[kid][chrom][pos][i]["candidate_sites"] = []
-        vars_by_sample[kid][chrom][pos][i]["candidate_sites"].append(candidate)
-    return True
+        for denovo in vars_by_sample[kid][chrom][start]:
+            vartype = (
+                denovo["vartype"] if whole_region and ("vartype" in denovo) else None
+            )
+            if usable_genotypes(
+                genotypes, kid_idx, dad_idx, mom_idx, vartype, het_sites
+            ):
+                usable_keys.append(tuple(close_var_key))
+                break
+    return usable_keys
 
 
 ###################################################################################
 def multithread_find_many(
     vcf_name,
     chrom,
-    chrom_range,
-    samples_by_location,
+    clusters,
+    window_indexes,
     vars_by_sample,
-    search_dist,
     pedigrees,
-    whole_region,
+    searches,
     build,
 ):
-    vcf = VCF(vcf_name)
-    prefix = get_prefix(vcf)
+    vcf = open_sites_vcf(vcf_name, pedigrees)
+    contig = resolve_contig(get_vcf_contig_aliases(vcf_name, vcf), chrom)
     sample_dict = dict(zip(vcf.samples, range(len(vcf.samples))))
-    search_string = "{}:{}-{}".format(
-        prefix + chrom.strip("chr"),
-        chrom_range[0] - search_dist,
-        chrom_range[1] + search_dist,
-    )
-    vcf_iter = vcf(search_string)
+    family_indexes = {}
+    for kid in vars_by_sample:
+        if chrom in vars_by_sample[kid]:
+            family_indexes[kid] = get_family_indexes(kid, pedigrees, sample_dict)
+    site_stats = new_site_stats()
+    for cluster in clusters:
+        search_string = "{}:{}-{}".format(contig, cluster[0], cluster[1])
+        # keep the denovos of each search that each decoded record is usable for,
+        # to group the block rows by the denovos afterwards
+        keys_by_row = []
+
+        def usable(pos, genotypes):
+            search_keys = [
+                get_usable_keys(
+                    chrom,
+                    pos + 1,
+                    genotypes,
+                    window_index,
+                    vars_by_sample,
+                    family_indexes,
+                    search["whole_region"],
+                    search["het_sites"],
+                )
+                for search, window_index in zip(searches, window_indexes)
+            ]
+            if any(len(usable_keys) > 0 for usable_keys in search_keys):
+                keys_by_row.append(search_keys)
+                return True
+            return False
+
+        block = load_sites_block(vcf(search_string), len(vcf.samples), usable)
+        add_site_stats(site_stats, block["stats"])
+
+        high_quality = high_quality_sites(block)
+        trio_sites_cache = {}
+        for search_idx, search in enumerate(searches):
+            rows_by_key = {}
+            for row, search_keys in enumerate(keys_by_row):
+                for key in search_keys[search_idx]:
+                    if key not in rows_by_key:
+                        rows_by_key[key] = []
+                    rows_by_key[key].append(row)
+
+            for close_var_key in rows_by_key:
+                add_good_candidate_sites(
+                    block,
+                    high_quality,
+                    rows_by_key[close_var_key],
+                    vars_by_sample,
+                    close_var_key,
+                    pedigrees,
+                    search["whole_region"],
+                    sample_dict,
+                    build,
+                    trio_sites_cache,
+                    search["het_sites"],
+                    search["candidate_field"],
+                )
+    return site_stats
 
-    for variant in vcf_iter:
 
-        # ignore complex variants for now
-        if (
-            len(variant.ALT) != 1
-            or (len(variant.REF) > 1)
-            or ("*" in variant.ALT or len(variant.ALT[0]) > 1)
-        ):
-            continue
+def split_clusters(clusters, max_bases):
+    """
+    split clusters longer than max_bases into consecutive pieces.
+    sites records are single bases, so each is read by exactly one piece
+    """
+    pieces = []
+    for start, end in clusters:
+        while (end - start + 1) > max_bases:
+            pieces.append([start, start + max_bases - 1])
+            start += max_bases
+        pieces.append([start, end])
+    return pieces
 
-        close_var_keys = get_close_vars(
-            variant.CHROM,
-            variant.POS,
-            samples_by_location,
-            vars_by_sample,
-            search_dist,
-            whole_region,
-        )
 
-        if len(close_var_keys) == 0:
+def plan_chunks(clusters, chunk_bases):
+    """
+    group consecutive clusters into chunks of roughly chunk_bases queried bases,
+    so a chromosome can be searched by several workers at once
+    """
+    chunks = []
+    chunk_size = 0
+    for cluster in split_clusters(clusters, chunk_bases):
+        if len(chunks) == 0 or chunk_size >= chunk_bases:
+            chunks.append([])
+            chunk_size = 0
+        chunks[-1].append(cluster)
+        chunk_size += cluster[1] - cluster[0] + 1
+    return chunks
+
+
+def get_chunk_vars(vars_by_sample, chrom, chunk, searches):
+    """
+    copies of the denovos with search windows that overlap any part of a chunk,
+    with all of the denovos that share their key. the copies are pickled for
+    the worker after submission, so they must not see sites merged from other chunks
+    """
+    chunk_vars_by_sample = {}
+    for kid in vars_by_sample:
+        if chrom not in vars_by_sample[kid]:
             continue
-        for close_var_key in close_var_keys:
-            add_good_candidate_variant(
-                variant,
-                vars_by_sample,
-                close_var_key,
-                pedigrees,
-                whole_region,
-                sample_dict,
-                build,
+        for start in vars_by_sample[kid][chrom]:
+            denovos = vars_by_sample[kid][chrom][start]
+            windows = []
+            for denovo in denovos:
+                for search in searches:
+                    windows += get_search_windows(
+                        denovo, search["search_dist"], search["whole_region"]
+                    )
+            for window in windows:
+                if window[0] <= chunk[-1][1] and window[1] >= chunk[0][0]:
+                    if kid not in chunk_vars_by_sample:
+                        chunk_vars_by_sample[kid] = {chrom: {}}
+                    chunk_vars_by_sample[kid][chrom][start] = [
+                        dict(denovo) for denovo in denovos
+                    ]
+                    break
+    return chunk_vars_by_sample
+
+
+def find_chunk_sites(
+    vcf_name,
+    chrom,
+    chunk,
+    vars_by_sample,
+    pedigrees,
+    searches,
+    build,
+    quiet_mode,
+    site_filters,
+):
+    """
+    process pool worker for find_many. finds the sites in a chunk of a chromosome
+    for the worker's own copy of the denovos, and returns them with the same keys
+    """
+    set_site_filters(quiet_mode, **site_filters)
+    site_stats = multithread_find_many(
+        vcf_name,
+        chrom,
+        chunk,
+        get_window_indexes(vars_by_sample, searches),
+        vars_by_sample,
+        pedigrees,
+        searches,
+        build,
+    )
+    fields = [search["candidate_field"] for search in searches] + ["het_sites"]
+    chunk_sites = {}
+    for kid in vars_by_sample:
+        for start in vars_by_sample[kid][chrom]:
+            chunk_sites[(kid, start)] = []
+            for denovo in vars_by_sample[kid][chrom][start]:
+                chunk_sites[(kid, start)].append(
+                    {field: denovo[field] for field in fields if field in denovo}
+                )
+    return site_stats, chunk_sites
+
+
+def find_many_in_store(store, vars_by_sample, pedigrees, searches, build):
+    """
+    look up the sites in the search windows of each denovo in a sites store
+    """
+    for kid in vars_by_sample:
+        dad = pedigrees[kid]["dad"]
+        mom = pedigrees[kid]["mom"]
+        for chrom in vars_by_sample[kid]:
+            family_sites = get_family_sites(
+                store, kid, dad, mom, resolve_contig(store["aliases"], chrom)
             )
+            if family_sites is None:
+                if not QUIET_MODE:
+                    print("{} missing from sites store".format(kid), file=sys.stderr)
+                break
+            for start in vars_by_sample[kid][chrom]:
+                denovos = vars_by_sample[kid][chrom][start]
+                for search in searches:
+                    # denovos that share a start are matched to the same sites
+                    windows = []
+                    for denovo in denovos:
+                        windows += get_search_windows(
+                            denovo, search["search_dist"], search["whole_region"]
+                        )
+                    # a site can be in more than one of the windows
+                    rows = np.unique(find_window_rows(family_sites, windows))
+                    if len(rows) == 0:
+                        continue
+                    for denovo in denovos:
+                        block, trio_sites = load_store_block(
+                            family_sites, rows, get_search_vartype(denovo, search)
+                        )
+                        add_block_sites(
+                            denovo,
+                            block,
+                            range(len(rows)),
+                            trio_sites,
+                            dad,
+                            mom,
+                            search["het_sites"],
+                            search["candidate_field"],
+                        )
 
 
-def find_many(
-    dnms, pedigrees, vcf_name, search_dist, threads, build, whole_region=True
-):
+def find_many(dnms, pedigrees, vcf_name, searches, threads, build, store=None):
     """
     Given list of denovo variant positions
-    a vcf_name, and the distance upstream or downstream to search, find informative sites
+    a vcf_name, and the searches to make around them, find informative sites
     """
-    samples_by_location, vars_by_sample, chrom_ranges,dnms_autophase,dnms = create_lookups(
-        dnms, pedigrees, build
+    window_index, vars_by_sample, dnms_autophase, dnms = create_lookups(
+        dnms,
+        pedigrees,
+        build,
+        searches[0]["search_dist"],
+        searches[0]["whole_region"],
     )
-    chroms = set([dnm["chrom"] for dnm in dnms])
-
-    if threads != 1:
-        executor = ThreadPoolExecutor(threads)
-        futures = []
-    for chrom in chroms:
-        if threads != 1:
-            futures.append(
-                executor.submit(
-                    multithread_find_many,
-                    vcf_name,
-                    chrom,
-                    chrom_ranges[chrom],
-                    samples_by_location,
-                    vars_by_sample,
-                    search_dist,
-                    pedigrees,
-                    whole_region,
-                    build,
+    window_indexes = [window_index] + get_window_indexes(vars_by_sample, searches[1:])
+    chroms = sorted(set([dnm["chrom"] for dnm in dnms]))
+
+    query_summaries = []
+    if store is not None:
+        find_many_in_store(store, vars_by_sample, pedigrees, searches, build)
+    elif threads != 1:
+        # the work is python-bound, so it's split into chunks of each chromosome
+        # that are searched in separate processes, with several chunks per process
+        # so that one dense chunk doesn't hold up the rest
+        clusters_by_chrom = {}
+        for chrom in chroms:
+            clusters_by_chrom[chrom] = plan_queries(window_indexes, chrom)
+        total_bases = sum(
+            end - start + 1
+            for chrom in chroms
+            for start, end in clusters_by_chrom[chrom]
+        )
+        chunk_bases = max(
+            total_bases // (threads * CHUNKS_PER_THREAD) + 1, MIN_CHUNK_BASES
+        )
+        site_filters = get_site_filters(
+            [MIN_AB_HOMREF, MAX_AB_HOMREF],
+            [MIN_AB_HOMALT, MAX_AB_HOMALT],
+            [MIN_AB_HET, MAX_AB_HET],
+            MIN_GT_QUAL,
+            MIN_DEPTH,
+        )
+        with ProcessPoolExecutor(threads) as executor:
+            futures = {}
+            for chrom in chroms:
+                futures[chrom] = []
+                for chunk in plan_chunks(clusters_by_chrom[chrom], chunk_bases):
+                    futures[chrom].append(
+                        executor.submit(
+                            find_chunk_sites,
+                            vcf_name,
+                            chrom,
+                            chunk,
+                            get_chunk_vars(vars_by_sample, chrom, chunk, searches),
+                            pedigrees,
+                            searches,
+                            build,
+                            QUIET_MODE,
+                            site_filters,
+                        )
+                    )
+            # merge in chromosome and chunk order,
+            # so the output doesn't depend on scheduling
+            for chrom in chroms:
+                site_stats = new_site_stats()
+                for future in futures[chrom]:
+                    chunk_site_stats, chunk_sites = future.result()
+                    add_site_stats(site_stats, chunk_site_stats)
+                    for kid, start in sorted(chunk_sites):
+                        for denovo, sites in zip(
+                            vars_by_sample[kid][chrom][start],
+                            chunk_sites[(kid, start)],
+                        ):
+                            for field in sites:
+                                if field not in denovo:
+                                    denovo[field] = []
+                                denovo[field] += sites[field]
+                query_summaries.append(
+                    summarize_queries(chrom, clusters_by_chrom[chrom], site_stats)
                 )
-            )
-        else:
-            multithread_find_many(
+    else:
+        for chrom in chroms:
+            clusters = plan_queries(window_indexes, chrom)
+            site_stats = multithread_find_many(
                 vcf_name,
                 chrom,
-                chrom_ranges[chrom],
-                samples_by_location,
+                clusters,
+                window_indexes,
                 vars_by_sample,
-                search_dist,
                 pedigrees,
-                whole_region,
+                searches,
                 build,
             )
-    if threads != 1:
-        wait(futures)
+            query_summaries.append(summarize_queries(chrom, clusters, site_stats))
+
+    if not QUIET_MODE:
+        for summary in query_summaries:
+            print(
+                "Sites queries for chromosome {chrom}: {queries} regions, "
+                "{queried_bases} bases and {records} records read, "
+                "{skipped_bases} bases skipped, holding an estimated "
+                "{estimated_skipped_records} records".format(**summary),
+                file=sys.stderr,
+            )
+            print_site_stats(
+                "Sites records for chromosome {}".format(summary["chrom"]),
+                summary["site_stats"],
+            )
 
+    fields = [search["candidate_field"] for search in searches] + ["het_sites"]
     dnms_annotated = []
     for sample in vars_by_sample:
         for chrom in vars_by_sample[sample]:
             for pos in vars_by_sample[sample][chrom]:
                 for denovo in vars_by_sample[sample][chrom][pos]:
-                    if "candidate_sites" in denovo:
-                        denovo["candidate_sites"] = sorted(
-                            denovo["candidate_sites"], key=lambda x: x["pos"]
-                        )
-                    if "het_sites" in denovo:
-                        denovo["het_sites"] = sorted(
-                            denovo["het_sites"], key=lambda x: x["pos"]
-                        )
+                    for field in fields:
+                        if field in denovo:
+                            denovo[field] = sorted(
+                                denovo[field], key=lambda x: x["pos"]
+                            )
                     dnms_annotated.append(denovo)
     return (dnms_annotated+dnms_autophase)
 
 
+def get_family_idxs(families, sample_dict):
+    """
+    get arrays of the sample indexes of the kids, dads, and moms of the families
+    """
+    kids = list(families)
+    return (
+        np.array([sample_dict[kid] for kid in kids], dtype=np.int64),
+        np.array([sample_dict[families[kid]["dad"]] for kid in kids], dtype=np.int64),
+        np.array([sample_dict[families[kid]["mom"]] for kid in kids], dtype=np.int64),
+    )
+
+
+def usable_for_families(genotypes, kid_idxs, dad_idxs, mom_idxs):
+    """
+    check if the genotypes could make a het or candidate site for any family,
+    as usable_genotypes does for a DEL with het sites, across all families at once
+    """
+    kid_gts = genotypes[kid_idxs]
+    dad_gts = genotypes[dad_idxs]
+    mom_gts = genotypes[mom_idxs]
+    known = (dad_gts != GT_UNKNOWN) & (mom_gts != GT_UNKNOWN)
+    # a DEL takes homozygous kids as well, and het kids are always kept
+    candidate = (dad_gts != mom_gts) & ((kid_gts == HOM_REF) | (kid_gts == HOM_ALT))
+    return bool(np.any(known & ((kid_gts == HET) | candidate)))
+
+
+def get_chrom_sites(vcf, families, sample_dict):
+    """
+    classify the sites of every family, one chromosome at a time.
+    only sites that are het or informative for a family are kept for it
+    """
+    kid_idxs, dad_idxs, mom_idxs = get_family_idxs(families, sample_dict)
+    for chrom in vcf.seqnames:
+        family_sites = {}
+        for kid in families:
+            family_sites[kid] = {field: [] for field in STORE_FIELDS}
+        site_stats = new_site_stats()
+        records = vcf(chrom)
+        while True:
+            variants = list(islice(records, PREPARE_CHUNK_SIZE))
+            if len(variants) == 0:
+                break
+            block = load_sites_block(
+                variants,
+                len(vcf.samples),
+                lambda pos, genotypes: usable_for_families(
+                    genotypes, kid_idxs, dad_idxs, mom_idxs
+                ),
+            )
+            add_site_stats(site_stats, block["stats"])
+            high_quality = high_quality_sites(block)
+            ref = np.array(block["ref"], dtype="S1")
+            alt = np.array(block["alt"], dtype="S1")
+            for kid in families:
+                kid_idx = sample_dict[kid]
+                dad_idx = sample_dict[families[kid]["dad"]]
+                mom_idx = sample_dict[families[kid]["mom"]]
+                trio_sites = classify_trio_sites(
+                    block, high_quality, kid_idx, dad_idx, mom_idx, None
+                )
+                cnv_trio_sites = {}
+                for vartype in KID_ALLELE_SHIFTS:
+                    cnv_trio_sites[vartype] = classify_trio_sites(
+                        block, high_quality, kid_idx, dad_idx, mom_idx, vartype
+                    )
+                flags = encode_site_flags(trio_sites, cnv_trio_sites)
+                # the parent of the alt allele doesn't matter for other sites
+                keep = (flags & ~np.uint8(ALT_FROM_DAD_FLAG)) > 0
+                family_sites[kid]["pos"].append(block["pos"][keep])
+                family_sites[kid]["ref"].append(ref[keep])
+                family_sites[kid]["alt"].append(alt[keep])
+                family_sites[kid]["flags"].append(flags[keep])
+        if site_stats["records"] == 0:
+            continue
+
+        site_count = 0
+        for kid in families:
+            for field in STORE_FIELDS:
+                family_sites[kid][field] = np.concatenate(family_sites[kid][field])
+            site_count += len(family_sites[kid]["pos"])
+        if not QUIET_MODE:
+            print_site_stats(
+                "Sites records for chromosome {}".format(chrom), site_stats
+            )
+            print(
+                "Prepared sites for chromosome {}: ".format(chrom)
+                + "{} het or informative sites across {} families".format(
+                    site_count, len(families)
+                ),
+                file=sys.stderr,
+            )
+        yield chrom, family_sites
+
+
+def prepare(
+    pedigrees,
+    vcf_name,
+    store_dir,
+    quiet_mode,
+    ab_homref,
+    ab_homalt,
+    ab_het,
+    min_gt_qual,
+    min_depth,
+):
+    """
+    find the het and informative sites of every trio across the whole sites file
+    and write them to a sites store that find can read in place of the file
+    """
+    set_site_filters(quiet_mode, ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth)
+    vcf = open_sites_vcf(vcf_name, pedigrees)
+    sample_dict = dict(zip(vcf.samples, range(len(vcf.samples))))
+    families = {}
+    for kid in sorted(pedigrees):
+        if None in get_family_indexes(kid, pedigrees, sample_dict):
+            continue
+        families[kid] = {"dad": pedigrees[kid]["dad"], "mom": pedigrees[kid]["mom"]}
+    if len(families) == 0:
+        sys.exit("No complete trios in the sites file")
+
+    manifest = {
+        "sites_vcf": os.path.abspath(vcf_name),
+        "samples": vcf.samples,
+        "filters": get_site_filters(
+            ab_homref, ab_homalt, ab_het, min_gt_qual, min_depth
+        ),
+        "families": families,
+    }
+    write_site_store(store_dir, manifest, get_chrom_sites(vcf, families, sample_dict))
+    return manifest
+
+
 if __name__ == "__main__":
     sys.exit("Import this as a module")
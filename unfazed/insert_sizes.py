@@ -0,0 +1,549 @@
+#!/usr/bin/env python
+"""
+estimates of the concordant insert length of each alignment file, and their cache.
+
+the length is estimated from reads sampled at random regions of the autosomes,
+through the index, until the estimate stops changing. estimating it still reads
+many regions of the file, so the result is kept in a json file in a cache
+directory and reused by later runs. entries are keyed on the path of the
+alignment file and the options used to estimate it, and are only used while
+the size and modification time of the file are unchanged.
+
+samples with insert size metrics from Picard or samtools skip the estimate,
+and use the mean and standard deviation of their metrics instead
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+import time
+from threading import Lock
+
+import numpy as np
+
+from .handle_pool import get_alignment_file
+from .utils import get_contig_key
+
+# bases of each region sampled for read inserts, and regions sampled between
+# checks of the estimate
+INSERT_SAMPLE_REGION = 1000
+INSERT_SAMPLE_ROUND = 32
+# the estimate has converged once a round changes it by less than this fraction,
+# with at least the minimum number of inserts sampled
+INSERT_CONVERGENCE = 0.005
+MIN_INSERT_SAMPLE = 10000
+MAX_INSERT_SAMPLE_REGIONS = 10000
+# inserts are counted in a histogram, with any longer than this in the last bin
+MAX_INSERT_SIZE = 100000
+INSERT_SAMPLE_SEED = 0
+# upper percentile of inserts left out of the estimate
+INSERT_TRIM_PERCENTILE = 99.5
+AUTOSOMES = [str(chrom) for chrom in range(1, 23)]
+
+CACHE_VERSION = 2
+CACHE_NAME = "insert_sizes.json"
+# the options an estimate depends on, in the order they're shown
+ESTIMATE_OPTIONS = ["insert_size_max_sample", "stdevs", "readlen"]
+
+# set by set_insert_size_cache
+CACHE_DIR = None
+REBUILD = False
+QUIET_MODE = False
+cache_lock = Lock()
+
+# concordant insert lengths of the samples in this run, shared by the SNV and SV
+# phasers. each sample has a lock so that only one thread estimates it
+sample_insert_lens = {}
+sample_insert_locks = {}
+sample_locks_lock = Lock()
+
+
+def is_insert_read(read):
+    """
+    primary alignments of pairs with both reads mapped to the same contig
+    """
+    return not (
+        read.is_unmapped
+        or read.mate_is_unmapped
+        or not read.is_paired
+        or read.is_secondary
+        or read.is_supplementary
+        or read.is_duplicate
+        or read.is_qcfail
+        or read.tlen == 0
+        or read.next_reference_id != read.reference_id
+    )
+
+
+def add_inserts(insert_hist, inserts):
+    if len(inserts) > 0:
+        insert_hist += np.bincount(
+            np.minimum(inserts, MAX_INSERT_SIZE), minlength=MAX_INSERT_SIZE + 1
+        )
+
+
+def get_insert_stats(insert_hist):
+    """
+    the INSERT_TRIM_PERCENTILE percentile of the inserts in a histogram,
+    which is the concordant insert length, and the mean and standard deviation
+    of the inserts below it
+    """
+    insert_count = insert_hist.sum()
+    cumulative_counts = np.cumsum(insert_hist)
+    # interpolate the percentile between the sizes of its neighboring inserts,
+    # as numpy does for a list of the inserts
+    rank = (insert_count - 1) * INSERT_TRIM_PERCENTILE / 100.0
+    lower = np.searchsorted(cumulative_counts, np.floor(rank), side="right")
+    upper = np.searchsorted(cumulative_counts, np.ceil(rank), side="right")
+    max_insert = lower + (upper - lower) * (rank - np.floor(rank))
+
+    sizes = np.arange(len(insert_hist))
+    trimmed_hist = np.where(sizes <= max_insert, insert_hist, 0)
+    mean = (sizes * trimmed_hist).sum() / float(trimmed_hist.sum())
+    variance = (((sizes - mean) ** 2) * trimmed_hist).sum() / float(trimmed_hist.sum())
+    return {
+        "concordant_insert_len": float(int(max_insert)),
+        "trimmed_insert_mean": float(mean),
+        "trimmed_insert_stdev": float(np.sqrt(variance)),
+        "inserts_sampled": int(insert_count),
+    }
+
+
+def get_sample_contigs(bamfile):
+    """
+    the autosomes of an alignment file, or all of its contigs if it has none
+    """
+    contigs = [
+        [contig, length]
+        for contig, length in zip(bamfile.references, bamfile.lengths)
+        if get_contig_key(contig) in AUTOSOMES
+    ]
+    if len(contigs) == 0:
+        contigs = [list(contig) for contig in zip(bamfile.references, bamfile.lengths)]
+    return contigs
+
+
+def sample_region_inserts(bamfile, contig, start, readlen):
+    inserts = []
+    for read in bamfile.fetch(contig, start, start + INSERT_SAMPLE_REGION):
+        # reads that start before the region belong to another one
+        if read.reference_start < start or not is_insert_read(read):
+            continue
+        inserts.append(abs(read.tlen - (readlen * 2)))
+    return inserts
+
+
+def estimate_insert_stats(bamfile, insert_size_max_sample, readlen):
+    """
+    the insert stats of an alignment file, from inserts sampled at random regions
+    of the autosomes. regions are sampled in rounds until the concordant insert
+    length converges, or insert_size_max_sample inserts have been counted.
+    memory is bounded by the histogram of insert sizes
+    """
+    contigs = get_sample_contigs(bamfile)
+    lengths = np.array([length for contig, length in contigs], dtype=np.float64)
+    rng = np.random.RandomState(INSERT_SAMPLE_SEED)
+    insert_hist = np.zeros(MAX_INSERT_SIZE + 1, dtype=np.int64)
+    insert_stats = None
+    regions_sampled = 0
+    while (
+        regions_sampled < MAX_INSERT_SAMPLE_REGIONS
+        and insert_hist.sum() < insert_size_max_sample
+        and lengths.sum() > 0
+    ):
+        # regions are placed in proportion to the length of each contig
+        contig_idxs = rng.choice(
+            len(contigs), INSERT_SAMPLE_ROUND, p=lengths / lengths.sum()
+        )
+        inserts = []
+        for contig_idx in contig_idxs:
+            contig, length = contigs[contig_idx]
+            start = rng.randint(0, max(length - INSERT_SAMPLE_REGION, 0) + 1)
+            inserts += sample_region_inserts(bamfile, contig, start, readlen)
+        add_inserts(insert_hist, inserts[: insert_size_max_sample - insert_hist.sum()])
+        regions_sampled += INSERT_SAMPLE_ROUND
+        if insert_hist.sum() == 0:
+            continue
+        last_insert_stats = insert_stats
+        insert_stats = get_insert_stats(insert_hist)
+        if (
+            last_insert_stats is not None
+            and insert_hist.sum() >= MIN_INSERT_SAMPLE
+            and abs(
+                insert_stats["concordant_insert_len"]
+                - last_insert_stats["concordant_insert_len"]
+            )
+            <= INSERT_CONVERGENCE * last_insert_stats["concordant_insert_len"]
+        ):
+            break
+
+    if insert_hist.sum() < min(MIN_INSERT_SAMPLE, insert_size_max_sample):
+        # too sparse to sample, so take the reads from the start of the file
+        insert_hist[:] = 0
+        inserts = []
+        for read in bamfile.fetch(until_eof=True):
+            if is_insert_read(read):
+                inserts.append(abs(read.tlen - (readlen * 2)))
+                if len(inserts) >= insert_size_max_sample:
+                    break
+        add_inserts(insert_hist, inserts)
+        if insert_hist.sum() == 0:
+            sys.exit(
+                "No mapped read pairs to estimate the insert size of {}".format(
+                    bamfile.filename.decode()
+                )
+            )
+        insert_stats = get_insert_stats(insert_hist)
+    return insert_stats
+
+
+def get_metrics_concordant_len(mean, stdev, stdevs, readlen):
+    """
+    the concordant insert length from the mean and standard deviation of the
+    fragment lengths in insert size metrics. inserts are measured by read as
+    |tlen - 2 * readlen|, so the longest concordant insert is that of the second
+    read of a pair with a fragment stdevs above the mean
+    """
+    return mean + (stdev * stdevs) + (readlen * 2)
+
+
+def parse_picard_metrics(metrics_lines):
+    """
+    mean and stdev of the InsertSizeMetrics of Picard CollectInsertSizeMetrics,
+    using the all-reads row of the most common pair orientation
+    """
+    header = None
+    rows = []
+    for line in metrics_lines:
+        if line.startswith("## METRICS CLASS"):
+            header = []
+            continue
+        if header is None or line.startswith("#"):
+            continue
+        if line.strip() == "":
+            # the histogram follows the metrics
+            if len(rows) > 0:
+                break
+            continue
+        fields = line.rstrip("\n").split("\t")
+        if len(header) == 0:
+            header = fields
+        else:
+            rows.append(dict(zip(header, fields)))
+    rows = [
+        row
+        for row in rows
+        if all(
+            row.get(level, "") == "" for level in ["SAMPLE", "LIBRARY", "READ_GROUP"]
+        )
+    ]
+    if len(rows) == 0:
+        return None
+    row = max(rows, key=lambda x: int(x.get("READ_PAIRS", 0)))
+    return float(row["MEAN_INSERT_SIZE"]), float(row["STANDARD_DEVIATION"])
+
+
+def parse_samtools_stats(metrics_lines):
+    """
+    mean and stdev of the insert sizes in the summary numbers of samtools stats
+    """
+    summary = {}
+    for line in metrics_lines:
+        if line.startswith("SN\t"):
+            fields = line.rstrip("\n").split("\t")
+            summary[fields[1].rstrip(":")] = fields[2]
+    if "insert size average" not in summary:
+        return None
+    return (
+        float(summary["insert size average"]),
+        float(summary["insert size standard deviation"]),
+    )
+
+
+def read_metrics_file(metrics_name):
+    with open(metrics_name, "r") as metrics_file:
+        metrics_lines = metrics_file.readlines()
+    try:
+        if any(line.startswith("## METRICS CLASS") for line in metrics_lines):
+            return parse_picard_metrics(metrics_lines)
+        return parse_samtools_stats(metrics_lines)
+    except (KeyError, IndexError, ValueError):
+        sys.exit("Unreadable insert size metrics in {}".format(metrics_name))
+
+
+def read_metrics_table(metrics_name):
+    """
+    a table of sample, mean and stdev, separated by tabs or spaces
+    """
+    metrics = {}
+    with open(metrics_name, "r") as metrics_file:
+        for line in metrics_file:
+            if line.startswith("#") or line.strip() == "":
+                continue
+            fields = line.split()
+            try:
+                metrics[fields[0]] = float(fields[1]), float(fields[2])
+            except (IndexError, ValueError):
+                sys.exit(
+                    "Insert size metrics table {} needs sample, mean ".format(
+                        metrics_name
+                    )
+                    + "and stdev on each line, not: {}".format(line.strip())
+                )
+    return metrics
+
+
+def read_metrics_dir(metrics_dir, samples):
+    """
+    the metrics in Picard CollectInsertSizeMetrics or samtools stats output
+    files named for each sample, up to the first dot
+    """
+    metrics = {}
+    for metrics_name in sorted(os.listdir(metrics_dir)):
+        sample = metrics_name.split(".")[0]
+        metrics_name = os.path.join(metrics_dir, metrics_name)
+        if sample not in samples or not os.path.isfile(metrics_name):
+            continue
+        if sample in metrics:
+            sys.exit(
+                "multiple insert size metrics files for {} in {}".format(
+                    sample, metrics_dir
+                )
+            )
+        sample_metrics = read_metrics_file(metrics_name)
+        if sample_metrics is not None:
+            metrics[sample] = sample_metrics
+    return metrics
+
+
+def read_insert_size_metrics(metrics_name, samples, stdevs, readlen):
+    """
+    the concordant insert lengths of samples from precomputed insert size
+    metrics, either a directory of per-sample metrics files or a table.
+    samples without metrics are left out, and estimated from their reads
+    """
+    if metrics_name is None:
+        return {}
+    if os.path.isdir(metrics_name):
+        metrics = read_metrics_dir(metrics_name, samples)
+    else:
+        metrics = read_metrics_table(metrics_name)
+    concordant_lens = {}
+    for sample in samples:
+        if sample in metrics:
+            mean, stdev = metrics[sample]
+            concordant_lens[sample] = get_metrics_concordant_len(
+                mean, stdev, stdevs, readlen
+            )
+    if not QUIET_MODE:
+        missing = sorted(set(samples) - set(concordant_lens))
+        if len(missing) > 0:
+            print(
+                "no insert size metrics for {}, estimating from reads".format(
+                    ", ".join(missing)
+                ),
+                file=sys.stderr,
+            )
+    return concordant_lens
+
+
+def get_default_cache_dir():
+    cache_home = os.environ.get("XDG_CACHE_HOME", "")
+    if cache_home == "":
+        cache_home = os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(cache_home, "unfazed")
+
+
+def set_insert_size_cache(cache_dir, rebuild, quiet_mode):
+    """
+    cache_dir of None or an empty string turns the cache off.
+    with rebuild, cached lengths aren't used, but are replaced with new estimates
+    """
+    global CACHE_DIR
+    CACHE_DIR = cache_dir if cache_dir else None
+    global REBUILD
+    REBUILD = rebuild
+    global QUIET_MODE
+    QUIET_MODE = quiet_mode
+
+
+def get_file_info(bam_name):
+    stat = os.stat(bam_name)
+    return {
+        "path": os.path.realpath(bam_name),
+        "size": stat.st_size,
+        "mtime_ns": stat.st_mtime_ns,
+    }
+
+
+def read_cache(cache_dir):
+    cache_name = os.path.join(cache_dir, CACHE_NAME)
+    if not os.path.exists(cache_name):
+        return []
+    try:
+        with open(cache_name, "r") as cache_file:
+            cache = json.load(cache_file)
+    except ValueError:
+        if not QUIET_MODE:
+            print(
+                "Ignoring unreadable insert size cache {}".format(cache_name),
+                file=sys.stderr,
+            )
+        return []
+    if cache.get("version") != CACHE_VERSION:
+        return []
+    return cache["entries"]
+
+
+def write_cache(cache_dir, entries):
+    """
+    replace the cache file in one step, so a reader never sees part of it
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+    cache_name = os.path.join(cache_dir, CACHE_NAME)
+    temp_name = "{}.{}.tmp".format(cache_name, os.getpid())
+    with open(temp_name, "w") as cache_file:
+        json.dump(
+            {"version": CACHE_VERSION, "entries": entries},
+            cache_file,
+            indent=1,
+            sort_keys=True,
+        )
+    os.replace(temp_name, cache_name)
+
+
+def matches_entry(entry, file_info, options):
+    return entry["path"] == file_info["path"] and all(
+        entry[name] == options[name] for name in ESTIMATE_OPTIONS
+    )
+
+
+def is_current(entry, file_info):
+    return (
+        entry["size"] == file_info["size"]
+        and entry["mtime_ns"] == file_info["mtime_ns"]
+    )
+
+
+def get_cached_insert_len(bam_name, options):
+    """
+    the cached concordant insert length of an alignment file,
+    or None if there isn't a current one for these options
+    """
+    if CACHE_DIR is None or REBUILD:
+        return None
+    file_info = get_file_info(bam_name)
+    with cache_lock:
+        entries = read_cache(CACHE_DIR)
+    for entry in entries:
+        if matches_entry(entry, file_info, options) and is_current(entry, file_info):
+            return entry["concordant_insert_len"]
+    return None
+
+
+def cache_insert_stats(bam_name, options, insert_stats):
+    """
+    add an estimate to the cache, replacing any earlier one for the same options.
+    the cache is only an optimization, so failing to write it isn't fatal
+    """
+    if CACHE_DIR is None:
+        return
+    file_info = get_file_info(bam_name)
+    entry = dict(file_info)
+    entry.update(options)
+    entry.update(insert_stats)
+    entry["estimated"] = int(time.time())
+    with cache_lock:
+        entries = [
+            cached
+            for cached in read_cache(CACHE_DIR)
+            if not matches_entry(cached, file_info, options)
+        ]
+        entries.append(entry)
+        try:
+            write_cache(CACHE_DIR, entries)
+        except (IOError, OSError) as error:
+            if not QUIET_MODE:
+                print(
+                    "Could not write insert size cache in {}: {}".format(
+                        CACHE_DIR, error
+                    ),
+                    file=sys.stderr,
+                )
+
+
+def get_cache_stats(cache_dir):
+    """
+    the entries of a cache, each with the status of its alignment file:
+    current, changed since the estimate, or missing
+    """
+    stats = []
+    for entry in read_cache(cache_dir):
+        entry = dict(entry)
+        if not os.path.exists(entry["path"]):
+            entry["status"] = "missing"
+        elif is_current(entry, get_file_info(entry["path"])):
+            entry["status"] = "current"
+        else:
+            entry["status"] = "changed"
+        stats.append(entry)
+    return sorted(stats, key=lambda x: x["path"])
+
+
+def get_concordant_insert_len(
+    bam_name, cram_ref, insert_size_max_sample, stdevs, readlen
+):
+    """
+    the concordant insert length of an alignment file, from the insert size cache
+    if it was estimated with the same options before
+    """
+    options = {
+        "insert_size_max_sample": insert_size_max_sample,
+        "stdevs": stdevs,
+        "readlen": readlen,
+    }
+    concordant_insert_len = get_cached_insert_len(bam_name, options)
+    if concordant_insert_len is None:
+        insert_stats = estimate_insert_stats(
+            get_alignment_file(bam_name, cram_ref), insert_size_max_sample, readlen
+        )
+        cache_insert_stats(bam_name, options, insert_stats)
+        concordant_insert_len = insert_stats["concordant_insert_len"]
+    return concordant_insert_len
+
+
+def set_sample_insert_lens(insert_lens):
+    """
+    start the run's memo of concordant insert lengths,
+    with those of samples that have precomputed metrics
+    """
+    sample_insert_lens.clear()
+    sample_insert_lens.update(insert_lens)
+
+
+def get_sample_insert_len(
+    sample, bam_name, cram_ref, insert_size_max_sample, stdevs, readlen
+):
+    """
+    the concordant insert length of a sample, estimated once per run.
+    threads that ask for a sample while it's being estimated wait for that estimate
+    """
+    if sample in sample_insert_lens:
+        return sample_insert_lens[sample]
+    with sample_locks_lock:
+        if sample not in sample_insert_locks:
+            sample_insert_locks[sample] = Lock()
+        sample_lock = sample_insert_locks[sample]
+    with sample_lock:
+        if sample not in sample_insert_lens:
+            sample_insert_lens[sample] = get_concordant_insert_len(
+                bam_name, cram_ref, insert_size_max_sample, stdevs, readlen
+            )
+    return sample_insert_lens[sample]
+
+
+if __name__ == "__main__":
+    sys.exit("Import this as a module")
@@ -1,71 +1,527 @@
 #! /usr/bin/env python
 # Python 2/3 compatibility
+import random
 import sys
+from bisect import bisect_left
+from concurrent.futures import ThreadPoolExecutor
+from threading import local
 
-import numpy as np
-import pysam
-
+from .handle_pool import get_alignment_file
+from .insert_sizes import get_concordant_insert_len, get_sample_insert_len
 from .site_searcher import binary_search
-from .utils import CIGAR_MAP
-
-def estimate_concordant_insert_len(bamfile, insert_size_max_sample, stdevs):
-    insert_sizes = []
-    for i, read in enumerate(bamfile):
-        insert = abs(read.tlen - (READLEN * 2))
-        insert_sizes.append(insert)
-        if i >= insert_size_max_sample:
-            break
-    insert_sizes = np.array(insert_sizes)
-    # filter out the top .1% as weirdies
-    insert_sizes = np.percentile(insert_sizes, 99.5)
+from .utils import (
+    SV_TYPES,
+    get_bam_contig_aliases,
+    get_coordinate_key,
+    resolve_contig,
+)
 
-    frag_len = int(np.mean(insert_sizes))
-    stdev = np.std(insert_sizes)
-    concordant_size = frag_len + (stdev * stdevs)
-    return concordant_size
+# the first and second read of a pair
+READ_PAIR_FLAGS = 0x40 | 0x80
+# reads that are unmapped, have an unmapped mate, are secondary, fail QC,
+# are duplicates, or are supplementary
+BAD_READ_FLAGS = 0x4 | 0x8 | 0x100 | 0x200 | 0x400 | 0x800
+# cigar operations that match the reference (M, =), and indels (I, D)
+MATCH_OPS = (0, 7)
+INDEL_OPS = (1, 2)
+# a stretch of a kid's variants is swept with one pass over the alignment file
+# once their fetches would read each of its bases at least SWEEP_MIN_DEPTH times.
+# sweeps are held in memory, so they're capped at SWEEP_MAX_SPAN bases, and a
+# sweep deeper than its scan limit is dropped for fetches of each window
+SWEEP_MIN_DEPTH = 3
+SWEEP_MAX_SPAN = 250000
+# the reads of the sweep each thread is working through
+thread_sweeps = local()
+# cigar operations that align a query base to a reference base (M, =, X),
+# and those that consume only query bases (I, S) or only reference bases (D, N)
+ALIGNED_OPS = (0, 7, 8)
+QUERY_OPS = (1, 4)
+REF_OPS = (2, 3)
+# the query offsets of the reads of the variant each thread is phasing,
+# by query name, start, and which read of the pair it is
+thread_offsets = local()
+# reads are sampled down to MAX_READS of depth at a variant or het site.
+# no stretch of a fetch reads more than READ_SCAN_FACTOR times that depth,
+# which bounds the time spent on a pile-up. past that depth the sample is even
+# over the reads that start first rather than over all of them
+READ_SCAN_FACTOR = 10
+
+
+def get_low_quals(min_base_qual):
+    """
+    the base qualities below min_base_qual, as bytes to delete from a read's qualities
+    """
+    return bytes(range(min(max(min_base_qual, 0), 256)))
 
 
 def goodread(read, discordant=False):
     if not read:
         return False
     if (
-        read.is_qcfail
-        or read.is_unmapped
-        or read.is_duplicate
-        or int(read.mapping_quality) < MIN_MAPQ
-        or read.is_secondary
-        or read.is_supplementary
-        or read.mate_is_unmapped
+        read.flag & BAD_READ_FLAGS
+        or read.mapping_quality < MIN_MAPQ
         or (read.next_reference_id != read.reference_id)
     ):
         return False
     if not discordant:
         low_quals = 0
-        for qual in read.query_qualities:
-            if qual < MIN_BASE_QUAL:
-                low_quals += 1
+        qualities = read.query_qualities
+        if qualities is not None:
+            # deleting the low qualities leaves the rest
+            low_quals = len(qualities) - len(
+                qualities.tobytes().translate(None, LOW_QUALS)
+            )
         mismatches = 0
-        for operation in read.cigartuples:
-            if CIGAR_MAP[operation[0] not in ["=", "M"]]:
+        for operation, length in read.cigartuples:
+            if operation not in MATCH_OPS:
                 mismatches += 1
         if low_quals > 10 or mismatches > 10:
             return False
     return True
 
 
+def get_read_end(read):
+    """
+    the end of a read as used to fetch it, which is one past the start
+    for reads that don't cover any reference bases
+    """
+    if read.reference_end is None:
+        return read.reference_start + 1
+    return read.reference_end
+
+
+def get_fetch_windows(denovo, concordant_upper_len):
+    """
+    the windows fetch_pairs reads to phase a variant, including those of its het sites
+    """
+    if denovo["vartype"].upper() in SV_TYPES:
+        # breakpoint fetches are widened by the concordant insert length twice
+        reach = concordant_upper_len * 2
+        windows = [
+            [position - reach, position + reach]
+            for position in [int(denovo["start"]), int(denovo["end"])]
+        ]
+    else:
+        position = int(denovo["start"])
+        windows = [
+            [position - 1 - concordant_upper_len, position + 1 + concordant_upper_len]
+        ]
+    for het_site in denovo.get("het_sites", []):
+        windows.append(
+            [
+                het_site["pos"] - concordant_upper_len,
+                het_site["pos"] + 1 + concordant_upper_len,
+            ]
+        )
+    return [[int(max(0, start)), int(end) + 1] for start, end in windows]
+
+
+def add_sweep_spans(kid_dnms, concordant_upper_len):
+    """
+    find the stretches of a kid's chromosomes where its variants' fetches overlap
+    enough that one pass over the alignment file reads less, and mark the variants
+    in them with the span to sweep as sweep_span. other variants get None
+    """
+    dnms_by_chrom = {}
+    for denovo in kid_dnms:
+        denovo["sweep_span"] = None
+        key = (denovo["bam"], denovo["chrom"])
+        dnms_by_chrom.setdefault(key, []).append(denovo)
+    for key in dnms_by_chrom:
+        clusters = []
+        for denovo in sorted(dnms_by_chrom[key], key=get_coordinate_key):
+            windows = get_fetch_windows(denovo, concordant_upper_len)
+            span = [min(x[0] for x in windows), max(x[1] for x in windows)]
+            fetched = sum(end - start for start, end in windows)
+            cluster = clusters[-1] if len(clusters) > 0 else None
+            if (
+                cluster is not None
+                and span[0] < cluster["span"][1]
+                and max(span[1], cluster["span"][1]) - cluster["span"][0]
+                <= SWEEP_MAX_SPAN
+            ):
+                cluster["span"][1] = max(span[1], cluster["span"][1])
+                cluster["fetched"] += fetched
+                cluster["dnms"].append(denovo)
+            else:
+                clusters.append({"span": span, "fetched": fetched, "dnms": [denovo]})
+        for cluster in clusters:
+            span_len = cluster["span"][1] - cluster["span"][0]
+            if cluster["fetched"] >= SWEEP_MIN_DEPTH * span_len:
+                for denovo in cluster["dnms"]:
+                    denovo["sweep_span"] = cluster["span"]
+
+
+def add_kid_sweep_spans(dnms, threads, insert_size_max_sample, stdevs, readlen):
+    """
+    mark the variants of each kid with the spans to sweep before they're scheduled,
+    so the variants of a sweep can be kept on one worker. the kids' insert lengths,
+    which the spans are widened by, are estimated in parallel
+    """
+    dnms_by_kid = {}
+    for denovo in dnms:
+        dnms_by_kid.setdefault(denovo["kid"], []).append(denovo)
+    insert_len_args = [
+        [
+            kid,
+            dnms_by_kid[kid][0]["bam"],
+            dnms_by_kid[kid][0]["cram_ref"],
+            insert_size_max_sample,
+            stdevs,
+            readlen,
+        ]
+        for kid in sorted(dnms_by_kid)
+    ]
+    if threads != 1:
+        executor = ThreadPoolExecutor(threads)
+        for args in insert_len_args:
+            executor.submit(get_sample_insert_len, *args)
+        executor.shutdown()
+    for args in insert_len_args:
+        # the estimates are kept, so this only estimates again, and fails, if one failed
+        concordant_upper_len = get_sample_insert_len(*args)
+        add_sweep_spans(dnms_by_kid[args[0]], concordant_upper_len)
+
+
+def get_sweep(bamfile, tid, sweep_span):
+    """
+    the reads of a span of a contig, from one pass over it, or None if the span is
+    deeper than its scan limit. a sweep stops reading once it passes that limit,
+    and the variants in it fall back to fetching their own windows, so a pile-up
+    is never held in memory.
+    each thread keeps the last span it swept, so the variants in it share the pass
+    """
+    if sweep_span is None:
+        return None
+    key = (bamfile.filename, tid, sweep_span[0], sweep_span[1])
+    sweep = getattr(thread_sweeps, "sweep", None)
+    if sweep is None or sweep["key"] != key:
+        # let go of the last sweep's reads before reading the next
+        thread_sweeps.sweep = None
+        scan_limit = get_scan_limit(sweep_span[0], sweep_span[1])
+        reads = []
+        for read in bamfile.fetch(tid=tid, start=sweep_span[0], stop=sweep_span[1]):
+            if len(reads) >= scan_limit:
+                reads = None
+                break
+            reads.append(read)
+        sweep = {"key": key, "span": sweep_span, "reads": reads}
+        if reads is not None:
+            sweep["starts"] = [read.reference_start for read in reads]
+            sweep["max_read_len"] = max(
+                [get_read_end(read) - read.reference_start for read in reads] + [1]
+            )
+        thread_sweeps.sweep = sweep
+    if sweep["reads"] is None:
+        return None
+    return sweep
+
+
+def get_sweep_reads(sweep, start, end):
+    """
+    the reads of a sweep overlapping start to end, in the order fetch gives them
+    """
+    first = bisect_left(sweep["starts"], start - sweep["max_read_len"])
+    last = bisect_left(sweep["starts"], end)
+    return [read for read in sweep["reads"][first:last] if get_read_end(read) > start]
+
+
+def new_read_buffer(bamfile, chrom, sweep_span=None):
+    """
+    reads fetched from a contig by query name, and the windows they were fetched from.
+    windows inside sweep_span are read from a single pass over it
+    """
+    tid = bamfile.get_tid(chrom)
+    return {
+        "tid": tid,
+        "windows": [],
+        "reads": {},
+        "sweep": get_sweep(bamfile, tid, sweep_span),
+    }
+
+
+def in_read_windows(read, read_buffer, windows):
+    """
+    check if a read was read by the fetch of one of the windows, which read every
+    read overlapping the window that starts before the part of it marked as read.
+    the fetch may have stopped partway through the reads that start at the end of
+    that part, so those are looked up in the buffer
+    """
+    read_end = get_read_end(read)
+    if any(
+        start < end and read.reference_start < end and read_end > start
+        for start, end in windows
+    ):
+        return True
+    if any(read.reference_start <= end and read_end > start for start, end in windows):
+        return any(
+            buffered.flag == read.flag
+            and buffered.reference_start == read.reference_start
+            for buffered in read_buffer["reads"].get(read.query_name, [])
+        )
+    return False
+
+
+def get_window_reads(bamfile, read_buffer, start, end):
+    """
+    the reads of the buffer's contig overlapping start to end, in order of their
+    start, from the buffer's sweep if it covers them
+    """
+    sweep = read_buffer["sweep"]
+    if sweep is not None and sweep["span"][0] <= start < end <= sweep["span"][1]:
+        return get_sweep_reads(sweep, start, end)
+    return bamfile.fetch(tid=read_buffer["tid"], start=start, stop=end)
+
+
+def fetch_pairs(bamfile, read_buffer, regions, mate_dist):
+    """
+    generate the reads overlapping the regions, start to end pairs of the buffer's
+    contig in position order. every read within mate_dist of them is kept in the
+    buffer as it's read, so the mates of most of the reads can be found without
+    another fetch. reads an earlier window of the buffer read aren't added to it
+    again. the reads are read lazily, and if the caller stops early the buffer only
+    covers the part of the window read so far.
+    every read counts against the scan limit of the stretch it's read in: before
+    a region, over one, or after the last. past the limit before a region the fetch
+    skips ahead to it, past the limit over a region it stops yielding the reads that
+    only cover that region, and past the limit after the last region it stops
+    """
+    regions = [[int(start), int(end)] for start, end in regions]
+    window_start = int(max(0, regions[0][0] - mate_dist))
+    window_end = int(regions[-1][1] + mate_dist)
+    # reads that earlier windows read are already in the buffer
+    earlier_windows = read_buffer["windows"][:]
+    lead_limits = [
+        get_scan_limit(
+            window_start if idx == 0 else min(regions[idx - 1][1], regions[idx][0]),
+            regions[idx][0],
+        )
+        for idx in range(len(regions))
+    ]
+    region_limits = [get_scan_limit(start, end) for start, end in regions]
+    tail_limit = get_scan_limit(regions[-1][1], window_end)
+    region_counts = [0] * len(regions)
+    # the first region that reads to come could still be yielded for,
+    # and the reads read before it since the last region was passed
+    open_idx = 0
+    lead_count = 0
+    tail_count = 0
+    # the reads read at the start of the last read, which a fetch that skips ahead
+    # reads again along with those before it
+    last_start = None
+    last_start_keys = set()
+    fetch_start = window_start
+    while fetch_start is not None:
+        skipped_ahead = fetch_start != window_start
+        # the part of the window whose reads are all in the buffer
+        window = [fetch_start, fetch_start]
+        read_buffer["windows"].append(window)
+        reads = get_window_reads(bamfile, read_buffer, fetch_start, window_end)
+        fetch_start = None
+        for read in reads:
+            read_key = (read.query_name, read.flag)
+            if skipped_ahead and (
+                read.reference_start < last_start
+                or (read.reference_start == last_start and read_key in last_start_keys)
+            ):
+                continue
+            if read.reference_start != last_start:
+                last_start = read.reference_start
+                last_start_keys = set()
+            last_start_keys.add(read_key)
+            # reads come in order of their start, so every read overlapping
+            # a position before this one's start has been read
+            window[1] = max(window[1], min(read.reference_start, window_end))
+            if not in_read_windows(read, read_buffer, earlier_windows):
+                if read.query_name not in read_buffer["reads"]:
+                    read_buffer["reads"][read.query_name] = []
+                read_buffer["reads"][read.query_name].append(read)
+
+            while open_idx < len(regions) and (
+                regions[open_idx][1] <= read.reference_start
+                or region_counts[open_idx] >= region_limits[open_idx]
+            ):
+                open_idx += 1
+                lead_count = 0
+            if open_idx == len(regions):
+                tail_count += 1
+                if tail_count >= tail_limit:
+                    return
+                continue
+            read_end = get_read_end(read)
+            covered = False
+            for region_idx in range(open_idx, len(regions)):
+                region_start, region_end = regions[region_idx]
+                if region_start >= read_end:
+                    break
+                if (
+                    region_end > read.reference_start
+                    and region_counts[region_idx] < region_limits[region_idx]
+                ):
+                    region_counts[region_idx] += 1
+                    covered = True
+            if covered:
+                yield read
+                continue
+            lead_count += 1
+            if lead_count >= lead_limits[open_idx]:
+                # the rest of the reads before the region aren't read,
+                # and their mates are looked up through the index
+                fetch_start = regions[open_idx][0]
+                lead_count = 0
+                break
+        else:
+            window[1] = window_end
+
+
+def find_mate(bamfile, read, read_buffer):
+    """
+    the mate of a read as bamfile.mate() would find it, or None if there isn't one.
+    mates at a position in the part of the buffer's windows that has been read
+    are paired by query name, only the others take an index lookup
+    """
+    if not read.is_paired or read.mate_is_unmapped:
+        return None
+    mate_pos = read.next_reference_start
+    if read.next_reference_id == read_buffer["tid"] and any(
+        start <= mate_pos < end for start, end in read_buffer["windows"]
+    ):
+        # every read overlapping the mate's position is in the buffer,
+        # and they're in the order bamfile.mate() would see them
+        mate_flag = (read.flag ^ READ_PAIR_FLAGS) & READ_PAIR_FLAGS
+        for candidate in read_buffer["reads"].get(read.query_name, []):
+            if (
+                candidate.flag & mate_flag
+                and candidate.reference_start <= mate_pos < get_read_end(candidate)
+            ):
+                return candidate
+        return None
+    try:
+        return bamfile.mate(read)
+    except ValueError:
+        return None
+
+
+def get_query_offsets(read):
+    """
+    the query offset aligned to each reference position of a read, from its start,
+    or -1 where the position is deleted or skipped
+    """
+    if read.cigartuples is None:
+        return []
+    offsets = [-1] * (get_read_end(read) - read.reference_start)
+    query_offset = 0
+    ref_offset = 0
+    for operation, length in read.cigartuples:
+        if operation in ALIGNED_OPS:
+            offsets[ref_offset : ref_offset + length] = range(
+                query_offset, query_offset + length
+            )
+            query_offset += length
+            ref_offset += length
+        elif operation in QUERY_OPS:
+            query_offset += length
+        elif operation in REF_OPS:
+            ref_offset += length
+    return offsets
+
+
+def get_cached_offsets(read):
+    if not hasattr(thread_offsets, "reads"):
+        thread_offsets.reads = {}
+    key = (read.query_name, read.reference_start, read.is_read1)
+    offsets = thread_offsets.reads.get(key)
+    if offsets is None:
+        offsets = get_query_offsets(read)
+        thread_offsets.reads[key] = offsets
+    return offsets
+
+
+def clear_cached_offsets():
+    """
+    drop the query offsets of this thread's variant once it has been phased
+    """
+    thread_offsets.reads = {}
+
+
+def get_query_offset(read, pos):
+    """
+    the offset in a read's query sequence aligned to reference position pos,
+    or None if it isn't aligned there. the same as
+    read.get_reference_positions(full_length=True).index(pos), without the lists
+    """
+    offsets = get_cached_offsets(read)
+    ref_offset = pos - read.reference_start
+    if 0 <= ref_offset < len(offsets) and offsets[ref_offset] >= 0:
+        return offsets[ref_offset]
+    return None
+
+
+def get_aligned_query_range(read):
+    """
+    the first and last query offsets aligned to the reference,
+    which are the ends of any clipping (or insertions) at either end of the read
+    """
+    first_aligned = None
+    last_aligned = None
+    query_offset = 0
+    for operation, length in read.cigartuples:
+        if operation in ALIGNED_OPS and length > 0:
+            if first_aligned is None:
+                first_aligned = query_offset
+            last_aligned = query_offset + length - 1
+        if operation in ALIGNED_OPS or operation in QUERY_OPS:
+            query_offset += length
+    return first_aligned, last_aligned
+
+
+def get_cigar_len(cigartuples):
+    return sum(length for operation, length in cigartuples)
+
+
+def count_cigar_ops(cigartuples, start, end, operations):
+    """
+    how many of positions start to end of a cigar, as if it were expanded to one
+    operation per base, are one of operations. counted from the run lengths
+    """
+    count = 0
+    op_start = 0
+    for operation, length in cigartuples:
+        if op_start >= end:
+            break
+        op_end = op_start + length
+        if operation in operations:
+            count += max(0, min(end, op_end) - max(start, op_start))
+        op_start = op_end
+    return count
+
+
+def get_query_len(read):
+    """
+    the length of a read's query from its cigar, including soft clips but not hard
+    """
+    op_counts = read.get_cigar_stats()[0]
+    return sum(op_counts[operation] for operation in ALIGNED_OPS + QUERY_OPS)
+
+
+def get_unaligned_count(read):
+    """
+    bases of a read's query that aren't aligned to the reference (inserted or clipped)
+    """
+    op_counts = read.get_cigar_stats()[0]
+    return sum(op_counts[operation] for operation in QUERY_OPS)
+
+
 def get_allele_at(read, mate, pos, var_len):
-    read_ref_positions = read.get_reference_positions(full_length=True)
-    if mate:
-        mate_ref_positions = mate.get_reference_positions(full_length=True)
+    read_pos = get_query_offset(read, pos)
+    mate_pos = get_query_offset(mate, pos) if mate else None
 
-    if pos in read_ref_positions:
-        read_pos = read_ref_positions.index(pos)
+    if read_pos is not None:
         if read_pos < 4 or read_pos > (READLEN - 4):
             return False
         if len(read.query_sequence) > read_pos + var_len:
             return read.query_sequence[read_pos: read_pos + var_len]
-    elif mate and pos in mate_ref_positions:
-        mate_pos = mate_ref_positions.index(pos)
+    elif mate_pos is not None:
         if mate_pos < 4 or mate_pos > (READLEN - 4):
             return False
         if len(mate.query_sequence) > mate_pos + var_len:
@@ -73,153 +529,260 @@ def get_allele_at(read, mate, pos, var_len):
     return False
 
 
+def get_site_allele(site_alleles, fetched_reads, readname, pos):
+    """
+    the allele a read pair has at a het site, looked up once per read and site
+    """
+    key = (readname, pos)
+    if key not in site_alleles:
+        read, mate = fetched_reads[readname]
+        site_alleles[key] = get_allele_at(read, mate, pos, 1)
+    return site_alleles[key]
+
+
 def connect_reads(grouped_readsets, read_sites, site_reads, new_reads, fetched_reads):
-    """"""
-    reads_to_add = {"ref": [], "alt": []}
-    for haplotype in new_reads:
-        other_haplotype = "ref" if haplotype == "alt" else "alt"
-        for readname, found_pos in new_reads[haplotype]:
-            if readname not in read_sites:
-                # if the read isn't in the read sites collection it's from the original
-                # variant and didn't overlap any het sites
-                continue
-            for site in read_sites[readname]:
-                # we don't want to reprocess the same site where we found the read originally
-                # reads from the breakpoints of dnmsv have -1 as pos
-                if site["pos"] == found_pos:
-                    continue
-                finder_allele = get_allele_at(
-                    fetched_reads[readname][0],
-                    fetched_reads[readname][1],
-                    site["pos"],
-                    1,
-                )
-                non_finder_allele = None
-                if finder_allele:
-                    if finder_allele == site["ref_allele"]:
-                        non_finder_allele = site["alt_allele"]
-                    elif finder_allele == site["alt_allele"]:
-                        non_finder_allele = site["ref_allele"]
-
-                if not (finder_allele and non_finder_allele):
+    """
+    extend the haplotypes of the grouped reads through the het sites they share with
+    other reads. read_sites and site_reads link reads to the het sites they cover,
+    and a read with the same allele at a site as the read that found it is on the
+    same haplotype, one with the other allele on the other. the graph is walked a
+    level at a time from the grouped reads, and each site's reads are labelled by the
+    first read to reach it with one of its alleles. a site's reads are only looked
+    at then, so the walk is linear in the links between reads and sites
+    """
+    grouped_reads = grouped_readsets["ref"] | grouped_readsets["alt"]
+    site_alleles = {}
+    labelled_sites = set()
+    while len(new_reads["alt"]) + len(new_reads["ref"]) > 0:
+        reads_to_add = {"ref": [], "alt": []}
+        for haplotype in new_reads:
+            other_haplotype = "ref" if haplotype == "alt" else "alt"
+            for readname, found_pos in new_reads[haplotype]:
+                if readname not in read_sites:
+                    # if the read isn't in the read sites collection it's from the
+                    # original variant and didn't overlap any het sites
                     continue
-                for site_readname in site_reads[site["pos"]]:
-                    # if we haven't already found the reads in the next_site, add them
-                    if (site_readname not in grouped_readsets["ref"]) and (
-                        site_readname not in grouped_readsets["alt"]
-                    ):
-                        # we need to assign this read to a haplotype
+                for site in read_sites[readname]:
+                    # we don't want to reprocess the same site where we found the
+                    # read originally. reads from the breakpoints of dnmsv have -1 as pos.
+                    # every read at a labelled site already has its haplotype or
+                    # can't get one, so it isn't looked at again either
+                    site_key = (site["pos"], site["ref_allele"], site["alt_allele"])
+                    if site["pos"] == found_pos or site_key in labelled_sites:
+                        continue
+                    finder_allele = get_site_allele(
+                        site_alleles, fetched_reads, readname, site["pos"]
+                    )
+                    non_finder_allele = None
+                    if finder_allele:
+                        if finder_allele == site["ref_allele"]:
+                            non_finder_allele = site["alt_allele"]
+                        elif finder_allele == site["alt_allele"]:
+                            non_finder_allele = site["ref_allele"]
+
+                    if not (finder_allele and non_finder_allele):
+                        continue
+                    labelled_sites.add(site_key)
+                    for site_readname in site_reads[site["pos"]]:
+                        # if we haven't already found the reads in the next_site,
+                        # we need to assign them to a haplotype,
                         # either the same hp as the de novo or not
-                        read, mate = fetched_reads[site_readname]
-                        new_read_allele = get_allele_at(read, mate, site["pos"], 1)
-                        if not new_read_allele:
+                        if site_readname in grouped_reads:
                             continue
-                        read_ref_positions = read.get_reference_positions(
-                            full_length=True
+                        new_read_allele = get_site_allele(
+                            site_alleles, fetched_reads, site_readname, site["pos"]
                         )
-                        if site["pos"] not in read_ref_positions:
+                        if not new_read_allele:
                             continue
-                        read_site_pos = read_ref_positions.index(site["pos"])
-                        if read.query_qualities[read_site_pos] < MIN_BASE_QUAL:
+                        read = fetched_reads[site_readname][0]
+                        read_site_pos = get_query_offset(read, site["pos"])
+                        if read_site_pos is None:
                             continue
-                        if not new_read_allele:
+                        if read.query_qualities[read_site_pos] < MIN_BASE_QUAL:
                             continue
 
                         # if the read's allele at the het site matches the allele
                         # in the read we used to find it,
                         # this read belong to the current haplotype.
-                        # If it matches the non_finder allele it belong to the other haplotype
-                        # otherwise it's an error
-
+                        # If it matches the non_finder allele it belong to the other
+                        # haplotype, otherwise it's an error
                         if new_read_allele == finder_allele:
-                            reads_to_add[haplotype].append([site_readname, site["pos"]])
-                            grouped_readsets[haplotype].add(site_readname)
+                            found_haplotype = haplotype
                         elif new_read_allele == non_finder_allele:
-                            reads_to_add[other_haplotype].append(
-                                [site_readname, site["pos"]]
-                            )
-                            grouped_readsets[other_haplotype].add(site_readname)
-
-    if len(reads_to_add["alt"]) + len(reads_to_add["ref"]) > 0:
-        grouped_readsets = connect_reads(
-            grouped_readsets,
-            read_sites,
-            site_reads,
-            reads_to_add,
-            fetched_reads,
-        )
+                            found_haplotype = other_haplotype
+                        else:
+                            continue
+                        reads_to_add[found_haplotype].append(
+                            [site_readname, site["pos"]]
+                        )
+                        grouped_readsets[found_haplotype].add(site_readname)
+                        grouped_reads.add(site_readname)
+        new_reads = reads_to_add
 
     return grouped_readsets
 
 
+def add_to_sample(sample, seen, item, max_items, rng):
+    """
+    reservoir sampling: keep item in an even sample of up to max_items
+    of the seen items before it and itself
+    """
+    if seen < max_items:
+        sample.append(item)
+        return
+    slot = rng.randint(0, seen)
+    if slot < max_items:
+        sample[slot] = item
+
+
+def sample_reads(reads, max_reads, seed):
+    """
+    an even sample of up to max_reads of the reads, kept in their order.
+    reads is read lazily, so a sample of fetch_pairs reads no more than its
+    scan limit
+    """
+    rng = random.Random(seed)
+    sample = []
+    for read_idx, read in enumerate(reads):
+        add_to_sample(sample, read_idx, (read_idx, read), max_reads, rng)
+    sample.sort(key=lambda item: item[0])
+    return [read for read_idx, read in sample]
+
+
+def get_window_budget(start, end):
+    """
+    the number of reads that keeps a window within MAX_READS of depth
+    """
+    return int(MAX_READS * (end - start + READLEN) / READLEN)
+
+
+def get_scan_limit(start, end):
+    """
+    the number of reads read from a window before reading stops
+    """
+    return get_window_budget(start, end) * READ_SCAN_FACTOR
+
+
+def get_het_site_regions(het_sites, mate_dist):
+    """
+    the indexes of the het sites in position order, split into regions
+    whose fetch windows overlap so that each region is fetched once
+    """
+    regions = []
+    region_end = None
+    for site_idx in sorted(range(len(het_sites)), key=lambda i: het_sites[i]["pos"]):
+        pos = int(het_sites[site_idx]["pos"])
+        if region_end is None or int(max(0, pos - mate_dist)) > region_end:
+            regions.append([])
+        regions[-1].append(site_idx)
+        region_end = int(pos + 1 + mate_dist)
+    return regions
+
+
+def get_grouping_mate(bamfile, read, read_buffer, concordant_upper_len):
+    """
+    the mate of a read if the pair can be used to group reads by haplotype, else None
+    """
+    insert_size = abs(read.tlen - (READLEN * 2))
+    # if it's a high-quality concordant read we might use it
+    if not goodread(read) or insert_size > concordant_upper_len:
+        return None
+    mate = find_mate(bamfile, read, read_buffer)
+    if mate is None or not goodread(mate):
+        return None
+
+    mismatch_count = 0
+    for operation, length in read.cigartuples:
+        if operation not in MATCH_OPS:
+            mismatch_count += 1
+    if mismatch_count > 5:
+        return None
+
+    if (get_unaligned_count(read) > 5) or (get_unaligned_count(mate) > 5):
+        return None
+
+    read_coords = [read.reference_start, read.reference_end]
+    mate_coords = [mate.reference_start, mate.reference_end]
+    if (
+        mate_coords[0] <= read_coords[0] <= mate_coords[1]
+        or mate_coords[0] <= read_coords[1] <= mate_coords[1]
+    ):
+        # this means the mate pairs overlap each other,
+        # which is not biologically possible
+        # and is a sign of an alignment error
+        return None
+    return mate
+
+
 def group_reads_by_haplotype(
-    bamfile, region, grouped_reads, het_sites, reads_idx, concordant_upper_len
+    bamfile,
+    region,
+    grouped_reads,
+    het_sites,
+    reads_idx,
+    concordant_upper_len,
+    read_buffer,
 ):
     """
     using the heterozygous sites to group the reads into those which come from the same
-    haplotype as the de novo variant (alt) and those that don't (ref)
+    haplotype as the de novo variant (alt) and those that don't (ref).
+    read_buffer holds the reads fetched to find the grouped reads
     """
     fetched_reads = {}
     read_sites = {}
     site_reads = {}
-    for het_site in het_sites:
-        try:
-            bam_iter = bamfile.fetch(
-                region["chrom"], het_site["pos"], het_site["pos"] + 1
-            )
-        except ValueError:
-            chrom = (
-                region["chrom"].strip("chr")
-                if "chr" in region["chrom"]
-                else "chr" + region["chrom"]
-            )
-            bam_iter = bamfile.fetch(chrom, het_site["pos"], het_site["pos"] + 1)
-
-        for i, read in enumerate(bam_iter):
-            if i > EXTENDED_RB_READ_GOAL:
-                continue
-            insert_size = abs(read.tlen - (READLEN * 2))
-            # if it's a high-quality concordant read we might use it
-            if goodread(read) and (insert_size <= concordant_upper_len):
-                try:
-                    mate = bamfile.mate(read)
-                except ValueError:
+    site_pairs = [[] for het_site in het_sites]
+    for region_sites in get_het_site_regions(het_sites, concordant_upper_len):
+        site_positions = [het_sites[site_idx]["pos"] for site_idx in region_sites]
+        region_reads = fetch_pairs(
+            bamfile,
+            read_buffer,
+            [[pos, pos + 1] for pos in site_positions],
+            concordant_upper_len,
+        )
+        # each site samples MAX_READS of the reads that cover it, up to its scan
+        # limit, and each sampled read is checked once, however many sites it covers
+        site_counts = [0] * len(site_positions)
+        site_samples = [[] for pos in site_positions]
+        site_rngs = [random.Random(int(pos)) for pos in site_positions]
+        scan_limits = [get_scan_limit(pos, pos + 1) for pos in site_positions]
+        for read_idx, read in enumerate(region_reads):
+            first = bisect_left(site_positions, read.reference_start)
+            last = bisect_left(site_positions, get_read_end(read), lo=first)
+            for region_idx in range(first, last):
+                if site_counts[region_idx] >= scan_limits[region_idx]:
                     continue
-                if goodread(mate):
-
-                    mismatch_count = 0
-                    for tup in read.cigartuples:
-                        operation = CIGAR_MAP[tup[0]]
-                        if operation not in ["M", "="]:
-                            mismatch_count += 1
-                    if mismatch_count > 5:
-                        continue
+                add_to_sample(
+                    site_samples[region_idx],
+                    site_counts[region_idx],
+                    (read_idx, read),
+                    MAX_READS,
+                    site_rngs[region_idx],
+                )
+                site_counts[region_idx] += 1
 
-                    ref_positions = read.get_reference_positions(full_length=True)
-                    mate_ref_positions = mate.get_reference_positions(full_length=True)
-                    if (ref_positions.count(None) > 5) or (
-                        mate_ref_positions.count(None) > 5
-                    ):
-                        continue
+        mates = {}
+        for site_idx, sample in zip(region_sites, site_samples):
+            sample.sort(key=lambda item: item[0])
+            for read_idx, read in sample:
+                if read_idx not in mates:
+                    mates[read_idx] = get_grouping_mate(
+                        bamfile, read, read_buffer, concordant_upper_len
+                    )
+                if mates[read_idx] is not None:
+                    site_pairs[site_idx].append([read, mates[read_idx]])
+
+    for het_site, pairs in zip(het_sites, site_pairs):
+        for read, mate in pairs:
+            if read.query_name not in read_sites:
+                read_sites[read.query_name] = []
+            if het_site["pos"] not in site_reads:
+                site_reads[het_site["pos"]] = []
+
+            read_sites[read.query_name].append(het_site)
+            site_reads[het_site["pos"]].append(read.query_name)
+            fetched_reads[read.query_name] = [read, mate]
 
-                    read_coords = [read.reference_start, read.reference_end]
-                    mate_coords = [mate.reference_start, mate.reference_end]
-                    if (
-                        mate_coords[0] <= read_coords[0] <= mate_coords[1]
-                        or mate_coords[0] <= read_coords[1] <= mate_coords[1]
-                    ):
-                        # this means the mate pairs overlap each other,
-                        # which is not biologically possible
-                        # and is a sign of an alignment error
-                        continue
-                    if read.query_name not in read_sites:
-                        read_sites[read.query_name] = []
-                    if het_site["pos"] not in site_reads:
-                        site_reads[het_site["pos"]] = []
-
-                    read_sites[read.query_name].append(het_site)
-                    site_reads[het_site["pos"]].append(read.query_name)
-                    fetched_reads[read.query_name] = [read, mate]
     grouped_readsets = {"ref": set(), "alt": set()}
     new_reads = {"alt": [], "ref": []}
 
@@ -229,24 +792,23 @@ def group_reads_by_haplotype(
             # also make a list of readnames and nonreal positions for the matching algorithm
             grouped_readsets[refalt].add(read.query_name)
             new_reads[refalt].append([read.query_name, -1])
-            try:
-                mate = bamfile.mate(read)
-                fetched_reads[read.query_name] = [read, mate]
-                match_sites = binary_search(
-                    read.reference_start, read.reference_end, het_sites
-                )
-                if len(match_sites) <= 0:
-                    continue
-                if read.query_name not in read_sites:
-                    read_sites[read.query_name] = []
-                if het_site["pos"] not in site_reads:
-                    site_reads[het_site["pos"]] = []
-
-                for match_site in match_sites:
-                    read_sites[read.query_name].append(match_site)
-                    site_reads[het_site["pos"]].append(read.query_name)
-            except ValueError:
+            mate = find_mate(bamfile, read, read_buffer)
+            if mate is None:
+                continue
+            fetched_reads[read.query_name] = [read, mate]
+            match_sites = binary_search(
+                read.reference_start, read.reference_end, het_sites
+            )
+            if len(match_sites) <= 0:
                 continue
+            if read.query_name not in read_sites:
+                read_sites[read.query_name] = []
+
+            for match_site in match_sites:
+                if match_site["pos"] not in site_reads:
+                    site_reads[match_site["pos"]] = []
+                read_sites[read.query_name].append(match_site)
+                site_reads[match_site["pos"]].append(read.query_name)
 
     connected_reads = connect_reads(
         grouped_readsets, read_sites, site_reads, new_reads, fetched_reads
@@ -268,26 +830,19 @@ def indel_match_alleles(informative_reads, read, mate, ref, alt, position):
     Assume the alleles are different lengths (INDEL case only)
     """
     var_len = max(len(ref), len(alt))
-    read_ref_positions = read.get_reference_positions(full_length=True)
-
-    if position in read_ref_positions:
-        read_pos = read_ref_positions.index(position)
-    else:
+    read_pos = get_query_offset(read, position)
+    if read_pos is None:
         return
-    operations = []
-    for tup in read.cigartuples:
-        operations += [CIGAR_MAP[tup[0]] for x in range(tup[1])]
-    variant_ops = operations[read_pos: read_pos + var_len]
     variant_quals = read.query_qualities[read_pos: read_pos + var_len]
     for qual in variant_quals:
         if qual < MIN_BASE_QUAL:
             return
 
-    if "I" in variant_ops or "D" in variant_ops:
+    if count_cigar_ops(read.cigartuples, read_pos, read_pos + var_len, INDEL_OPS) > 0:
         informative_reads["alt"].append(read)
         if mate:
             informative_reads["alt"].append(mate)
-    elif 7 < read_pos < (len(read_ref_positions) - 7):
+    elif 7 < read_pos < (get_query_len(read) - 7):
         informative_reads["ref"].append(read)
         if mate:
             informative_reads["ref"].append(mate)
@@ -351,6 +906,8 @@ def collect_reads_snv(
     min_gt_qual,
     readlen,
     split_error_margin,
+    max_reads,
+    sweep_span=None,
 ):
     """
     given an alignment file name, a de novo SNV region,
@@ -360,51 +917,47 @@ def collect_reads_snv(
     """
     global MIN_BASE_QUAL
     MIN_BASE_QUAL = min_gt_qual
+    global LOW_QUALS
+    LOW_QUALS = get_low_quals(min_gt_qual)
     global MIN_MAPQ
     MIN_MAPQ = min_map_qual
     global READLEN
     READLEN = readlen
     global SPLITTER_ERR_MARGIN
     SPLITTER_ERR_MARGIN = split_error_margin
-    global EXTENDED_RB_READ_GOAL
-    EXTENDED_RB_READ_GOAL = insert_size_max_sample
+    global MAX_READS
+    MAX_READS = max_reads
 
-    if "cram" == bam_name[-4:]:
-        bamfile = pysam.AlignmentFile(bam_name, "rc", reference_filename=cram_ref)
-    else:
-        bamfile = pysam.AlignmentFile(bam_name, "rb")
+    bamfile = get_alignment_file(bam_name, cram_ref)
+    clear_cached_offsets()
 
     if not concordant_upper_len:
-        concordant_upper_len = estimate_concordant_insert_len(
-            bamfile, insert_size_max_sample, stdevs
+        concordant_upper_len = get_concordant_insert_len(
+            bam_name, cram_ref, insert_size_max_sample, stdevs, READLEN
         )
 
     supporting_reads = []
     position = int(region["start"])
-    try:
-        bam_iter = bamfile.fetch(region["chrom"], position - 1, position + 1)
-    except ValueError:
-        chrom = (
-            region["chrom"].strip("chr")
-            if "chr" in region["chrom"]
-            else "chr" + region["chrom"]
-        )
-        bam_iter = bamfile.fetch(chrom, position, position + 1)
+    chrom = resolve_contig(get_bam_contig_aliases(bamfile), region["chrom"])
+    # mates are paired from a fetch widened by the concordant insert length
+    read_buffer = new_read_buffer(bamfile, chrom, sweep_span)
+    bam_iter = sample_reads(
+        fetch_pairs(
+            bamfile, read_buffer, [[position - 1, position + 1]], concordant_upper_len
+        ),
+        get_window_budget(position - 1, position + 1),
+        position,
+    )
     informative_reads = {"alt": supporting_reads, "ref": []}
     for read in bam_iter:
         insert_size = abs(read.tlen - (READLEN * 2))
         if not goodread(read) or (insert_size > concordant_upper_len):
             continue
         # find mate for informative site check
-        try:
-            mate = bamfile.mate(read)
-            if not goodread(mate):
-                continue
-        except ValueError:
+        mate = find_mate(bamfile, read, read_buffer)
+        if not goodread(mate):
             continue
-        ref_positions = read.get_reference_positions(full_length=True)
-        mate_ref_positions = mate.get_reference_positions(full_length=True)
-        if (ref_positions.count(None) > 5) or (mate_ref_positions.count(None) > 5):
+        if (get_unaligned_count(read) > 5) or (get_unaligned_count(mate) > 5):
             continue
         read_coords = [read.reference_start, read.reference_end]
         mate_coords = [mate.reference_start, mate.reference_end]
@@ -427,7 +980,13 @@ def collect_reads_snv(
     if no_extended:
         return informative_reads, concordant_upper_len
     informative_reads = group_reads_by_haplotype(
-        bamfile, region, informative_reads, het_sites, 0, concordant_upper_len
+        bamfile,
+        region,
+        informative_reads,
+        het_sites,
+        0,
+        concordant_upper_len,
+        read_buffer,
     )
     return informative_reads, concordant_upper_len
 
@@ -445,6 +1004,8 @@ def collect_reads_sv(
     min_gt_qual,
     readlen,
     split_error_margin,
+    max_reads,
+    sweep_span=None,
 ):
     """
     given an alignment file name, a de novo SV region,
@@ -454,47 +1015,46 @@ def collect_reads_sv(
     """
     global MIN_BASE_QUAL
     MIN_BASE_QUAL = min_gt_qual
+    global LOW_QUALS
+    LOW_QUALS = get_low_quals(min_gt_qual)
     global MIN_MAPQ
     MIN_MAPQ = min_map_qual
     global READLEN
     READLEN = readlen
     global SPLITTER_ERR_MARGIN
     SPLITTER_ERR_MARGIN = split_error_margin
-    global EXTENDED_RB_READ_GOAL
-    EXTENDED_RB_READ_GOAL = insert_size_max_sample
+    global MAX_READS
+    MAX_READS = max_reads
 
-    if "cram" == bam_name[-4:]:
-        bamfile = pysam.AlignmentFile(bam_name, "rc", reference_filename=cram_ref)
-    else:
-        bamfile = pysam.AlignmentFile(bam_name, "rb")
+    bamfile = get_alignment_file(bam_name, cram_ref)
+    clear_cached_offsets()
 
     if not concordant_upper_len:
-        concordant_upper_len = estimate_concordant_insert_len(
-            bamfile, insert_size_max_sample, stdevs
+        concordant_upper_len = get_concordant_insert_len(
+            bam_name, cram_ref, insert_size_max_sample, stdevs, READLEN
         )
 
     supporting_reads = []
     var_len = abs(float(region["end"]) - float(region["start"]))
-    for position in region["start"], region["end"]:
-        position = int(position)
-        try:
-            bam_iter = bamfile.fetch(
-                region["chrom"],
-                max(0, position - concordant_upper_len),
-                position + concordant_upper_len,
-            )
-        except ValueError:
-            chrom = region["chrom"]
-            if "chr" in chrom:
-                chrom = chrom.replace("chr", "")
-            else:
-                chrom = "chr" + chrom
-
-            bam_iter = bamfile.fetch(
-                chrom,
-                max(0, position - concordant_upper_len),
-                position + concordant_upper_len,
-            )
+    chrom = resolve_contig(get_bam_contig_aliases(bamfile), region["chrom"])
+    # the mates of concordant reads are paired from fetches widened by the
+    # concordant insert length, and those of discordant reads at one breakpoint
+    # are often in the fetch of the other
+    read_buffer = new_read_buffer(bamfile, chrom, sweep_span)
+    positions = [int(region["start"]), int(region["end"])]
+    windows = [
+        [int(max(0, position - concordant_upper_len)), position + concordant_upper_len]
+        for position in positions
+    ]
+    breakpoint_reads = [
+        sample_reads(
+            fetch_pairs(bamfile, read_buffer, [[start, end]], concordant_upper_len),
+            get_window_budget(start, end),
+            position,
+        )
+        for position, (start, end) in zip(positions, windows)
+    ]
+    for position, bam_iter in zip(positions, breakpoint_reads):
         banned_reads = []
         for read in bam_iter:
             # skip if the mate has been banned for QC issues
@@ -504,19 +1064,19 @@ def collect_reads_sv(
                 continue
 
             # find mate for informative site check
-            try:
-                mate = bamfile.mate(read)
-            except ValueError:
+            mate = find_mate(bamfile, read, read_buffer)
+            if mate is None:
                 continue
             insert_size = abs(read.tlen - (READLEN * 2))
             if not goodread(mate, True):
                 continue
 
-            operations = []
-            for tup in read.cigartuples:
-                operations += [CIGAR_MAP[tup[0]] for x in range(tup[1])]
-            start_matches = operations[:10].count("M") + operations[:10].count("=")
-            end_matches = operations[-10:].count("M") + operations[-10:].count("=")
+            # matched bases in the first and last 10 operations
+            cigar_len = get_cigar_len(read.cigartuples)
+            start_matches = count_cigar_ops(read.cigartuples, 0, 10, MATCH_OPS)
+            end_matches = count_cigar_ops(
+                read.cigartuples, max(0, cigar_len - 10), cigar_len, MATCH_OPS
+            )
             if end_matches < 7 and start_matches < 7:
                 banned_reads.append(read.query_name)
                 continue
@@ -534,12 +1094,6 @@ def collect_reads_sv(
             elif (insert_size > concordant_upper_len) and (
                 0.7 < abs(var_len / insert_size) < 1.3
             ):
-
-                # find mate for informative site check
-                try:
-                    mate = bamfile.mate(read)
-                except ValueError:
-                    continue
                 left_read_positions = [
                     min(mate.reference_start, read.reference_start),
                     min(mate.reference_end, read.reference_end),
@@ -562,26 +1116,19 @@ def collect_reads_sv(
                 supporting_reads.append(mate)
                 supporting_reads.append(read)
             else:  # find clipped reads that aren't split alignment but still support the variant
-                ref_positions = read.get_reference_positions(full_length=True)
-                if position in ref_positions:
-                    region_pos = ref_positions.index(position)
-                elif position - 1 in ref_positions:
-                    region_pos = ref_positions.index(position - 1)
-                elif position + 1 in ref_positions:
-                    region_pos = ref_positions.index(position + 1)
-                else:
+                region_pos = None
+                for near_position in [position, position - 1, position + 1]:
+                    region_pos = get_query_offset(read, near_position)
+                    if region_pos is not None:
+                        break
+                if region_pos is None:
                     continue
-                if (region_pos < 2) or (region_pos > (len(ref_positions) - 4)):
+                if (region_pos < 2) or (region_pos > (get_query_len(read) - 4)):
                     continue
-                before_positions = list(set(ref_positions[: region_pos - 1]))
-                after_positions = list(set(ref_positions[region_pos + 1:]))
-                # identify clipping that matches the variant
-                if (
-                    len(before_positions) == 1
-                    and before_positions[0] is None
-                    or len(after_positions) == 1
-                    and after_positions[0] is None
-                ):
+                first_aligned, last_aligned = get_aligned_query_range(read)
+                # identify clipping that matches the variant: none of the read
+                # before it, or none after it, is aligned
+                if first_aligned >= region_pos - 1 or last_aligned <= region_pos:
                     supporting_reads.append(mate)
                     supporting_reads.append(read)
 
@@ -597,7 +1144,13 @@ def collect_reads_sv(
     if no_extended:
         return informative_reads, concordant_upper_len
     informative_reads = group_reads_by_haplotype(
-        bamfile, region, informative_reads, het_sites, 0, concordant_upper_len
+        bamfile,
+        region,
+        informative_reads,
+        het_sites,
+        0,
+        concordant_upper_len,
+        read_buffer,
     )
     return informative_reads, concordant_upper_len
 
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+"""
+on-disk store of precomputed informative sites, written by `unfazed prepare-sites`.
+
+the store is a directory with a json manifest and, for each chromosome, a set of
+.npy arrays (positions, alleles, and site flags) holding every family's sites
+back to back. each family's sites are sorted by position and located by the
+offsets in the manifest, so a search window is two binary searches over
+memory-mapped arrays instead of a query of the sites VCF
+"""
+
+from __future__ import print_function
+
+import json
+import os
+import sys
+from threading import Lock
+
+import numpy as np
+
+from .utils import get_contig_aliases
+
+STORE_VERSION = 1
+MANIFEST_NAME = "manifest.json"
+STORE_FIELDS = ["pos", "ref", "alt", "flags"]
+STORE_DTYPES = {"pos": np.int64, "ref": "S1", "alt": "S1", "flags": np.uint8}
+
+# bits of the flags array
+HET_FLAG = 1
+CANDIDATE_FLAG = 2
+ALT_FROM_DAD_FLAG = 4
+# the kid allele of a site inside a DEL or DUP is stored as a 2 bit code
+KID_ALLELE_SHIFTS = {"DEL": 3, "DUP": 5}
+KID_ALLELE_CODES = [None, "ref_parent", "alt_parent"]
+
+
+def is_site_store(sites):
+    return os.path.isdir(sites) and os.path.exists(os.path.join(sites, MANIFEST_NAME))
+
+
+def get_sites_vcf(sites):
+    """
+    the sites VCF a store was prepared from, or the sites file itself if not a store
+    """
+    if not is_site_store(sites):
+        return sites
+    with open(os.path.join(sites, MANIFEST_NAME), "r") as manifest_file:
+        return json.load(manifest_file)["sites_vcf"]
+
+
+def encode_kid_alleles(kid_alleles, vartype):
+    codes = np.zeros(len(kid_alleles), dtype=np.uint8)
+    for code, kid_allele in enumerate(KID_ALLELE_CODES):
+        if kid_allele is not None:
+            codes[kid_alleles == kid_allele] = code
+    return codes << KID_ALLELE_SHIFTS[vartype]
+
+
+def encode_site_flags(trio_sites, cnv_trio_sites):
+    """
+    pack the trio classification of a block of sites into flags.
+    cnv_trio_sites holds the classification for each CNV vartype,
+    only the kid alleles of its candidate sites are kept
+    """
+    flags = np.zeros(len(trio_sites["het"]), dtype=np.uint8)
+    flags[trio_sites["het"]] |= HET_FLAG
+    flags[trio_sites["candidate"]] |= CANDIDATE_FLAG
+    flags[trio_sites["alt_from_dad"]] |= ALT_FROM_DAD_FLAG
+    for vartype in cnv_trio_sites:
+        candidate = cnv_trio_sites[vartype]["candidate"]
+        flags[candidate] |= encode_kid_alleles(
+            cnv_trio_sites[vartype]["kid_allele"][candidate], vartype
+        )
+    return flags
+
+
+def write_site_store(store_dir, manifest, chrom_sites):
+    """
+    write the sites of each family on a chromosome back to back
+    and record where each family's sites start in the manifest.
+    chrom_sites is a generator of (chrom, {kid: {field: array}})
+    """
+    if not os.path.exists(store_dir):
+        os.makedirs(store_dir)
+    manifest["version"] = STORE_VERSION
+    manifest["chroms"] = []
+    for family in manifest["families"].values():
+        family["offsets"] = []
+    for chrom, family_sites in chrom_sites:
+        chrom_idx = len(manifest["chroms"])
+        manifest["chroms"].append(chrom)
+        offset = 0
+        for kid in sorted(manifest["families"]):
+            count = len(family_sites[kid]["pos"]) if kid in family_sites else 0
+            manifest["families"][kid]["offsets"].append([offset, count])
+            offset += count
+        for field in STORE_FIELDS:
+            chunks = [
+                family_sites[kid][field]
+                for kid in sorted(manifest["families"])
+                if kid in family_sites
+            ]
+            np.save(
+                os.path.join(store_dir, "{}.{}.npy".format(chrom_idx, field)),
+                (
+                    np.concatenate(chunks)
+                    if len(chunks) > 0
+                    else np.zeros(0, dtype=STORE_DTYPES[field])
+                ),
+            )
+    with open(os.path.join(store_dir, MANIFEST_NAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def open_site_store(store_dir, site_filters):
+    """
+    read a store's manifest. the sites arrays are memory-mapped when first used.
+    exits if the store was made with different quality filters than requested
+    """
+    with open(os.path.join(store_dir, MANIFEST_NAME), "r") as manifest_file:
+        store = json.load(manifest_file)
+    if store.get("version") != STORE_VERSION:
+        sys.exit(
+            "Sites store {} is from an incompatible version of unfazed. "
+            "Rerun `unfazed prepare-sites`".format(store_dir)
+        )
+    for name in site_filters:
+        if store["filters"][name] != site_filters[name]:
+            sys.exit(
+                "Sites store {} was prepared with {} {}, not {}. ".format(
+                    store_dir, name, store["filters"][name], site_filters[name]
+                )
+                + "Rerun `unfazed prepare-sites` with matching options"
+            )
+    store["dir"] = store_dir
+    store["chrom_idxs"] = dict(zip(store["chroms"], range(len(store["chroms"]))))
+    store["aliases"] = get_contig_aliases(store["chroms"])
+    store["arrays"] = {}
+    store["lock"] = Lock()
+    return store
+
+
+def get_store_arrays(store, chrom_idx):
+    with store["lock"]:
+        if chrom_idx not in store["arrays"]:
+            store["arrays"][chrom_idx] = {
+                field: np.load(
+                    os.path.join(store["dir"], "{}.{}.npy".format(chrom_idx, field)),
+                    mmap_mode="r",
+                )
+                for field in STORE_FIELDS
+            }
+    return store["arrays"][chrom_idx]
+
+
+def get_family_sites(store, kid, dad, mom, chrom):
+    """
+    the position-sorted sites of a trio on a chromosome (named as in the sites VCF),
+    or None if the store doesn't have the trio
+    """
+    if kid not in store["families"]:
+        return None
+    family = store["families"][kid]
+    if family["dad"] != dad or family["mom"] != mom:
+        return None
+    family_sites = {"chrom": chrom}
+    if chrom not in store["chrom_idxs"]:
+        for field in STORE_FIELDS:
+            family_sites[field] = np.zeros(0, dtype=STORE_DTYPES[field])
+        return family_sites
+    chrom_idx = store["chrom_idxs"][chrom]
+    offset, count = family["offsets"][chrom_idx]
+    arrays = get_store_arrays(store, chrom_idx)
+    for field in STORE_FIELDS:
+        family_sites[field] = arrays[field][offset : offset + count]
+    return family_sites
+
+
+def find_window_rows(family_sites, windows):
+    """
+    rows of the sites that overlap each closed, 1-based window, in window order
+    """
+    rows = []
+    for start, end in windows:
+        # sites are stored by their 0-based start
+        first = np.searchsorted(family_sites["pos"], start - 1, side="left")
+        last = np.searchsorted(family_sites["pos"], end - 1, side="right")
+        rows.append(np.arange(first, last))
+    if len(rows) == 0:
+        return np.zeros(0, dtype=np.int64)
+    return np.concatenate(rows)
+
+
+def load_store_block(family_sites, rows, vartype):
+    """
+    the sites in the given rows as a block with their trio classification,
+    in the form used for sites read from the VCF
+    """
+    block = {
+        "chrom": family_sites["chrom"],
+        "pos": family_sites["pos"][rows].astype(np.int64),
+        "ref": [ref.decode() for ref in family_sites["ref"][rows]],
+        "alt": [alt.decode() for alt in family_sites["alt"][rows]],
+    }
+    flags = family_sites["flags"][rows]
+    trio_sites = {
+        "het": (flags & HET_FLAG) > 0,
+        "candidate": (flags & CANDIDATE_FLAG) > 0,
+        "alt_from_dad": (flags & ALT_FROM_DAD_FLAG) > 0,
+    }
+    if vartype is not None:
+        if vartype in KID_ALLELE_SHIFTS:
+            codes = (flags >> KID_ALLELE_SHIFTS[vartype]) & 3
+        else:
+            codes = np.zeros(len(flags), dtype=np.uint8)
+        trio_sites["kid_allele"] = np.array(KID_ALLELE_CODES, dtype=object)[codes]
+        trio_sites["candidate"] = codes > 0
+    return block, trio_sites
+
+
+if __name__ == "__main__":
+    sys.exit("Import this as a module")
@@ -4,15 +4,19 @@ from __future__ import print_function
 import sys
 from concurrent.futures import ThreadPoolExecutor, wait
 
-from cyvcf2 import VCF
-
-from .informative_site_finder import find, get_prefix
-from .read_collector import collect_reads_snv
+from .handle_pool import get_vcf
+from .informative_site_finder import find
+from .insert_sizes import get_sample_insert_len
+from .read_collector import (
+    add_kid_sweep_spans,
+    clear_cached_offsets,
+    collect_reads_snv,
+    get_query_offset,
+)
+from .site_store import get_sites_vcf
 from .site_searcher import match_informative_sites
 from .utils import *
 
-concordant_upper_lens = {}
-
 def phase_by_reads(matches):
     # parent_ids -> list of informative site matches
     origin_parent_data = {}
@@ -25,11 +29,8 @@ def phase_by_reads(matches):
                     origin_parent_data[match["ref_parent"]] = []
                     origin_parent_data[match["alt_parent"]] = []
                 # to avoid issues from indels, use the reference position to index the read
-                try:
-                    read_pos = read.get_reference_positions(full_length=True).index(
-                        match["pos"]
-                    )
-                except ValueError:
+                read_pos = get_query_offset(read, match["pos"])
+                if read_pos is None:
                     continue
                 kid_allele = read.query_sequence[read_pos]
 
@@ -71,11 +72,12 @@ def phase_by_reads(matches):
 
 
 def get_refalt(chrom, pos, vcf_filehandle, kid_idx):
+    """
+    the alleles of the variant at pos. chrom is named as in the vcf
+    """
     alts = []
     ref = None
-    region = "{}{}:{}-{}".format(
-        get_prefix(vcf_filehandle), chrom.strip("chr"), pos, int(pos) + 1
-    )
+    region = "{}:{}-{}".format(chrom, pos, int(pos) + 1)
     for variant in vcf_filehandle(region):
         if ref is None:
             ref = variant.REF
@@ -97,8 +99,9 @@ def multithread_read_phasing(
     min_gt_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
-    vcf_filehandle = VCF(vcf)
+    vcf_filehandle = get_vcf(vcf)
     sample_dict = dict(zip(vcf_filehandle.samples, range(len(vcf_filehandle.samples))))
 
     region = {
@@ -109,7 +112,7 @@ def multithread_read_phasing(
     if denovo["kid"] not in sample_dict:
         return
     ref, alts = get_refalt(
-        region["chrom"],
+        resolve_contig(get_vcf_contig_aliases(vcf, vcf_filehandle), region["chrom"]),
         region["start"],
         vcf_filehandle,
         sample_dict[denovo["kid"]],
@@ -130,9 +133,14 @@ def multithread_read_phasing(
         return
     alt = alts[0]
     informative_sites = denovo["candidate_sites"]
-    concordant_upper_len = None
-    if denovo["kid"] in concordant_upper_lens:
-        concordant_upper_len = concordant_upper_lens[denovo["kid"]]
+    concordant_upper_len = get_sample_insert_len(
+        denovo["kid"],
+        denovo["bam"],
+        denovo["cram_ref"],
+        insert_size_max_sample,
+        stdevs,
+        readlen,
+    )
 
     # these are reads that support the ref or alt allele of the de novo variant
     dnm_reads, concordant_upper_len = collect_reads_snv(
@@ -150,10 +158,14 @@ def multithread_read_phasing(
         min_gt_qual,
         readlen,
         split_error_margin,
+        max_reads,
+        denovo["sweep_span"],
     )
-    concordant_upper_lens[denovo["kid"]] = concordant_upper_len
 
     matches = match_informative_sites(dnm_reads, informative_sites)
+    counts = phase_by_reads(matches)
+    # the offsets of this variant's reads won't be looked up again
+    clear_cached_offsets()
 
     if len(matches["alt"]) <= 0 and len(matches["ref"]) <= 0:
         if not QUIET_MODE:
@@ -165,7 +177,6 @@ def multithread_read_phasing(
             )
         return
 
-    counts = phase_by_reads(matches)
     if dad_id in counts:
         dad_informative_sites = [str(c[1]) for c in counts[dad_id]]
         dad_informative_sites = list(set(dad_informative_sites))
@@ -222,6 +233,7 @@ def run_read_phasing(
     min_map_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
     # get informative sites near SNVs for read-backed phasing
     dnms_with_informative_sites = find(
@@ -239,12 +251,12 @@ def run_read_phasing(
         min_gt_qual,
         min_depth,
         whole_region=False,
+        het_sites=not no_extended,
     )
+    # the denovo alleles are read from the sites VCF, even if sites come from a store
+    sites_vcf = get_sites_vcf(vcf)
     records = {}
-    if threads != 1:
-        executor = ThreadPoolExecutor(threads)
-        futures = []
-
+    phaseable_dnms = []
     for denovo in dnms_with_informative_sites:
         dad_id = pedigrees[denovo["kid"]]["dad"]
         mom_id = pedigrees[denovo["kid"]]["mom"]
@@ -261,15 +273,27 @@ def run_read_phasing(
                 )
             continue
 
+        phaseable_dnms.append(denovo)
+
+    # dense stretches of a kid's variants are read in one pass over its alignment
+    # file. they're found before scheduling, so each is phased by one worker
+    add_kid_sweep_spans(
+        phaseable_dnms, threads, insert_size_max_sample, stdevs, readlen
+    )
+    # each worker phases the variants of its kids in coordinate order
+    if threads != 1:
+        executors = [ThreadPoolExecutor(1) for worker in range(threads)]
+        futures = []
+    for worker, denovo in schedule_by_kid(phaseable_dnms, threads):
         if threads != 1:
             futures.append(
-                executor.submit(
+                executors[worker].submit(
                     multithread_read_phasing,
                     denovo,
                     records,
-                    vcf,
-                    dad_id,
-                    mom_id,
+                    sites_vcf,
+                    pedigrees[denovo["kid"]]["dad"],
+                    pedigrees[denovo["kid"]]["mom"],
                     no_extended,
                     insert_size_max_sample,
                     stdevs,
@@ -277,15 +301,16 @@ def run_read_phasing(
                     min_gt_qual,
                     readlen,
                     split_error_margin,
+                    max_reads,
                 )
             )
         else:
             multithread_read_phasing(
                 denovo,
                 records,
-                vcf,
-                dad_id,
-                mom_id,
+                sites_vcf,
+                pedigrees[denovo["kid"]]["dad"],
+                pedigrees[denovo["kid"]]["mom"],
                 no_extended,
                 insert_size_max_sample,
                 stdevs,
@@ -293,9 +318,12 @@ def run_read_phasing(
                 min_gt_qual,
                 readlen,
                 split_error_margin,
+                max_reads,
             )
     if threads != 1:
         wait(futures)
+        for executor in executors:
+            executor.shutdown()
     return records
 
 
@@ -374,6 +402,7 @@ def phase_snvs(
     min_map_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
     global QUIET_MODE
     QUIET_MODE = quiet_mode
@@ -396,4 +425,5 @@ def phase_snvs(
         min_map_qual,
         readlen,
         split_error_margin,
+        max_reads,
     )
@@ -5,12 +5,16 @@ import sys
 from concurrent.futures import ThreadPoolExecutor, wait
 
 from .informative_site_finder import find
-from .read_collector import collect_reads_sv
+from .insert_sizes import get_sample_insert_len
+from .read_collector import (
+    add_kid_sweep_spans,
+    clear_cached_offsets,
+    collect_reads_sv,
+    get_query_offset,
+)
 from .site_searcher import match_informative_sites
 from .utils import *
 
-concordant_upper_lens = {}
-
 def phase_by_reads(matches):
     # parent_ids -> list of informative site matches
     origin_parent_data = {}
@@ -23,11 +27,8 @@ def phase_by_reads(matches):
                     origin_parent_data[match["ref_parent"]] = []
                     origin_parent_data[match["alt_parent"]] = []
                 # to avoid issues from indels, use the reference position to index the read
-                try:
-                    read_pos = read.get_reference_positions(full_length=True).index(
-                        match["pos"]
-                    )
-                except ValueError:
+                read_pos = get_query_offset(read, match["pos"])
+                if read_pos is None:
                     continue
                 kid_allele = read.query_sequence[read_pos]
 
@@ -97,15 +98,21 @@ def multithread_read_phasing(
     min_gt_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
     region = {
         "chrom": denovo["chrom"],
         "start": denovo["start"],
         "end": denovo["end"],
     }
-    concordant_upper_len = None
-    if denovo["kid"] in concordant_upper_lens:
-        concordant_upper_len = concordant_upper_lens[denovo["kid"]]
+    concordant_upper_len = get_sample_insert_len(
+        denovo["kid"],
+        denovo["bam"],
+        denovo["cram_ref"],
+        insert_size_max_sample,
+        stdevs,
+        readlen,
+    )
 
     # these are reads that support the ref or alt allele of the de novo variant
     dnm_reads,concordant_upper_len = collect_reads_sv(
@@ -121,9 +128,13 @@ def multithread_read_phasing(
         min_gt_qual,
         readlen,
         split_error_margin,
+        max_reads,
+        denovo["sweep_span"],
     )
-    concordant_upper_lens[denovo["kid"]] = concordant_upper_len
     matches = match_informative_sites(dnm_reads, denovo["candidate_sites"])
+    counts = phase_by_reads(matches)
+    # the offsets of this variant's reads won't be looked up again
+    clear_cached_offsets()
 
     if len(matches["alt"]) <= 0 and len(matches["ref"]) <= 0:
         if not QUIET_MODE:
@@ -135,7 +146,6 @@ def multithread_read_phasing(
             )
         return
 
-    counts = phase_by_reads(matches)
     if dad_id in counts:
         dad_informative_sites = [str(c[1]) for c in counts[dad_id]]
         dad_informative_sites = list(set(dad_informative_sites))
@@ -174,47 +184,24 @@ def multithread_read_phasing(
 
 
 def run_read_phasing(
-    dnms,
+    dnms_with_informative_sites,
     pedigrees,
-    vcf,
     threads,
     build,
     no_extended,
-    multiread_proc_min,
-    ab_homref,
-    ab_homalt,
-    ab_het,
     min_gt_qual,
-    min_depth,
-    search_dist,
     insert_size_max_sample,
     stdevs,
     min_map_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
-    # get informative sites near the breakpoints of SVs for reab-backed phasing
-    dnms_with_informative_sites = find(
-        dnms,
-        pedigrees,
-        vcf,
-        search_dist,
-        threads,
-        build,
-        multiread_proc_min,
-        QUIET_MODE,
-        ab_homref,
-        ab_homalt,
-        ab_het,
-        min_gt_qual,
-        min_depth,
-        whole_region=False,
-    )
+    """
+    read-backed phasing of SVs, using the informative sites near their breakpoints
+    """
     records = {}
-    if threads != 1:
-        executor = ThreadPoolExecutor(threads)
-        futures = []
-
+    phaseable_dnms = []
     for denovo in dnms_with_informative_sites:
         dad_id = pedigrees[denovo["kid"]]["dad"]
         mom_id = pedigrees[denovo["kid"]]["mom"]
@@ -230,14 +217,26 @@ def run_read_phasing(
                     file=sys.stderr,
                 )
             continue
+        phaseable_dnms.append(denovo)
+
+    # dense stretches of a kid's variants are read in one pass over its alignment
+    # file. they're found before scheduling, so each is phased by one worker
+    add_kid_sweep_spans(
+        phaseable_dnms, threads, insert_size_max_sample, stdevs, readlen
+    )
+    # each worker phases the variants of its kids in coordinate order
+    if threads != 1:
+        executors = [ThreadPoolExecutor(1) for worker in range(threads)]
+        futures = []
+    for worker, denovo in schedule_by_kid(phaseable_dnms, threads):
         if threads != 1:
             futures.append(
-                executor.submit(
+                executors[worker].submit(
                     multithread_read_phasing,
                     denovo,
                     records,
-                    dad_id,
-                    mom_id,
+                    pedigrees[denovo["kid"]]["dad"],
+                    pedigrees[denovo["kid"]]["mom"],
                     no_extended,
                     insert_size_max_sample,
                     stdevs,
@@ -245,14 +244,15 @@ def run_read_phasing(
                     min_gt_qual,
                     readlen,
                     split_error_margin,
+                    max_reads,
                 )
             )
         else:
             multithread_read_phasing(
                 denovo,
                 records,
-                dad_id,
-                mom_id,
+                pedigrees[denovo["kid"]]["dad"],
+                pedigrees[denovo["kid"]]["mom"],
                 no_extended,
                 insert_size_max_sample,
                 stdevs,
@@ -260,9 +260,12 @@ def run_read_phasing(
                 min_gt_qual,
                 readlen,
                 split_error_margin,
+                max_reads,
             )
     if threads != 1:
         wait(futures)
+        for executor in executors:
+            executor.shutdown()
     return records
 
 
@@ -273,7 +276,7 @@ def multithread_cnv_phasing(denovo, records, dad_id, mom_id):
         "end": denovo["end"],
     }
 
-    origin_data = phase_by_snvs(denovo["candidate_sites"])
+    origin_data = phase_by_snvs(denovo["cnv_candidate_sites"])
     if not origin_data:
         return
 
@@ -354,39 +357,11 @@ def autophase(denovo, pedigrees, records, dad_id, mom_id, build):
     records["_".join(key)] = record
 
 
-def run_cnv_phasing(
-    dnms,
-    pedigrees,
-    vcf,
-    threads,
-    build,
-    multithread_proc_min,
-    ab_homref,
-    ab_homalt,
-    ab_het,
-    min_gt_qual,
-    min_depth,
-):
+def run_cnv_phasing(dnms_with_informative_sites, pedigrees, threads, build):
     """
     Specialized phasing for CNVs,
     using the informative sites from the region with a copy-number change
     """
-    # get informative sites inside CNVs for purely SNV-based phasing
-    dnms_with_informative_sites = find(
-        dnms,
-        pedigrees,
-        vcf,
-        0,
-        threads,
-        build,
-        multithread_proc_min,
-        QUIET_MODE,
-        ab_homref,
-        ab_homalt,
-        ab_het,
-        min_gt_qual,
-        min_depth,
-    )
     records = {}
     if threads != 1:
         executor = ThreadPoolExecutor(threads)
@@ -401,7 +376,10 @@ def run_cnv_phasing(
         if denovo["vartype"] not in ["DEL", "DUP"]:
             continue
 
-        if "candidate_sites" not in denovo or len(denovo["candidate_sites"]) == 0:
+        if (
+            "cnv_candidate_sites" not in denovo
+            or len(denovo["cnv_candidate_sites"]) == 0
+        ):
             if not QUIET_MODE:
                 print(
                     "No usable informative sites for allele-balance phasing of variant {}:{}-{}".format(
@@ -445,41 +423,46 @@ def phase_svs(
     min_map_qual,
     readlen,
     split_error_margin,
+    max_reads,
 ):
     global QUIET_MODE
     QUIET_MODE = quiet_mode
-    cnv_records = run_cnv_phasing(
+    # one pass over the sites finds the informative sites inside CNVs for purely
+    # SNV-based phasing, and those near the breakpoints of SVs for read-backed phasing
+    dnms_with_informative_sites = find(
         dnms,
         pedigrees,
         sites,
+        search_dist,
         threads,
         build,
         multiread_proc_min,
+        QUIET_MODE,
         ab_homref,
         ab_homalt,
         ab_het,
         min_gt_qual,
         min_depth,
+        whole_region=False,
+        het_sites=not no_extended,
+        cnv_sites=True,
+    )
+    cnv_records = run_cnv_phasing(
+        dnms_with_informative_sites, pedigrees, threads, build
     )
     read_records = run_read_phasing(
-        dnms,
+        dnms_with_informative_sites,
         pedigrees,
-        sites,
         threads,
         build,
         no_extended,
-        multiread_proc_min,
-        ab_homref,
-        ab_homalt,
-        ab_het,
         min_gt_qual,
-        min_depth,
-        search_dist,
         insert_size_max_sample,
         stdevs,
         min_map_qual,
         readlen,
         split_error_margin,
+        max_reads,
     )
     for key in cnv_records:
         if key not in read_records:
@@ -4,12 +4,22 @@ from __future__ import print_function
 import gzip
 import os
 import sys
+import time
 from glob import glob
 
 import numpy as np
 from cyvcf2 import VCF, Writer
 
 from .__init__ import __version__
+from .handle_pool import close_handles, set_handle_pool_size
+from .informative_site_finder import prepare
+from .insert_sizes import (
+    ESTIMATE_OPTIONS,
+    get_cache_stats,
+    read_insert_size_metrics,
+    set_insert_size_cache,
+    set_sample_insert_lens,
+)
 from .snv_phaser import phase_snvs
 from .sv_phaser import phase_svs
 from .utils import *
@@ -159,6 +169,19 @@ def parse_ped(ped, kids):
     return kid_entries
 
 
+def read_ped_kids(ped):
+    """
+    the samples in the ped file with both parents listed
+    """
+    kids = set()
+    with open(ped, "r") as pedfile:
+        for line in pedfile:
+            fields = line.strip().split()
+            if len(fields) > 3 and fields[2] != "0" and fields[3] != "0":
+                kids.add(fields[1])
+    return kids
+
+
 def summarize_autophased(read_record, verbose):
     chrom = read_record["region"]["chrom"]
     if chrom.lower().strip("chr") == "y":
@@ -536,6 +559,10 @@ def unfazed(args):
         )
     global QUIET_MODE
     QUIET_MODE = args.quiet
+    set_insert_size_cache(
+        args.insert_size_cache, args.rebuild_insert_size_cache, args.quiet
+    )
+    set_handle_pool_size(args.max_open_files)
 
     output_type = args.output_type if args.output_type is not None else input_type
     if output_type == "vcf" and input_type != "vcf":
@@ -593,6 +620,12 @@ def unfazed(args):
             filtered_svs.append(sv)
     svs = filtered_svs
 
+    # samples with precomputed insert size metrics skip the estimate
+    set_sample_insert_lens(
+        read_insert_size_metrics(
+            args.insert_size_metrics, kids, args.stdevs, args.readlen
+        )
+    )
     phased_svs = {}
     phased_snvs = {}
 
@@ -620,6 +653,7 @@ def unfazed(args):
             args.min_map_qual,
             args.readlen,
             args.split_error_margin,
+            args.max_reads,
         )
     if len(snvs) > 0:
         phased_snvs = phase_snvs(
@@ -643,8 +677,11 @@ def unfazed(args):
             args.min_map_qual,
             args.readlen,
             args.split_error_margin,
+            args.max_reads,
         )
 
+    close_handles()
+
     all_phased = phased_snvs
     all_phased.update(phased_svs)
 
@@ -665,3 +702,55 @@ def unfazed(args):
             args.outfile,
             args.evidence_min_ratio,
         )
+
+
+def prepare_sites(args):
+    global QUIET_MODE
+    QUIET_MODE = args.quiet
+
+    pedigrees = parse_ped(args.ped, read_ped_kids(args.ped))
+    if len(pedigrees) == 0:
+        sys.exit("No trios in the ped file")
+    manifest = prepare(
+        pedigrees,
+        args.sites,
+        args.store,
+        args.quiet,
+        args.ab_homref,
+        args.ab_homalt,
+        args.ab_het,
+        args.min_gt_qual,
+        args.min_depth,
+    )
+    if not QUIET_MODE:
+        print(
+            "Wrote informative sites for {} trios to {}".format(
+                len(manifest["families"]), args.store
+            ),
+            file=sys.stderr,
+        )
+
+
+def format_time(seconds):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(seconds))
+
+
+def insert_size_stats(args):
+    stats = get_cache_stats(args.insert_size_cache)
+    if len(stats) == 0:
+        print(
+            "No insert sizes cached in {}".format(args.insert_size_cache),
+            file=sys.stderr,
+        )
+        return
+    fields = (
+        ["path", "status", "concordant_insert_len"]
+        + ["trimmed_insert_mean", "trimmed_insert_stdev", "inserts_sampled"]
+        + ESTIMATE_OPTIONS
+        + ["size", "modified", "estimated"]
+    )
+    print("#" + "\t".join(fields))
+    for entry in stats:
+        entry["modified"] = format_time(entry["mtime_ns"] // 10**9)
+        entry["estimated"] = format_time(entry["estimated"])
+        print("\t".join(str(entry[field]) for field in fields))
@@ -43,11 +43,101 @@ grch38_par2 = {
 }
 
 
-def get_prefix(vcf):
-    chrom_prefix = ""
-    for var in vcf:
-        if "chr" in var.CHROM.lower():
-            chrom_prefix = var.CHROM[:3]
-        return chrom_prefix
-    return ""
+# contig alias tables of the sites and alignment files, by file name
+CONTIG_ALIASES = {}
 
+
+def get_contig_key(chrom):
+    """
+    the name of a contig without any chr prefix, and MT for the mitochondrial contig
+    """
+    if chrom[:3].lower() == "chr":
+        chrom = chrom[3:]
+    if chrom.upper() in ["M", "MT"]:
+        return "MT"
+    return chrom
+
+
+def get_contig_aliases(contigs):
+    """
+    map each name a contig might be given as (with or without chr, M or MT)
+    to the name of the contig in a file's header
+    """
+    aliases = {}
+    for contig in contigs:
+        if get_contig_key(contig) not in aliases:
+            aliases[get_contig_key(contig)] = contig
+    # a contig's own name always means that contig
+    for contig in contigs:
+        aliases[contig] = contig
+    return aliases
+
+
+def get_vcf_contig_aliases(vcf_name, vcf):
+    if vcf_name not in CONTIG_ALIASES:
+        CONTIG_ALIASES[vcf_name] = get_contig_aliases(vcf.seqnames)
+    return CONTIG_ALIASES[vcf_name]
+
+
+def get_bam_contig_aliases(bamfile):
+    if bamfile.filename not in CONTIG_ALIASES:
+        CONTIG_ALIASES[bamfile.filename] = get_contig_aliases(bamfile.references)
+    return CONTIG_ALIASES[bamfile.filename]
+
+
+def resolve_contig(aliases, chrom):
+    """
+    the name of chrom in a file, from the file's contig aliases.
+    names the file doesn't have are left as they are
+    """
+    if chrom in aliases:
+        return aliases[chrom]
+    return aliases.get(get_contig_key(chrom), chrom)
+
+
+def get_coordinate_key(denovo):
+    return (get_contig_key(denovo["chrom"]), int(denovo["start"]), int(denovo["end"]))
+
+
+def in_same_sweep(denovo, other):
+    """
+    check if two variants of a kid are read in the same sweep of its alignment file
+    """
+    return (
+        denovo.get("sweep_span") is not None
+        and denovo["chrom"] == other["chrom"]
+        and denovo["sweep_span"] == other.get("sweep_span")
+    )
+
+
+def schedule_by_kid(dnms, workers):
+    """
+    assign variants to workers as (worker, denovo), in the order they should run.
+    each kid's variants are sorted by coordinate and kept on one worker, so its
+    alignment file is read mostly in order through one open handle. kids with more
+    than a worker's share of the variants are split into runs of nearby variants,
+    never between variants that share a sweep_span, so each sweep is read by one
+    worker. the kids (or runs) with the most variants are assigned first,
+    each to the worker with the fewest variants so far
+    """
+    dnms_by_kid = {}
+    for denovo in dnms:
+        dnms_by_kid.setdefault(denovo["kid"], []).append(denovo)
+    share = max(1, -(-len(dnms) // workers))
+    runs = []
+    for kid in sorted(dnms_by_kid):
+        run = []
+        for denovo in sorted(dnms_by_kid[kid], key=get_coordinate_key):
+            if len(run) >= share and not in_same_sweep(run[-1], denovo):
+                runs.append(run)
+                run = []
+            run.append(denovo)
+        runs.append(run)
+    worker_dnms = [[] for worker in range(workers)]
+    for run in sorted(runs, key=lambda x: -len(x)):
+        min(worker_dnms, key=len).extend(run)
+    schedule = []
+    for worker in range(workers):
+        for denovo in worker_dnms[worker]:
+            schedule.append((worker, denovo))
+    return schedule